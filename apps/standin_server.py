@@ -0,0 +1,752 @@
+'''This is a local stand-in for the IG REST API and Lightstreamer, for load testing.
+
+It serves the endpoints this project uses with synthetic prices, so IGClient,
+IGStream and faig.py can run end to end without an IG account:
+
+    python apps/standin_server.py --port 8080 --tick-rate 5 --latency 0.05
+
+then point config.conf at it:
+
+    API_ENDPOINT: http://127.0.0.1:8080/gateway/deal
+
+REST calls are limited per API key (--rate-limit calls per minute) and
+/prices spends a historical data allowance (--allowance points), answering
+with IG's error codes once they run out. Every response is delayed by
+--latency seconds plus up to --jitter seconds.
+'''
+import argparse
+import calendar
+import configparser
+import json
+import logging
+import math
+import queue
+import random
+import re
+import socketserver
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+logging.basicConfig(level='INFO', format='%(asctime)s %(message)s')
+
+ACCOUNT_ID = 'STANDIN01'
+CHART_SCALES = {'SECOND': 1, '1MINUTE': 60, '5MINUTE': 300, 'HOUR': 3600}
+RESOLUTIONS = {'SECOND': 1, 'MINUTE': 60, 'MINUTE_2': 120, 'MINUTE_3': 180, 'MINUTE_5': 300,
+               'MINUTE_10': 600, 'MINUTE_15': 900, 'MINUTE_30': 1800, 'HOUR': 3600, 'HOUR_2': 7200,
+               'HOUR_3': 10800, 'HOUR_4': 14400, 'DAY': 86400, 'WEEK': 604800, 'MONTH': 2592000}
+
+
+def uk_struct(t):
+    '''This is t in UK time, the stand-in account's time zone.'''
+    year = time.gmtime(t).tm_year
+    bst = []
+    for month in (3, 10):
+        last = calendar.monthrange(year, month)[1]
+        sunday = last - (calendar.weekday(year, month, last) + 1) % 7
+        bst.append(calendar.timegm((year, month, sunday, 1, 0, 0)))
+    return time.gmtime(t + (3600 if bst[0] <= t < bst[1] else 0))
+
+
+def uk_time(t=None):
+    '''This is UPDATE_TIME as IG sends it, HH:MM:SS in UK time.'''
+    return time.strftime('%H:%M:%S', uk_struct(time.time() if t is None else t))
+
+
+def ls_value(value):
+    '''This is to encode a field value for the Lightstreamer text protocol.'''
+    if value is None:
+        return '#'
+    value = str(value)
+    if value == '':
+        return '$'
+    if value[0] in '#$':
+        return value[0] + value
+    return value
+
+
+class Market():
+    '''
+
+    This is a synthetic instrument following a random walk.
+
+    Prices are quoted in points, as for spread bets, and spreads come from
+    the minspread in the EPICS config.
+
+    '''
+
+    def __init__(self, epic, minspread, rng):
+        self.epic = epic
+        self.market_id = epic.split('.')[2] if epic.count('.') >= 2 else epic
+        self.rng = rng
+        self.price = round(rng.uniform(5000, 20000) if rng.random() < 0.7 else rng.uniform(50, 8000), 1)
+        self.spread = minspread * rng.uniform(1.0, 1.6)
+        self.day_open = self.price
+        self.day_high = self.price
+        self.day_low = self.price
+        self.volume = 0
+        self.long_pct = rng.uniform(20, 80)
+        self.bars = {}
+        self.completed = {}
+        now = time.time()
+        for scale, seconds in CHART_SCALES.items():
+            self.bars[scale] = self._new_bar(now, seconds)
+
+    def _new_bar(self, now, seconds):
+        start = now - now % seconds
+        return {'start': start, 'end': start + seconds, 'open': self.price, 'high': self.price,
+                'low': self.price, 'close': self.price, 'volume': 0}
+
+    @property
+    def bid(self):
+        return round(self.price - self.spread / 2, 5)
+
+    @property
+    def offer(self):
+        return round(self.price + self.spread / 2, 5)
+
+    def tick(self, now):
+        '''This is to move the price one step, and roll any finished chart bars.'''
+        self.price = max(self.price * (1 + self.rng.gauss(0, 0.0004)), 1e-6)
+        self.day_high = max(self.day_high, self.price)
+        self.day_low = min(self.day_low, self.price)
+        self.volume += 1
+        self.long_pct = min(95, max(5, self.long_pct + self.rng.gauss(0, 0.2)))
+        self.completed = {}
+        for scale, bar in self.bars.items():
+            if now >= bar['end']:
+                self.completed[scale] = bar
+                bar = self.bars[scale] = self._new_bar(now, CHART_SCALES[scale])
+            bar['high'] = max(bar['high'], self.price)
+            bar['low'] = min(bar['low'], self.price)
+            bar['close'] = self.price
+            bar['volume'] += 1
+
+    def change(self):
+        return round(self.price - self.day_open, 5), round((self.price - self.day_open) / self.day_open * 100, 3)
+
+    def market_fields(self):
+        change, change_pct = self.change()
+        return {'BID': self.bid, 'OFFER': self.offer, 'CHANGE': change, 'CHANGE_PCT': change_pct,
+                'MID_OPEN': round(self.day_open, 5), 'HIGH': round(self.day_high, 5), 'LOW': round(self.day_low, 5),
+                'UPDATE_TIME': uk_time(), 'MARKET_DELAY': 0, 'MARKET_STATE': 'TRADEABLE'}
+
+    def chart_fields(self, bar, cons_end):
+        half = self.spread / 2
+        values = {'LTV': bar['volume'], 'UTM': int(bar['start'] * 1000), 'CONS_END': cons_end,
+                  'DAY_LOW': round(self.day_low, 5), 'DAY_HIGH': round(self.day_high, 5),
+                  'DAY_OPEN_MID': round(self.day_open, 5), 'CONS_TICK_COUNT': bar['volume']}
+        for side, sign in (('BID', -1), ('OFR', 1)):
+            for key in ('open', 'high', 'low', 'close'):
+                values['{0}_{1}'.format(side, key.upper())] = round(bar[key] + sign * half, 5)
+        return values
+
+    def snapshot(self):
+        change, change_pct = self.change()
+        return {'instrument': {'epic': self.epic, 'marketId': self.market_id, 'name': self.epic,
+                               'lotSize': 1.0, 'type': 'CURRENCIES', 'onePipMeans': '1',
+                               'marginFactor': 5, 'marginFactorUnit': 'PERCENTAGE',
+                               'currencies': [{'code': 'GBP', 'isDefault': True}],
+                               'openingHours': None},
+                'dealingRules': {'minStepDistance': {'unit': 'POINTS', 'value': 1.0},
+                                 'minDealSize': {'unit': 'POINTS', 'value': 0.5},
+                                 'minControlledRiskStopDistance': {'unit': 'POINTS', 'value': 30.0},
+                                 'minNormalStopOrLimitDistance': {'unit': 'POINTS', 'value': 4.0},
+                                 'maxStopOrLimitDistance': {'unit': 'PERCENTAGE', 'value': 75.0},
+                                 'marketOrderPreference': 'AVAILABLE_DEFAULT_ON',
+                                 'trailingStopsPreference': 'AVAILABLE'},
+                'snapshot': {'marketStatus': 'TRADEABLE', 'bid': self.bid, 'offer': self.offer,
+                             'netChange': change, 'percentageChange': change_pct,
+                             'high': round(self.day_high, 5), 'low': round(self.day_low, 5),
+                             'updateTime': time.strftime('%H:%M:%S'), 'delayTime': 0,
+                             'scalingFactor': 1}}
+
+    def history(self, seconds, points):
+        '''This is to make up a price history ending at the current price.'''
+        prices = []
+        close = self.price
+        now = time.time()
+        now -= now % seconds  # bars start on whole multiples of the resolution, the last one still forming
+        scale = math.sqrt(seconds) * 0.0004
+        for i in range(points):
+            open_ = close / (1 + self.rng.gauss(0, scale))
+            high = max(open_, close) * (1 + abs(self.rng.gauss(0, scale / 2)))
+            low = min(open_, close) * (1 - abs(self.rng.gauss(0, scale / 2)))
+            half = self.spread / 2
+            # as prices version 3 sends them: in the account's time zone, and in UTC
+            bar = {'snapshotTime': time.strftime('%Y/%m/%d %H:%M:%S', uk_struct(now - i * seconds)),
+                   'snapshotTimeUTC': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now - i * seconds)),
+                   'lastTradedVolume': self.rng.randint(100, 5000)}
+            for key, value in (('openPrice', open_), ('closePrice', close), ('highPrice', high), ('lowPrice', low)):
+                bar[key] = {'bid': round(value - half, 2), 'ask': round(value + half, 2), 'lastTraded': None}
+            prices.insert(0, bar)
+            close = open_
+        return prices
+
+
+class Table():
+    '''This is one Lightstreamer subscription (table) of a session.'''
+
+    def __init__(self, table_id, mode, items, fields, max_frequency, snapshot):
+        self.table_id = table_id
+        self.mode = mode
+        self.items = items
+        self.fields = fields
+        self.snapshot = snapshot
+        self.last_sent = {}
+        self.set_frequency(max_frequency)
+
+    def set_frequency(self, max_frequency):
+        try:
+            self.min_interval = 1.0 / float(max_frequency)
+        except (TypeError, ValueError, ZeroDivisionError):
+            self.min_interval = 0
+
+    def due(self, pos, now):
+        if now - self.last_sent.get(pos, 0) < self.min_interval:
+            return False
+        self.last_sent[pos] = now
+        return True
+
+    def line(self, pos, values):
+        return '{0},{1}|{2}'.format(self.table_id, pos, '|'.join(ls_value(values.get(f)) for f in self.fields))
+
+
+class LSSession():
+    '''This is a Lightstreamer session: its tables and the queue of lines for its stream connection.'''
+
+    def __init__(self):
+        self.session_id = uuid.uuid4().hex
+        self.tables = {}
+        self.lines = queue.Queue()
+        self.closed = False
+
+
+class StandIn():
+    '''This is the state of the stand-in: markets, deals, stream sessions and limits.'''
+
+    def __init__(self, epics, tick_rate=5.0, latency=0.0, jitter=0.0, rate_limit=30, allowance=10000,
+                 keepalive=5.0, seed=None, token_lifetime=6 * 3600):
+        self.rng = random.Random(seed)
+        self.epics = epics
+        self.tick_rate = tick_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.allowance = allowance
+        self.allowance_expiry = time.time() + 7 * 86400
+        self.keepalive = keepalive
+        self.token_lifetime = token_lifetime
+        self.tokens = {}
+        self.lock = threading.RLock()
+        self.markets = {}
+        self.sessions = {}
+        self.calls = {}
+        self.positions = {}
+        self.confirms = {}
+        self.cash = 10000.0
+        self.realised = 0.0
+
+    def market(self, epic):
+        with self.lock:
+            if epic not in self.markets:
+                minspread = self.epics.get(epic, {}).get('minspread', 1.0)
+                self.markets[epic] = Market(epic, minspread, self.rng)
+            return self.markets[epic]
+
+    def market_by_id(self, market_id):
+        with self.lock:
+            for market in self.markets.values():
+                if market.market_id == market_id:
+                    return market
+        return None
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+    def allow_call(self, api_key):
+        '''This is to keep a per-minute window of calls for each API key.'''
+        if not self.rate_limit:
+            return True
+        now = time.time()
+        with self.lock:
+            calls = [t for t in self.calls.get(api_key, []) if t > now - 60]
+            allowed = len(calls) < self.rate_limit
+            if allowed:
+                calls.append(now)
+            self.calls[api_key] = calls
+        return allowed
+
+    def new_token(self):
+        '''This is to issue session tokens, valid for token_lifetime seconds after their last use.'''
+        auth = {'CST': uuid.uuid4().hex, 'X-SECURITY-TOKEN': uuid.uuid4().hex}
+        with self.lock:
+            self.tokens[auth['CST']] = time.time() + self.token_lifetime
+        return auth
+
+    def check_token(self, cst):
+        now = time.time()
+        with self.lock:
+            if self.tokens.get(cst, 0) < now:
+                self.tokens.pop(cst, None)
+                return False
+            self.tokens[cst] = now + self.token_lifetime
+        return True
+
+    # Trading
+
+    def account_fields(self):
+        pnl = sum(self.position_pnl(p) for p in self.positions.values())
+        margin = sum(p['size'] * p['level'] * 0.05 for p in self.positions.values())
+        equity = self.cash + self.realised + pnl
+        return {'PNL': round(pnl, 2), 'DEPOSIT': round(margin, 2), 'AVAILABLE_CASH': round(equity - margin, 2),
+                'AVAILABLE_TO_DEAL': round(equity - margin, 2), 'FUNDS': round(self.cash + self.realised, 2),
+                'MARGIN': round(margin, 2), 'EQUITY': round(equity, 2), 'EQUITY_USED': 0}
+
+    def position_pnl(self, position):
+        market = self.market(position['epic'])
+        if position['direction'] == 'BUY':
+            move = market.bid - position['level']
+        else:
+            move = position['level'] - market.offer
+        return move * position['size']
+
+    def _confirm(self, deal_ref, deal_id, epic, deal_status, reason, **extra):
+        confirm = {'dealReference': deal_ref, 'dealId': deal_id, 'epic': epic, 'dealStatus': deal_status,
+                   'reason': reason, 'status': extra.pop('status', 'OPEN' if deal_status == 'ACCEPTED' else None),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        confirm.update(extra)
+        self.confirms[deal_ref] = confirm
+        self.trade_event('CONFIRMS', confirm)
+        return confirm
+
+    def open_position(self, data):
+        epic = data.get('epic')
+        deal_ref = data.get('dealReference') or uuid.uuid4().hex[:15].upper()
+        deal_id = 'DIAAAA' + uuid.uuid4().hex[:10].upper()
+        with self.lock:
+            market = self.market(epic)
+            size = float(data.get('size', 0))
+            direction = data.get('direction')
+            if direction not in ('BUY', 'SELL') or size <= 0:
+                return deal_ref, self._confirm(deal_ref, deal_id, epic, 'REJECTED', 'UNKNOWN')
+            if size < 0.5:
+                return deal_ref, self._confirm(deal_ref, deal_id, epic, 'REJECTED', 'MINIMUM_ORDER_SIZE_ERROR')
+            level = market.offer if direction == 'BUY' else market.bid
+            if size * level * 0.05 > self.account_fields()['AVAILABLE_CASH']:
+                return deal_ref, self._confirm(deal_ref, deal_id, epic, 'REJECTED', 'INSUFFICIENT_FUNDS')
+            sign = 1 if direction == 'BUY' else -1
+            limit = float(data['limitDistance']) if data.get('limitDistance') else None
+            stop = float(data['stopDistance']) if data.get('stopDistance') else None
+            position = {'dealId': deal_id, 'dealReference': deal_ref, 'epic': epic, 'direction': direction,
+                        'size': size, 'level': round(level, 5),
+                        'limitLevel': round(level + sign * limit, 5) if limit else None,
+                        'stopLevel': round(level - sign * stop, 5) if stop else None,
+                        'guaranteedStop': bool(data.get('guaranteedStop')),
+                        'currency': data.get('currencyCode', 'GBP'),
+                        'createdDateUTC': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime())}
+            self.positions[deal_id] = position
+            self.trade_event('OPU', dict(position, status='OPEN', dealStatus='ACCEPTED'))
+            return deal_ref, self._confirm(deal_ref, deal_id, epic, 'ACCEPTED', 'SUCCESS', level=position['level'],
+                                           size=size, direction=direction, limitLevel=position['limitLevel'],
+                                           stopLevel=position['stopLevel'])
+
+    def close_position(self, data, reason='SUCCESS'):
+        deal_ref = uuid.uuid4().hex[:15].upper()
+        with self.lock:
+            position = self.positions.get(data.get('dealId'))
+            if position is None:
+                return deal_ref, self._confirm(deal_ref, data.get('dealId'), None, 'REJECTED', 'POSITION_NOT_FOUND')
+            pnl = self.position_pnl(position)
+            self.realised += pnl
+            del self.positions[position['dealId']]
+            self.trade_event('OPU', dict(position, status='DELETED', dealStatus='ACCEPTED'))
+            return deal_ref, self._confirm(deal_ref, position['dealId'], position['epic'], 'ACCEPTED', reason,
+                                           status='CLOSED', profit=round(pnl, 2), profitCurrency=position['currency'])
+
+    def check_levels(self, market):
+        '''This is to close positions whose stop or limit the price has reached.'''
+        for position in list(self.positions.values()):
+            if position['epic'] != market.epic:
+                continue
+            price = market.bid if position['direction'] == 'BUY' else market.offer
+            sign = 1 if position['direction'] == 'BUY' else -1
+            if position['limitLevel'] is not None and sign * (price - position['limitLevel']) >= 0:
+                self.close_position({'dealId': position['dealId']})
+            elif position['stopLevel'] is not None and sign * (price - position['stopLevel']) <= 0:
+                self.close_position({'dealId': position['dealId']})
+
+    # Streaming
+
+    def trade_event(self, field, payload):
+        self.publish_item('TRADE:' + ACCOUNT_ID, {field: json.dumps(payload)})
+
+    def item_values(self, item, pos, table, now):
+        '''This is to produce the lines for one item of a table, oldest first.'''
+        parts = item.split(':')
+        if parts[0] == 'MARKET' and len(parts) == 2:
+            return [table.line(pos, self.market(parts[1]).market_fields())]
+        if parts[0] == 'CHART' and len(parts) == 3 and parts[2] in CHART_SCALES:
+            market = self.market(parts[1])
+            lines = []
+            if parts[2] in market.completed:
+                lines.append(table.line(pos, market.chart_fields(market.completed[parts[2]], 1)))
+            lines.append(table.line(pos, market.chart_fields(market.bars[parts[2]], 0)))
+            return lines
+        if parts[0] == 'ACCOUNT':
+            return [table.line(pos, self.account_fields())]
+        return []
+
+    def publish_item(self, name, values):
+        with self.lock:
+            for session in self.sessions.values():
+                for table in session.tables.values():
+                    if not set(values).intersection(table.fields):
+                        continue
+                    for pos, item in enumerate(table.items, 1):
+                        if item == name:
+                            session.lines.put(table.line(pos, values))
+
+    def publish(self, now):
+        with self.lock:
+            for session in self.sessions.values():
+                for table in session.tables.values():
+                    for pos, item in enumerate(table.items, 1):
+                        if item.startswith('TRADE:') or not table.due(pos, now):
+                            continue
+                        for line in self.item_values(item, pos, table, now):
+                            session.lines.put(line)
+
+    def run_ticker(self):
+        '''This is to tick every watched market tick_rate times a second.'''
+        interval = 1.0 / self.tick_rate
+        while True:
+            time.sleep(interval)
+            now = time.time()
+            with self.lock:
+                for market in list(self.markets.values()):
+                    market.tick(now)
+                    if self.positions:
+                        self.check_levels(market)
+                self.publish(now)
+
+    def control(self, params):
+        op = params.get('LS_op')
+        with self.lock:
+            session = self.sessions.get(params.get('LS_session'))
+            if session is None:
+                return 'SYNC ERROR'
+            table_id = params.get('LS_table', params.get('LS_Table'))
+            if op == 'add':
+                table = Table(table_id, params.get('LS_mode', 'MERGE'), params.get('LS_id', '').split(),
+                              params.get('LS_schema', '').split(), params.get('LS_requested_max_frequency'),
+                              params.get('LS_snapshot', 'true') != 'false')
+                session.tables[table_id] = table
+                if table.snapshot:
+                    now = time.time()
+                    for pos, item in enumerate(table.items, 1):
+                        table.last_sent[pos] = now
+                        for line in self.item_values(item, pos, table, now)[-1:]:
+                            session.lines.put(line)
+            elif op == 'delete':
+                session.tables.pop(table_id, None)
+            elif op == 'reconf':
+                if table_id in session.tables:
+                    session.tables[table_id].set_frequency(params.get('LS_requested_max_frequency'))
+            elif op == 'destroy':
+                session.closed = True
+                session.lines.put('END')
+            else:
+                return 'ERROR\r\n2\r\nUnknown op'
+        return 'OK'
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''This is to route requests to the stand-in.'''
+
+    server_version = 'StandIn/1.0'
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    @property
+    def standin(self):
+        return self.server.standin
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def _json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._json(status, {'errorCode': code})
+
+    def do_GET(self):
+        self._rest('GET')
+
+    def do_PUT(self):
+        self._rest('PUT')
+
+    def do_DELETE(self):
+        self._rest('DELETE')
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path.startswith('/lightstreamer/'):
+            self._lightstreamer(path)
+        else:
+            self._rest('POST')
+
+    # REST
+
+    def _rest(self, method):
+        path = urlparse(self.path).path
+        path = path[path.index('/gateway/deal') + len('/gateway/deal'):] if '/gateway/deal' in path else path
+        method = self.headers.get('_method', method).upper()
+        body = self._body()
+        self.standin.delay()
+
+        if path == '/session' and method == 'POST':
+            return self._session()
+        if not self.standin.allow_call(self.headers.get('X-IG-API-KEY')):
+            return self._error(403, 'error.public-api.exceeded-api-key-allowance')
+        if not self.headers.get('CST'):
+            return self._error(401, 'error.security.client-token-missing')
+        if not self.standin.check_token(self.headers.get('CST')):
+            return self._error(401, 'error.security.client-token-invalid')
+
+        data = json.loads(body) if body.startswith('{') else {}
+        routes = [
+            ('GET', r'/session$', self._read_session),
+            ('PUT', r'/session$', self._update_session),
+            ('GET', r'/accounts$', self._accounts),
+            ('GET', r'/markets/([^/]+)$', self._markets),
+            ('GET', r'/prices/([^/]+)/([A-Z_0-9]+)/(\d+)$', self._prices),
+            ('GET', r'/prices/([^/]+)$', self._prices_v3),
+            ('GET', r'/clientsentiment/([^/]+)$', self._clientsentiment),
+            ('GET', r'/positions$', self._positions),
+            ('GET', r'/positions/([^/]+)$', self._position),
+            ('POST', r'/positions/otc$', self._positions_otc),
+            ('DELETE', r'/positions/otc$', self._positions_otc_close),
+            ('GET', r'/confirms/([^/]+)$', self._confirms),
+        ]
+        for route_method, pattern, handler in routes:
+            match = re.match(pattern, path)
+            if match and route_method == method:
+                return handler(data, *match.groups())
+        self._error(404, 'error.not-found')
+
+    def _session(self):
+        auth = self.standin.new_token()
+        host = self.headers.get('Host', '{0}:{1}'.format(*self.server.server_address))
+        self._json(200, {'accountType': 'SPREADBET', 'currencyIsoCode': 'GBP', 'currencySymbol': '£',
+                         'currentAccountId': ACCOUNT_ID, 'lightstreamerEndpoint': 'http://' + host,
+                         'accounts': [{'accountId': ACCOUNT_ID, 'accountName': 'Stand-in', 'preferred': True,
+                                       'accountType': 'SPREADBET'}],
+                         'clientId': 'STANDIN', 'timezoneOffset': 0, 'hasActiveDemoAccounts': True,
+                         'hasActiveLiveAccounts': False, 'trailingStopsEnabled': False,
+                         'dealingEnabled': True}, auth)
+
+    def _read_session(self, data):
+        host = self.headers.get('Host', '{0}:{1}'.format(*self.server.server_address))
+        self._json(200, {'clientId': 'STANDIN', 'accountId': ACCOUNT_ID, 'timezoneOffset': 0, 'locale': 'en_GB',
+                         'currency': 'GBP', 'lightstreamerEndpoint': 'http://' + host})
+
+    def _update_session(self, data):
+        self._error(412, 'error.switch.accountId-must-be-different')
+
+    def _accounts(self, data):
+        balance = self.standin.account_fields()
+        self._json(200, {'accounts': [{'accountId': ACCOUNT_ID, 'accountName': 'Stand-in', 'preferred': True,
+                                       'accountType': 'SPREADBET', 'currency': 'GBP', 'status': 'ENABLED',
+                                       'balance': {'balance': balance['FUNDS'], 'deposit': balance['DEPOSIT'],
+                                                   'profitLoss': balance['PNL'],
+                                                   'available': balance['AVAILABLE_CASH']}}]})
+
+    def _markets(self, data, epic):
+        self._json(200, self.standin.market(epic).snapshot())
+
+    def _prices(self, data, epic, resolution, points):
+        points = int(points)
+        if resolution not in RESOLUTIONS:
+            return self._error(400, 'error.invalid.resolution')
+        with self.standin.lock:
+            if self.standin.allowance < points:
+                return self._error(403, 'error.public-api.exceeded-account-historical-data-allowance')
+            self.standin.allowance -= points
+            remaining = self.standin.allowance
+        market = self.standin.market(epic)
+        self._json(200, {'prices': market.history(RESOLUTIONS[resolution], points), 'instrumentType': 'CURRENCIES',
+                         'allowance': {'remainingAllowance': remaining, 'totalAllowance': 10000,
+                                       'allowanceExpiry': int(self.standin.allowance_expiry - time.time())}})
+
+    def _prices_v3(self, data, epic):
+        query = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+        resolution, points = query.get('resolution', 'MINUTE'), int(query.get('max', 10))
+        if resolution not in RESOLUTIONS:
+            return self._error(400, 'error.invalid.resolution')
+        with self.standin.lock:
+            if self.standin.allowance < points:
+                return self._error(403, 'error.public-api.exceeded-account-historical-data-allowance')
+            self.standin.allowance -= points
+            remaining = self.standin.allowance
+        market = self.standin.market(epic)
+        self._json(200, {'prices': market.history(RESOLUTIONS[resolution], points), 'instrumentType': 'CURRENCIES',
+                         'metadata': {'allowance': {'remainingAllowance': remaining, 'totalAllowance': 10000,
+                                                    'allowanceExpiry': int(self.standin.allowance_expiry - time.time())},
+                                      'size': points, 'pageData': {'pageSize': 0, 'pageNumber': 1, 'totalPages': 1}}})
+
+    def _clientsentiment(self, data, market_id):
+        market = self.standin.market_by_id(market_id)
+        long_pct = round(market.long_pct if market else 50.0, 1)
+        self._json(200, {'marketId': market_id, 'longPositionPercentage': long_pct,
+                         'shortPositionPercentage': round(100 - long_pct, 1)})
+
+    def _position_json(self, position):
+        market = self.standin.market(position['epic'])
+        return {'position': dict(position, contractSize=1.0, controlledRisk=position['guaranteedStop']),
+                'market': {'epic': position['epic'], 'instrumentName': position['epic'],
+                           'bid': market.bid, 'offer': market.offer,
+                           'marketStatus': 'TRADEABLE', 'scalingFactor': 1}}
+
+    def _positions(self, data):
+        with self.standin.lock:
+            self._json(200, {'positions': [self._position_json(p) for p in self.standin.positions.values()]})
+
+    def _position(self, data, deal_id):
+        with self.standin.lock:
+            position = self.standin.positions.get(deal_id)
+            if position is None:
+                return self._error(404, 'error.position.notfound')
+            self._json(200, self._position_json(position))
+
+    def _positions_otc(self, data):
+        deal_ref, confirm = self.standin.open_position(data)
+        self._json(200, {'dealReference': deal_ref})
+
+    def _positions_otc_close(self, data):
+        deal_ref, confirm = self.standin.close_position(data)
+        self._json(200, {'dealReference': deal_ref})
+
+    def _confirms(self, data, deal_ref):
+        confirm = self.standin.confirms.get(deal_ref)
+        if confirm is None:
+            return self._error(404, 'error.confirms.deal-not-found')
+        self._json(200, confirm)
+
+    # Lightstreamer
+
+    def _lightstreamer(self, path):
+        params = dict((k, v[0]) for k, v in parse_qs(self._body()).items())
+        self.standin.delay()
+        if path.endswith('/create_session.txt'):
+            session = LSSession()
+            with self.standin.lock:
+                self.standin.sessions[session.session_id] = session
+            self._stream(session)
+        elif path.endswith('/bind_session.txt'):
+            session = self.standin.sessions.get(params.get('LS_session'))
+            if session is None:
+                return self._text('SYNC ERROR\r\n')
+            self._stream(session)
+        elif path.endswith('/control.txt'):
+            self._text(self.standin.control(params) + '\r\n')
+        else:
+            self.send_error(404)
+
+    def _text(self, text):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, session):
+        '''This is to write the session header, then queued updates, until the session or connection ends.'''
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.end_headers()
+        keepalive_ms = int(self.standin.keepalive * 1000)
+        self.wfile.write('OK\r\nSessionId:{0}\r\nKeepaliveMillis:{1}\r\nMaxBandwidth:0.0\r\n\r\n'.format(
+            session.session_id, keepalive_ms).encode('utf-8'))
+        try:
+            while not session.closed:
+                try:
+                    lines = [session.lines.get(timeout=self.standin.keepalive)]
+                except queue.Empty:
+                    lines = ['PROBE']
+                while not session.lines.empty() and len(lines) < 500:
+                    lines.append(session.lines.get_nowait())
+                self.wfile.write(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+                if 'END' in lines:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        with self.standin.lock:
+            self.standin.sessions.pop(session.session_id, None)
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address, standin):
+        HTTPServer.__init__(self, address, Handler)
+        self.standin = standin
+
+
+def read_epics(path):
+    '''This is to read the EPICS table from a config file, if it has one.'''
+    config = configparser.ConfigParser()
+    config.read(path)
+    try:
+        return json.loads(config['Epics']['EPICS'])
+    except KeyError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the IG REST API and Lightstreamer')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--config', default='default.conf', help='file to read [Epics] EPICS from')
+    parser.add_argument('--tick-rate', type=float, default=5.0, help='price ticks per second per market')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many extra seconds per response')
+    parser.add_argument('--rate-limit', type=int, default=30, help='REST calls per minute per API key, 0 for none')
+    parser.add_argument('--allowance', type=int, default=10000, help='historical data points available')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--token-lifetime', type=float, default=6 * 3600,
+                        help='seconds a session token stays valid after its last use')
+    args = parser.parse_args()
+
+    standin = StandIn(read_epics(args.config), tick_rate=args.tick_rate, latency=args.latency, jitter=args.jitter,
+                      rate_limit=args.rate_limit, allowance=args.allowance, seed=args.seed,
+                      token_lifetime=args.token_lifetime)
+    ticker = threading.Thread(target=standin.run_ticker, name='TICKER')
+    ticker.daemon = True
+    ticker.start()
+
+    server = StandInServer((args.host, args.port), standin)
+    logging.info('Stand-in listening on http://{0}:{1}/gateway/deal'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Run the trading decisions over stored bars instead of the live market.
+
+Bars are bid prices, one row per epic and one column per bar, saved with
+save_bars() as a .npz file. At the close of every bar each epic goes through
+what faig.py does live, for all epics and bars at once:
+
+    screen   Price_Change_Day_percent_low < |change on the day| < ..._high,
+             and the spread within max_spread
+    fit      Prediction.linear_regression: close ~ high + low over the last
+             5 bars at 1, 2, 3 and 4 times the bar length and a day (the
+             fetch_lg_prices resolutions for hourly bars), predicting from
+             the day's high and low so far
+    decide   Prediction.determine_trade_direction: limitDistance from the
+             price difference, score and greed, direction from the prediction
+             when the score reaches predict_accuracy, else from sentiment
+
+The bars of each resolution end at the current bar rather than on clock
+multiples, as they would with bars fetched live. Sentiment isn't stored by
+IG, so without a long_pct array use_clientsentiment is treated as off.
+
+Trades are then filled bar by bar, one open position per epic as live: BUY at
+the offer (bid + spread), SELL at the bid, closed at the stop, the limit or
+after exit_max_hold. A stop gapped through fills at the bar's open unless it's
+guaranteed, and both touched in one bar counts as the stop. Distances are
+fitted to the dealing rules of an instrument catalogue when one is given.
+
+    python backtest.py bars.npz [--catalogue instruments.json]
+    python backtest.py --synthetic 90x8760
+"""
+
+import argparse
+import collections
+import json
+import logging
+import time
+
+import numpy as np
+
+from igclient import load_config
+from lib.dealing import CompiledRules, adjust_orders, compile_rules, stack_rules
+from lib.settings import build_settings
+
+# bars per fetch_lg_prices resolution, for hourly bars; DAY is one day's worth of bars
+MULTIPLES = (1, 2, 3, 4)
+POINTS = 5
+
+Bars = collections.namedtuple('Bars', ['epic_ids', 'time', 'open', 'high', 'low', 'close', 'spread', 'long_pct'])
+
+Features = collections.namedtuple('Features', ['change_pct', 'score', 'prediction', 'enough'])
+
+Trades = collections.namedtuple('Trades', ['epic', 'entry_bar', 'exit_bar', 'direction', 'entry', 'exit', 'pnl',
+                                           'reason'])
+
+STOP, LIMIT, TIMEOUT, END = 'STOP', 'LIMIT', 'TIMEOUT', 'END'
+
+
+def save_bars(path, bars):
+    arrays = dict((field, value) for field, value in bars._asdict().items() if value is not None)
+    arrays['epic_ids'] = np.asarray(bars.epic_ids)
+    np.savez_compressed(path, **arrays)
+
+
+def load_bars(path):
+    """
+    :param path: .npz with epic_ids (E), time (T, epoch seconds), open, high, low, close (E x T bid),
+    optionally spread (E, offer - bid in points) and long_pct (E x T, client sentiment)
+    """
+    d = np.load(path)
+    optional = dict((field, d[field] if field in d else None) for field in ('spread', 'long_pct'))
+    return Bars(epic_ids=[str(e) for e in d['epic_ids']], time=d['time'].astype(float),
+                open=d['open'].astype(float), high=d['high'].astype(float), low=d['low'].astype(float),
+                close=d['close'].astype(float), **optional)
+
+
+def synthetic_bars(epics=90, bars=24 * 365, seconds=3600, seed=0):
+    """Random walks, for timing and trying the engine out."""
+    rng = np.random.RandomState(seed)
+    start = 1500000000 // 86400 * 86400
+    level = rng.uniform(50, 20000, size=(epics, 1))
+    steps = rng.normal(0, 0.004, size=(epics, bars * 4)).cumsum(axis=1)
+    ticks = (level * np.exp(steps)).reshape(epics, bars, 4)
+    return Bars(epic_ids=['SYN.{0}'.format(i) for i in range(epics)],
+                time=start + seconds * np.arange(bars, dtype=float),
+                open=ticks[:, :, 0], high=ticks.max(axis=2), low=ticks.min(axis=2), close=ticks[:, :, -1],
+                spread=np.round(level[:, 0] * 0.0002, 1) + 0.5, long_pct=None)
+
+
+def _shift(a, n, fill=np.nan):
+    """a moved n bars later along the last axis."""
+    if n == 0:
+        return a
+    out = np.full(a.shape, fill)
+    out[..., n:] = a[..., :-n]
+    return out
+
+
+def _rolling(a, n, reduce):
+    out = a
+    for i in range(1, n):
+        out = reduce(out, _shift(a, i))
+    return out
+
+
+def _day_running(a, day, reduce):
+    """Running max (reduce=np.maximum) or min of a since the start of each day."""
+    # offsetting each day past the last means accumulate never looks back across a day boundary
+    sign = 1.0 if reduce is np.maximum else -1.0
+    span = np.nanmax(np.abs(a)) * 4 + 1
+    offset = (day - day[0]) * span
+    return sign * (np.maximum.accumulate(sign * a + offset, axis=-1) - offset)
+
+
+def features(bars):
+    """
+    What the decision needs that no [Trade] setting changes, worth computing once for many settings
+    :return: Features of E x T arrays
+    """
+    close, high, low = bars.close, bars.high, bars.low
+    seconds = float(np.median(np.diff(bars.time))) if len(bars.time) > 1 else 3600.0
+    per_day = max(1, int(round(86400 / seconds)))
+    day = np.floor(bars.time / 86400)
+
+    # the change on the day, as CHANGE_PCT, from the previous day's last close
+    new_day = np.r_[True, day[1:] != day[:-1]]
+    last_close = np.where(new_day, _shift(close, 1), np.nan)
+    last_close = _ffill(last_close)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change_pct = (close - last_close) / last_close * 100
+
+    # least squares of close on high and low, from running sums over the POINTS bars of each resolution
+    sums = dict((k, np.zeros(close.shape)) for k in ('n', 'h', 'l', 'y', 'hh', 'll', 'hl', 'hy', 'ly', 'yy'))
+    for multiple in MULTIPLES + (per_day,):
+        h_k = _rolling(high, multiple, np.fmax) if multiple > 1 else high
+        l_k = _rolling(low, multiple, np.fmin) if multiple > 1 else low
+        for point in range(POINTS):
+            # relative to the current close, the fit doesn't care and the sums keep their precision
+            h, l, y = (_shift(a, point * multiple) - close for a in (h_k, l_k, close))
+            sums['n'] += 1
+            sums['h'] += h
+            sums['l'] += l
+            sums['y'] += y
+            sums['hh'] += h * h
+            sums['ll'] += l * l
+            sums['hl'] += h * l
+            sums['hy'] += h * y
+            sums['ly'] += l * y
+            sums['yy'] += y * y
+    n = sums['n']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mh, ml, my = sums['h'] / n, sums['l'] / n, sums['y'] / n
+        shh, sll, shl = sums['hh'] - n * mh * mh, sums['ll'] - n * ml * ml, sums['hl'] - n * mh * ml
+        shy, sly, syy = sums['hy'] - n * mh * my, sums['ly'] - n * ml * my, sums['yy'] - n * my * my
+        det = shh * sll - shl * shl
+        singular = ~(np.abs(det) > 1e-9 * np.abs(shh * sll))
+        # high and low moving together leave one direction to fit, take the minimum norm solution as lstsq does
+        trace_2 = np.where(shh + sll > 0, shh + sll, 1) ** 2
+        a = np.where(singular, (shh * shy + shl * sly) / trace_2, (sll * shy - shl * sly) / det)
+        b = np.where(singular, (shl * shy + sll * sly) / trace_2, (shh * sly - shl * shy) / det)
+        score = np.where(syy > 0, 1 - (syy - a * shy - b * sly) / syy, 1.0)
+
+        day_high = _day_running(high, day, np.maximum)
+        day_low = _day_running(low, day, np.minimum)
+        prediction = close + my + a * (day_high - close - mh) + b * (day_low - close - ml)
+
+    enough = np.arange(close.shape[1]) >= POINTS * max(MULTIPLES + (per_day,)) - 1
+    return Features(change_pct=change_pct, score=score, prediction=prediction,
+                    enough=np.broadcast_to(enough, close.shape))
+
+
+def signals(bars, settings, spread, features_=None):
+    """
+    The live decision at the close of every bar
+    :param features_: features(bars), if already computed
+    :return: direction (E x T, +1 BUY, -1 SELL, 0 none), limit distance
+    """
+    trade = settings.trade
+    f = features_ if features_ is not None else features(bars)
+    close, score, prediction = bars.close, f.score, f.prediction
+    with np.errstate(invalid='ignore'):
+        # epics missing from [Epics] take the stored spread as their minspread
+        minspread = spread * trade.spread_multiplier * -1
+        max_spread = np.array([settings.max_spread_for(e) if e in settings.epic_index else
+                               (trade.max_spread if trade.use_max_spread else minspread[i])
+                               for i, e in enumerate(bars.epic_ids)])
+        change = np.abs(f.change_pct)
+        screened = (trade.Price_Change_Day_percent_low < change) & (change < trade.Price_Change_Day_percent_high) & \
+                   ((-spread) > max_spread)[:, None]
+        limit = np.abs(np.round((close - prediction) * score * trade.greed, 1))
+        by_prediction = np.sign(prediction - close)
+
+        if trade.use_clientsentiment and bars.long_pct is not None:
+            long_pct = bars.long_pct
+            short_pct = 100 - long_pct
+            sentiment = np.select([(short_pct > long_pct) & (short_pct >= trade.clientsentiment_value),
+                                   (long_pct > short_pct) & (long_pct >= trade.clientsentiment_value),
+                                   short_pct >= trade.hightrend_watermark,
+                                   long_pct >= trade.hightrend_watermark], [-1, 1, -1, 1], 0)
+            contrarian = -1 if trade.clientsentiment_contrarian else 1
+            # quick_check turns down epics sentiment gives no direction for before anything is fitted
+            direction = np.where(sentiment == 0, 0,
+                                 np.where(score >= trade.predict_accuracy, by_prediction, sentiment * contrarian))
+        else:
+            direction = np.where(score >= trade.predict_accuracy, by_prediction, 0)
+
+        valid = screened & f.enough & (limit > 0) & np.isfinite(prediction)
+    return np.where(valid, direction, 0).astype(int), limit
+
+
+def _ffill(a):
+    """Carry the last non-nan value forward along the last axis."""
+    index = np.where(np.isnan(a), 0, np.arange(a.shape[-1]))
+    np.maximum.accumulate(index, axis=-1, out=index)
+    return a[np.arange(a.shape[0])[:, None], index]
+
+
+def _rules_for(epic_ids, catalogue):
+    """CompiledRules stacked per epic, rules the catalogue doesn't have don't apply."""
+    instruments = {}
+    if catalogue:
+        with open(catalogue) as f:
+            instruments = json.load(f).get('instruments', {})
+    return stack_rules([compile_rules((instruments.get(e) or {}).get('dealingRules') or {}) for e in epic_ids])
+
+
+def _fill(bars, spread, epics, entry_bar, sign, stop, limit, guaranteed, max_bars):
+    """
+    Where each new position closes
+    :return: exit bar, exit price, entry price, reason
+    """
+    n_bars = bars.close.shape[1]
+    entry = bars.close[epics, entry_bar] + np.where(sign > 0, spread[epics], 0)
+    stop_level = entry - sign * stop
+    limit_level = entry + sign * limit
+    horizon = max_bars if max_bars else n_bars
+    exit_bar = np.full(len(epics), -1)
+    exit_price = np.full(len(epics), np.nan)
+    reason = np.full(len(epics), END, dtype=object)
+
+    # look ahead a chunk of bars at a time, most positions close within the first
+    pending = np.arange(len(epics))
+    start = 1
+    chunk = 256
+    while len(pending) and start <= horizon:
+        steps = np.arange(start, min(start + chunk, horizon + 1))
+        bar = entry_bar[pending, None] + steps
+        inside = bar < n_bars
+        bar = np.minimum(bar, n_bars - 1)
+        e = epics[pending, None]
+        s = sign[pending, None]
+        # a long closes at the bid, a short at the offer
+        quote = np.where(s > 0, 0, spread[e])
+        b_open, b_high, b_low = bars.open[e, bar] + quote, bars.high[e, bar] + quote, bars.low[e, bar] + quote
+        against = np.where(s > 0, b_low, b_high)
+        toward = np.where(s > 0, b_high, b_low)
+        with np.errstate(invalid='ignore'):
+            hit_stop = inside & ~np.isnan(stop_level[pending, None]) & (s * (against - stop_level[pending, None]) <= 0)
+            hit_limit = inside & ~np.isnan(limit_level[pending, None]) & \
+                        (s * (toward - limit_level[pending, None]) >= 0)
+        hit = hit_stop | hit_limit
+        first = np.argmax(hit, axis=1)
+        done = hit[np.arange(len(pending)), first]
+        rows = pending[done]
+        f = first[done]
+        at = bar[done, f]
+        stopped = hit_stop[done, f]
+        gap = s[done, 0] * (b_open[done, f] - stop_level[rows]) < 0
+        stop_fill = np.where(guaranteed[rows] | ~gap, stop_level[rows], b_open[done, f])
+        exit_bar[rows] = at
+        exit_price[rows] = np.where(stopped, stop_fill, limit_level[rows])
+        reason[rows] = np.where(stopped, STOP, LIMIT)
+        # out of data, or out of time
+        last = ~done & ~inside[:, -1]
+        ended = ~done & ((steps[-1] >= horizon) | last)
+        rows = pending[ended]
+        at = np.minimum(entry_bar[rows] + horizon, n_bars - 1)
+        exit_bar[rows] = at
+        exit_price[rows] = bars.close[epics[rows], at] + np.where(sign[rows] > 0, 0, spread[epics[rows]])
+        reason[rows] = np.where(entry_bar[rows] + horizon < n_bars, TIMEOUT, END)
+        pending = pending[~done & ~ended]
+        start += chunk
+    return exit_bar, exit_price, entry, reason
+
+
+def run(bars, settings, catalogue=None, guaranteed_premium=0.0, features_=None, rules=None):
+    """
+    :param settings: lib.settings.Settings, as the bot would run with
+    :param catalogue: instruments.json whose dealing rules the orders are fitted to
+    :param features_: features(bars), if already computed
+    :param rules: stacked CompiledRules per epic, instead of reading catalogue
+    :param guaranteed_premium: points charged per unit size for a guaranteed stop
+    :return: Trades, in the order they opened
+    """
+    trade = settings.trade
+    n_epics, n_bars = bars.close.shape
+    if bars.spread is not None:
+        spread = np.asarray(bars.spread, dtype=float)
+    else:
+        spread = np.array([settings.minspread[settings.epic_index[e]] if e in settings.epic_index else 0.0
+                           for e in bars.epic_ids])
+    direction, limit_distance = signals(bars, settings, spread, features_)
+    if rules is None:
+        rules = _rules_for(bars.epic_ids, catalogue)
+    # handleDealingRules only warns, but IG turns down every market order on these
+    direction[~rules.market_orders] = 0
+    guaranteed_all = bool(trade.always_guarantee_stops and not trade.never_guarantee_stops)
+    seconds = float(np.median(np.diff(bars.time))) if n_bars > 1 else 3600.0
+    max_bars = int(np.ceil(trade.exit_max_hold / seconds)) if trade.exit_max_hold > 0 else 0
+
+    # the next bar with a signal at or after each bar, n_bars for none
+    signal_bar = np.where(direction != 0, np.arange(n_bars), n_bars)
+    next_signal = np.minimum.accumulate(signal_bar[:, ::-1], axis=1)[:, ::-1]
+    next_signal = np.concatenate([next_signal, np.full((n_epics, 1), n_bars)], axis=1)
+
+    opened = []
+    free = np.zeros(n_epics, dtype=int)  # the first bar each epic can open a position on
+    while True:
+        entry_bar = next_signal[np.arange(n_epics), np.minimum(free, n_bars)]
+        epics = np.flatnonzero(entry_bar < n_bars)
+        if not len(epics):
+            break
+        entry_bar = entry_bar[epics]
+        sign = direction[epics, entry_bar]
+        price = bars.close[epics, entry_bar]
+        guaranteed = np.full(len(epics), guaranteed_all)
+        epic_rules = CompiledRules(rules.values[epics], rules.percent[epics], rules.market_orders[epics],
+                                   rules.trailing_stops[epics])
+        size, stop, limit = adjust_orders(epic_rules, price, np.full(len(epics), trade.size),
+                                          np.full(len(epics), trade.stopDistance_value),
+                                          limit_distance[epics, entry_bar], guaranteed)
+        exit_bar, exit_price, entry, reason = _fill(bars, spread, epics, entry_bar, sign, stop, limit,
+                                                    guaranteed, max_bars)
+        pnl = sign * (exit_price - entry) * size - np.where(guaranteed, guaranteed_premium * size, 0)
+        opened.append((epics, entry_bar, exit_bar, sign, entry, exit_price, pnl, reason))
+        # one position per epic, the next can open once this one has closed
+        waiting = np.full(n_epics, n_bars)
+        waiting[epics] = exit_bar + 1
+        free = waiting
+
+    if not opened:
+        return Trades(*[np.empty(0)] * len(Trades._fields))
+    columns = [np.concatenate(column) for column in zip(*opened)]
+    order = np.lexsort((columns[0], columns[1]))
+    return Trades(*[column[order] for column in columns])
+
+
+def summary(trades, bars):
+    """P&L, hit rate and drawdown, with drawdown measured on P&L booked in exit order."""
+    pnl = np.asarray(trades.pnl, dtype=float)
+    equity = np.cumsum(pnl[np.argsort(trades.exit_bar, kind='mergesort')])
+    drawdown = float(np.max(np.maximum.accumulate(np.r_[0, equity]) - np.r_[0, equity])) if len(pnl) else 0.0
+    per_epic = collections.OrderedDict()
+    for i, epic_id in enumerate(bars.epic_ids):
+        mine = trades.epic == i
+        if mine.any():
+            per_epic[epic_id] = {'trades': int(mine.sum()), 'pnl': round(float(pnl[mine].sum()), 2)}
+    return collections.OrderedDict([
+        ('trades', len(pnl)),
+        ('pnl', round(float(pnl.sum()), 2)),
+        ('hit_rate', round(float((pnl > 0).mean()), 4) if len(pnl) else None),
+        ('max_drawdown', round(drawdown, 2)),
+        ('exits', dict(collections.Counter(str(r) for r in trades.reason))),
+        ('per_epic', per_epic)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest the trading decisions over stored bars')
+    parser.add_argument('path', nargs='?', help='.npz of bars, see save_bars')
+    parser.add_argument('--synthetic', metavar='EPICSxBARS', help='random walk bars instead, e.g. 90x8760')
+    parser.add_argument('--catalogue', help='instruments.json to fit orders to the dealing rules of')
+    parser.add_argument('--guaranteed-premium', type=float, default=0.0)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.synthetic:
+        epics, n = (int(v) for v in args.synthetic.lower().split('x'))
+        bars = synthetic_bars(epics, n)
+    elif args.path:
+        bars = load_bars(args.path)
+    else:
+        parser.error('give a .npz of bars or --synthetic')
+
+    settings = build_settings(load_config())
+    start = time.monotonic()
+    trades = run(bars, settings, catalogue=args.catalogue, guaranteed_premium=args.guaranteed_premium)
+    elapsed = time.monotonic() - start
+    result = summary(trades, bars)
+    if args.json:
+        print(json.dumps(dict(result, seconds=round(elapsed, 3))))
+        return
+    print("{0} epics x {1} bars in {2:.2f}s".format(len(bars.epic_ids), len(bars.time), elapsed))
+    print("trades {trades}  pnl {pnl}  hit rate {hit_rate}  max drawdown {max_drawdown}".format(**result))
+    print("exits {0}".format(result['exits']))
+
+
+if __name__ == '__main__':
+    main()
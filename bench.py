@@ -0,0 +1,359 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Offline benchmarks of the hot paths, with baselines to compare against.
+
+    notifyupdate      Subscription.notifyupdate, updates/s
+    forward_update    LSClient._forward_update_message, updates/s
+    tickdb_add        TickDB.add_tick with its aggregation every agg_size ticks, ticks/s
+    tickdb_aggregate  TickDB.aggregate_ticks, ticks/s
+    screener_update   Screener.on_update over every epic, updates/s
+    screener_scan     Screener.scan of every epic at once, scans/s
+    linear_regression Prediction.linear_regression, fits/s
+    trackcall         a trackcall'd method doing nothing, calls/s (overhead_us is what trackcall adds)
+
+Stream updates are a synthetic MERGE feed of --epics MARKET items, or the
+busiest table of a recording made with STREAM_RECORD_FILE (see igreplay.py).
+Each benchmark reports its best of --repeat runs:
+
+    python bench.py --out baseline.json
+    python bench.py --recording session.lsrec.gz --out after.json
+    python bench.py --compare baseline.json after.json --threshold 0.1
+
+--compare with one file runs the benchmarks now and compares them with it.
+A benchmark that got slower by more than --threshold is a regression, and
+the exit status is 1 if there are any.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import platform
+import sys
+import threading
+import time
+
+import numpy as np
+
+import igstream
+from igclient import load_config, trackcall
+from igreplay import SUBSCRIPTION_TAG, read_recording
+from lib.latency import TRACKER
+from lib.prediction import Prediction
+from lib.screener import Screener
+from lib.settings import build_settings
+
+SCREEN_FIELDS = ["MID_OPEN", "HIGH", "LOW", "CHANGE", "CHANGE_PCT", "UPDATE_TIME", "MARKET_DELAY", "MARKET_STATE",
+                 "BID", "OFFER"]
+
+Feed = collections.namedtuple('Feed', ['items', 'fields', 'lines'])
+
+
+def synthetic_feed(epics=90, updates=20000, seed=0):
+    """MERGE updates as the server sends them: unchanged fields empty, random walk prices."""
+    rng = np.random.RandomState(seed)
+    items = ['MARKET:CS.D.BENCH{0:03d}.TODAY.IP'.format(i) for i in range(epics)]
+    mid = rng.uniform(0.5, 20000, epics)
+    day_open = mid.copy()
+    spread = np.maximum(mid * 0.0002, 0.0001)
+    lines = []
+    for i in range(epics):
+        lines.append('{0}|{1:.5f}|{2:.5f}|{3:.5f}|0|0|08:00:00|0|TRADEABLE|{4:.5f}|{5:.5f}'.format(
+            i + 1, day_open[i], mid[i], mid[i], mid[i] - spread[i] / 2, mid[i] + spread[i] / 2))
+    rows = rng.randint(0, epics, updates - epics)
+    steps = rng.standard_normal(updates - epics) * 0.0005
+    for n, (i, step) in enumerate(zip(rows, steps)):
+        mid[i] *= 1 + step
+        change = mid[i] - day_open[i]
+        seconds = 8 * 3600 + n // 100
+        lines.append('{0}||||{1:.5f}|{2:.3f}|{3:02d}:{4:02d}:{5:02d}|||{6:.5f}|{7:.5f}'.format(
+            i + 1, change, change / day_open[i] * 100, seconds // 3600, seconds // 60 % 60, seconds % 60,
+            mid[i] - spread[i] / 2, mid[i] + spread[i] / 2))
+    return Feed(items, SCREEN_FIELDS, lines)
+
+
+def recorded_feed(path):
+    """The updates of the recording's busiest table."""
+    tables, lines = {}, collections.defaultdict(list)
+    for _, text in read_recording(path):
+        if text.startswith(SUBSCRIPTION_TAG):
+            table = json.loads(text[len(SUBSCRIPTION_TAG):])
+            tables[table['table']] = table
+            continue
+        table, sep, item = text.partition(',')
+        if sep and table.isdigit() and '|' in item:
+            lines[int(table)].append(item)
+    busiest = max((key for key in lines if key in tables), key=lambda key: len(lines[key]))
+    return Feed(tables[busiest]['items'], tables[busiest]['fields'], lines[busiest])
+
+
+def _item_infos(feed):
+    subscription = igstream.Subscription('MERGE', feed.items, feed.fields)
+    infos = []
+    subscription.addlistener(infos.append)
+    for line in feed.lines:
+        subscription.notifyupdate(line)
+    return infos
+
+
+# each benchmark takes the feed and returns (operations per run, run, unit)
+
+def bench_notifyupdate(feed, scale):
+    subscription = igstream.Subscription('MERGE', feed.items, feed.fields)
+    subscription.addlistener(lambda item_info: None)
+    lines = feed.lines
+
+    def run():
+        for line in lines:
+            subscription.notifyupdate(line)
+    return len(lines), run, 'updates'
+
+
+def bench_forward_update(feed, scale):
+    client = igstream.LSClient('http://bench/')
+    subscription = igstream.Subscription('MERGE', feed.items, feed.fields)
+    subscription.addlistener(lambda item_info: None)
+    client._subscriptions[1] = subscription
+    messages = ['1,' + line for line in feed.lines]
+
+    def run():
+        received = time.monotonic()
+        for message in messages:
+            client._forward_update_message(message, received)
+    return len(messages), run, 'updates'
+
+
+def _ticks(feed, n):
+    ticks, now = [], time.time()
+    for i, info in enumerate(_item_infos(feed)[:n]):
+        values = info['values']
+        if values.get('BID') and values.get('OFFER'):
+            ticks.append({'timestamp': int(now) - 60 + i // 100, 'epic_id': info['name'].split(':', 1)[1],
+                          'bid': float(values['BID']), 'offer': float(values['OFFER'])})
+    return ticks
+
+
+def bench_tickdb_add(feed, scale):
+    from lib.ticks import TickDB
+    ticks = _ticks(feed, int(1000 * scale))
+
+    def run():
+        db = TickDB()
+        for tick in ticks:
+            db.add_tick(dict(tick))
+    return len(ticks), run, 'ticks'
+
+
+def bench_tickdb_aggregate(feed, scale):
+    import pandas as pd
+    from lib.ticks import TickDB
+    ticks = pd.DataFrame(_ticks(feed, int(2000 * scale)))
+    db = TickDB()
+
+    def run():
+        db.aggregate_ticks(ticks)
+    return len(ticks), run, 'ticks'
+
+
+def _screener(feed):
+    epic_ids = [item.split(':', 1)[1] for item in feed.items]
+    return Screener(epic_ids, change_high=1.9, change_low=0.2, max_spreads=[-2.0] * len(epic_ids), cooldown=0)
+
+
+def bench_screener_update(feed, scale):
+    infos = _item_infos(feed)
+
+    def run():
+        screener = _screener(feed)
+        for info in infos:
+            screener.on_update(info)
+    return len(infos), run, 'updates'
+
+
+def bench_screener_scan(feed, scale):
+    screener = _screener(feed)
+    for info in _item_infos(feed):
+        screener.on_update(info)
+    n = int(1000 * scale)
+
+    def run():
+        for _ in range(n):
+            screener.queued[:] = False
+            screener.scan()
+        while not screener.candidates.empty():
+            screener.candidates.get_nowait()
+    return n, run, 'scans'
+
+
+def bench_linear_regression(feed, scale):
+    settings = build_settings(load_config())
+    rng = np.random.RandomState(0)
+    fits = []
+    for _ in range(int(50 * scale)):
+        close = 100 + np.cumsum(rng.standard_normal(25))
+        x = np.column_stack([close + rng.uniform(0, 1, 25), close - rng.uniform(0, 1, 25)]).tolist()
+        fits.append((x, close.tolist(), x[-1][0], x[-1][1]))
+
+    def run():
+        for x, y, high, low in fits:
+            prediction = Prediction(settings)
+            prediction.epic_id = 'CS.D.BENCH.TODAY.IP'
+            prediction.current_price = y[-1]
+            prediction.linear_regression(x=x, y=y, high_price=high, low_price=low)
+    return len(fits), run, 'fits'
+
+
+class _Client(object):
+    # just what trackcall needs of an IGClient
+    def __init__(self):
+        self.recent_calls = []
+        self.recent_calls_lock = threading.Lock()
+        self.rate_limiter = None
+        self.auth = {}
+        self.session_manager = None
+
+    def plain(self):
+        # kept under the 30 a minute trackcall would sleep at
+        del self.recent_calls[:]
+
+    tracked = trackcall(plain)
+
+
+def bench_trackcall(feed, scale):
+    client = _Client()
+    n = int(20000 * scale)
+
+    def run():
+        for _ in range(n):
+            client.tracked()
+    return n, run, 'calls'
+
+
+BENCHMARKS = collections.OrderedDict([
+    ('notifyupdate', bench_notifyupdate),
+    ('forward_update', bench_forward_update),
+    ('tickdb_add', bench_tickdb_add),
+    ('tickdb_aggregate', bench_tickdb_aggregate),
+    ('screener_update', bench_screener_update),
+    ('screener_scan', bench_screener_scan),
+    ('linear_regression', bench_linear_regression),
+    ('trackcall', bench_trackcall),
+])
+
+
+def measure(run, repeat):
+    """:return: seconds of the fastest of repeat runs, after one to warm up"""
+    run()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_benchmarks(feed, names=None, repeat=5, scale=1.0):
+    """:return: {'meta': ..., 'results': {name: {...}}}, a benchmark that fails has an 'error' instead"""
+    logger = logging.getLogger('bench')
+    # the feed's stamps are from whenever, not late
+    TRACKER.lag_alert = 0
+    results = collections.OrderedDict()
+    for name, bench in BENCHMARKS.items():
+        if names and name not in names:
+            continue
+        try:
+            ops, run, unit = bench(feed, scale)
+            seconds = measure(run, repeat)
+        except Exception as e:
+            logger.warning('bench.py {0}: {1!r}'.format(name, e))
+            results[name] = {'error': repr(e)}
+            continue
+        results[name] = {'ops': ops, 'unit': unit, 'seconds': seconds, 'ops_per_sec': ops / seconds,
+                         'us_per_op': seconds / ops * 1e6}
+        logger.info('bench.py {0}: {1:,.0f} {2}/s'.format(name, ops / seconds, unit))
+    if 'trackcall' in results and 'error' not in results['trackcall']:
+        client = _Client()
+        n = results['trackcall']['ops']
+        plain = measure(lambda: [client.plain() for _ in range(n)], repeat)
+        results['trackcall']['overhead_us'] = (results['trackcall']['seconds'] - plain) / n * 1e6
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                     'numpy': np.__version__, 'machine': platform.machine(), 'node': platform.node(),
+                     'cpus': os.cpu_count(), 'items': len(feed.items), 'updates': len(feed.lines),
+                     'repeat': repeat, 'scale': scale},
+            'results': results}
+
+
+def compare(base, new, threshold=0.1):
+    """
+    :return: list of (name, base ops/s, new ops/s, change, regressed), change as a fraction of base
+    """
+    rows = []
+    for name, b in base['results'].items():
+        n = new['results'].get(name)
+        if n is None or 'error' in b or 'error' in n:
+            continue
+        change = n['ops_per_sec'] / b['ops_per_sec'] - 1
+        rows.append((name, b['ops_per_sec'], n['ops_per_sec'], change, change < -threshold))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stream, screener, tick store and prediction')
+    parser.add_argument('--recording', help='igreplay recording to take updates from, instead of synthetic ones')
+    parser.add_argument('--epics', type=int, default=90, help='synthetic MARKET items')
+    parser.add_argument('--updates', type=int, default=20000, help='synthetic updates')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), help='run just these')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the work of the fixed size benchmarks')
+    parser.add_argument('--out', help='write results here as JSON')
+    parser.add_argument('--compare', nargs='+', metavar='JSON', help='BASE [NEW], NEW defaults to running now')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown that counts as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(name)-12s: %(levelname)-8s %(message)s')
+    # the events of the code under test aren't the benchmarks' output
+    logging.getLogger('events').setLevel(logging.WARNING)
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes BASE and at most one NEW')
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1]) as f:
+            results = json.load(f)
+    else:
+        feed = recorded_feed(args.recording) if args.recording else synthetic_feed(args.epics, args.updates)
+        results = run_benchmarks(feed, args.only, args.repeat, args.scale)
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    if not args.compare:
+        for name, r in results['results'].items():
+            if 'error' in r:
+                print('{0:<18} {1}'.format(name, r['error']))
+            else:
+                print('{0:<18} {1:>14,.0f} {2}/s {3:>10.2f} us'.format(name, r['ops_per_sec'], r['unit'],
+                                                                       r['us_per_op']))
+        return
+
+    with open(args.compare[0]) as f:
+        base = json.load(f)
+    rows = compare(base, results, args.threshold)
+    for name, b, n, change, regressed in rows:
+        print('{0:<18} {1:>14,.0f} {2:>14,.0f} {3:>+8.1%} {4}'.format(name, b, n, change,
+                                                                      'REGRESSION' if regressed else ''))
+    if any(regressed for *_, regressed in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,50 +4,21 @@
 # -*- coding: utf-8 -*-
 import sys
 from ig import API
-from lib.prediction import Prediction
+from igclient import load_config
+from lib.logs import setup_from_config
+from lib.pipeline import TradePipeline, ALGORITHMS
 
-import logging
-
-# Setup logging
-LOG_FILENAME = 'logfile.txt'
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                    datefmt='%y-%m-%d %H:%M:%S',
-                    filename=LOG_FILENAME,
-                    filemode='w')
-
-# Setup simple logging to console @ INFO
-console = logging.StreamHandler()
-# console.setLevel(logging.INFO)
-console.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
+# Setup logging, to LOG_FILE and the console at the [Config] LOG_LEVEL and LOG_CONSOLE_LEVEL,
+# written on a thread of its own so the stream and trading threads never wait on it
+setup_from_config(load_config())
 
 api = API()
- 
-while(True):
-    d = api.find_next_trade()
-
-    epic_id = d['values']['EPIC']
-
-    prediction = Prediction(api.config)
-    prediction.epic_id = epic_id
-    prediction.current_price = float(d['values']['BID'])
-    prediction.set_marketdata( api.clientsentiment(epic_id) )
-    if prediction.quick_check() is None: # no point pulling in market data (right now), we'll reject this later on anyway
-        continue # find a different trade
-   
-    if api.config['Trade']['algorithm'] == 'LinearRegression':
-        (x, y) = api.fetch_lg_prices(epic_id)
-        (high_price, low_price) = api.fetch_lg_highlow(epic_id)
-
-        prediction.linear_regression(x=x, y=y, high_price=high_price, low_price=low_price)
-    else:
-        sys.exit('Trading Algorithm: {} not found'.format(api.config['Trade']['algorithm']))
 
-    if prediction.direction_to_trade is None:
-        print ("!!DEBUG!! Literally NO decent trade direction could be determined")
-        continue
+if api.settings.trade.algorithm not in ALGORITHMS:
+    sys.exit('Trading Algorithm: {} not found'.format(api.settings.trade.algorithm))
 
-    api.placeOrder(prediction)
-    continue
+# screen, enrich, predict and place orders concurrently, see lib/pipeline.py
+pipeline = TradePipeline(api,
+                         workers=api.config['Config'].getint('PIPELINE_WORKERS', fallback=4),
+                         queue_size=api.config['Config'].getint('PIPELINE_QUEUE_SIZE', fallback=8))
+pipeline.run()
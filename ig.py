@@ -10,42 +10,207 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-from igclient import IGClient
+from igclient import IGClient, CONFIG_FILES, load_config
+from igsession import SessionManager
 import igstream
+from lib.account import AccountMirror, margin_needed, pretrade_check
+from lib.bus import BusReader
+from lib.allowance import AllowancePlanner
+from lib.candles import SCALES, CandleBuilder
+from lib.catalogue import InstrumentCatalogue
+from lib.dealing import DealingRulesBook, adjust_order
+from lib.history import PriceHistory, RESOLUTION_SECONDS, parse_resolution
+from lib.latency import TRACKER
+from lib.logs import Sampler, event
+from lib.monitor import PositionMonitor
+from lib.paper import PaperBroker
+from lib.profiler import MetricsExporter, enable as enable_profiler, span, timed
+from lib.ratelimit import HISTORY
+from lib.screener import Screener
+from lib.settings import SettingsWatcher, build_settings
 import time as systime
-import json
+from concurrent.futures import ThreadPoolExecutor
 
+import functools
 import random
+import threading
 
 import logging
 
 
+_sample_updates = Sampler(interval=1.0)
+
+
 def on_item_update(item_update):
-    print(item_update)
+    # a tick per item per second is plenty on the console
+    if _sample_updates(item_update['name']):
+        event('update', '{item_update}', item_update=item_update)
 
 
 class API(IGClient):
     def __init__(self):
         super().__init__()
-        d = super().session()
         self.logger = logging.getLogger('API')
         self.logger.debug('ig.py API __init__')
 
-        self.igstreamclient = igstream.IGStream(igclient=self, loginresponse=d)
+        # time each stage of the loop and every API call, for Prometheus
+        self.metrics = None
+        metrics_file = self.config['Config'].get('METRICS_FILE', fallback='')
+        metrics_port = self.config['Config'].getint('METRICS_PORT', fallback=0)
+        if metrics_file or metrics_port:
+            enable_profiler()
+            self.metrics = MetricsExporter(path=metrics_file or None, port=metrics_port,
+                                           interval=self.config['Config'].getint('METRICS_INTERVAL', fallback=15))
+            self.metrics.start()
+
+        # warn when the stream falls behind
+        TRACKER.lag_alert = self.config['Config'].getfloat('STREAM_LAG_ALERT', fallback=5)
+        TRACKER.backlog_alert = self.config['Config'].getfloat('STREAM_BACKLOG_ALERT', fallback=0.8)
+
+        # a first sighting is on the order path, the background refresh can wait behind history fetches
+        self.catalogue = InstrumentCatalogue(self.config['Config'].get('INSTRUMENT_CATALOGUE', fallback=''),
+                                             fetch=super().markets,
+                                             refresh_fetch=functools.partial(super().markets, priority=HISTORY),
+                                             max_age=self.config['Config'].getint('INSTRUMENT_MAX_AGE',
+                                                                                  fallback=86400))
+        self.dealing_rules = DealingRulesBook(self.catalogue.get)
+
+        # trade on paper against the live prices, positions and orders never reach the account
+        self.paper = None
+        if self.config['Config'].getboolean('PAPER_TRADING', fallback=False):
+            self.paper = PaperBroker(quote=self.quote, subscribe=self.subscribe_prices,
+                                     unsubscribe=self.unsubscribe_prices, instrument=self.catalogue.get,
+                                     balance=self.config['Config'].getfloat('PAPER_BALANCE', fallback=10000))
+
+        # prices from marketbus.py, shared with the other processes on this host, when it's running
+        self.bus = None
+        bus_path = self.config['Config'].get('MARKET_BUS', fallback='')
+        if bus_path:
+            try:
+                self.bus = BusReader(bus_path)
+            except (IOError, OSError, ValueError) as e:
+                self.logger.warning('ig.py API: no market bus at {0}, streaming prices ourselves: {1}'.format(
+                    bus_path, e))
+
+        # historical prices are rationed, keep what we fetch and spend the rest evenly
+        self.history = PriceHistory()
+        self.candles = CandleBuilder(self.history)
+        self.planner = AllowancePlanner(
+            reserve=self.config['Config'].getint('HISTORY_ALLOWANCE_RESERVE', fallback=500))
+
+        # reuse the last run's session while it's valid, and keep it alive from here on
+        self.session_manager = SessionManager(self, self.config['Config'].get('SESSION_FILE', fallback='') or None)
+        d = self.session_manager.login()
+
+        # the stream only needs the session tokens, so connect it while the account is picked;
+        # positions are per account, so they wait for the switch
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            if self.accountId is None:
+                account = pool.submit(super().select_account)
+            stream = pool.submit(self.connect_stream, d)
+            if self.accountId is None:
+                account.result()
+            positions = pool.submit(self.positions)
+            stream.result()
+            self.open_positions = positions.result()
+        self.session_manager.save()
+        self.session_manager.start()
 
         subscription = igstream.Subscription(
             mode="DISTINCT",
             items=["TRADE:" + str(self.accountId)],
             fields=["OPU"])
 
+        # price the open positions off the stream and close them on our own exit rules
+        trade = self.settings.trade
+        self.position_monitor = PositionMonitor(close=self.positions_otc_close, subscribe=self.subscribe_prices,
+                                                unsubscribe=self.unsubscribe_prices,
+                                                trailing_stop=trade.exit_trailing_stop, max_hold=trade.exit_max_hold,
+                                                target_pnl=trade.exit_target_pnl)
+        self.position_monitor.load(self.open_positions)
+        if self.paper is not None:
+            self.paper.listeners.append(self.position_monitor.on_trade)
+        else:
+            subscription.addlistener(self.position_monitor.on_trade)
+
         self.igstreamclient.subscribe(subscription=subscription, listener=on_item_update)
-        self.market_ids = {}
 
-        self.ls_subscriptions = {}  #
+        # balance and margin as they change, so orders we can't afford never reach the API
+        self.account = AccountMirror()
+        self.igstreamclient.subscribe(subscription=self.account.subscription(self.accountId),
+                                      listener=self.account.on_update)
 
-        # get open positions
-        self.open_positions = super().positions()
+        self.ls_subscriptions = {}  #
+        self.price_subscriptions = {}  # epic_id -> (sub_key, Subscription) of subscribe_prices
+        self.price_subscriptions_lock = threading.Lock()
+        self.position_monitor.start()
+
+        self.screener = None
+        self.screener_sub_key = None
+        self.screener_follower = None
+        self.candles_sub_keys = []
+        self.streams_lock = threading.RLock()
+        with self.streams_lock:
+            self.start_screener()
+            self.start_candles()
+
+        # fill in epics the catalogue hasn't seen, or saw long ago, while we wait for trades
+        self.catalogue.refresh(self.settings.epic_ids)
+        self.catalogue.start()
+
+        # hot reload [Trade] and [Epics] when a config file changes
+        self.settings_watcher = SettingsWatcher(lambda: build_settings(load_config()), CONFIG_FILES,
+                                                interval=self.config['Config'].getint('CONFIG_RELOAD_INTERVAL',
+                                                                                      fallback=0))
+        self.settings_watcher.listeners.append(self.on_settings_reload)
+        self.settings_watcher.start()
+
+    def connect_stream(self, d):
+        """
+        Open the Lightstreamer connection(s) configured in [Config]
+        :param d: login response
+        """
+        self.logger.debug('ig.py API connect_stream')
+        items_per_session = self.config['Config'].getint('STREAM_ITEMS_PER_SESSION', fallback=0)
+        dispatch_queue_size = self.config['Config'].getint('STREAM_DISPATCH_QUEUE', fallback=0)
+        record_path = self.config['Config'].get('STREAM_RECORD_FILE', fallback='')
+        if items_per_session > 0:
+            self.igstreamclient = igstream.ShardedIGStream(
+                igclient=self, loginresponse=d, items_per_session=items_per_session,
+                max_sessions=self.config['Config'].getint('STREAM_MAX_SESSIONS', fallback=4),
+                dispatch_queue_size=dispatch_queue_size, record_path=record_path)
+        else:
+            self.igstreamclient = igstream.IGStream(igclient=self, loginresponse=d,
+                                                    dispatch_queue_size=dispatch_queue_size,
+                                                    record_path=record_path)
+        return self.igstreamclient
 
+    def on_settings_reload(self, old, new):
+        """
+        Called by the settings watcher after a config file changed
+        :param old: Settings
+        :param new: Settings
+        :return:
+        """
+        self.logger.debug('ig.py API on_settings_reload')
+        self.settings = new
+        self.position_monitor.set_rules(new.trade.exit_trailing_stop, new.trade.exit_max_hold,
+                                        new.trade.exit_target_pnl)
+        if self.screener is None:
+            return
+        if new.epic_ids == old.epic_ids:
+            self.screener.set_thresholds(change_high=new.trade.Price_Change_Day_percent_high,
+                                         change_low=new.trade.Price_Change_Day_percent_low,
+                                         max_spreads=new.max_spread)
+        else:
+            # different epics need different subscriptions
+            with self.streams_lock:
+                self.stop_streams()
+                self.screener = None
+                self.start_screener()
+                self.start_candles()
+
+    @timed('clientsentiment')
     def clientsentiment(self, epic_id):
         self.logger.debug('ig.py API clientsentiment')
         market_id = self.get_market_id(epic_id)
@@ -53,18 +218,86 @@ class API(IGClient):
 
     def get_market_id(self, epic_id):
         self.logger.debug('ig.py API get_market_id')
-        try:
-            MARKET_ID = self.market_ids[epic_id]
-        except KeyError:
-            # lookup and cache - these won't change
-            d = super().markets(epic_id)
-            self.market_ids[epic_id] = d['instrument']['marketId']
-            MARKET_ID = self.market_ids[epic_id]
-        return MARKET_ID
+        # cached on disk between runs - these won't change
+        return self.catalogue.market_id(epic_id)
+
+    def markets(self, epic_id):
+        self.logger.debug('ig.py API markets')
+        d = super().markets(epic_id)
+        self.catalogue.update(epic_id, d)
+        return d
+
+    def positions(self, deal_id=None):
+        if self.paper is not None:
+            return self.paper.positions(deal_id)
+        return super().positions(deal_id)
+
+    def positions_otc(self, data):
+        if self.paper is not None:
+            # IGClient.positions_otc applies [Trade] always/never_guarantee_stops, so paper orders need it here
+            data['guaranteedStop'] = self.guaranteed_stop(data)
+            return self.paper.positions_otc(data)
+        return super().positions_otc(data)
+
+    def positions_otc_close(self, data):
+        if self.paper is not None:
+            return self.paper.positions_otc_close(data)
+        return super().positions_otc_close(data)
+
+    def confirms(self, deal_ref):
+        if self.paper is not None:
+            return self.paper.confirms(deal_ref)
+        return super().confirms(deal_ref)
+
+    def quote(self, epic_id):
+        """:return: (bid, offer) from the screener or a stream lookup, None if there's no price"""
+        values = self.screener.latest(epic_id) if getattr(self, 'screener', None) is not None else None
+        if not values or values.get('BID') is None or values.get('OFFER') is None:
+            res = self.fetch_current_price(epic_id)
+            values = res['values'] if res is not None else None
+        if not values or values.get('BID') is None or values.get('OFFER') is None:
+            return None
+        return float(values['BID']), float(values['OFFER'])
+
+    def subscribe_prices(self, epic_id, listener):
+        """
+        Stream every BID and OFFER change of an epic, for the position monitor and the paper broker;
+        they share one subscription per epic
+        """
+        self.logger.debug('ig.py API subscribe_prices')
+        with self.price_subscriptions_lock:
+            if epic_id in self.price_subscriptions:
+                sub_key, subscription = self.price_subscriptions[epic_id]
+                subscription.addlistener(listener)
+                return sub_key
+            subscription = igstream.Subscription.from_preset(
+                'monitor',
+                mode="MERGE",
+                items=["MARKET:{}".format(epic_id)],
+                fields=["BID", "OFFER", "MARKET_STATE"]
+            )
+            sub_key, success = self.igstreamclient.subscribe(subscription=subscription, listener=listener)
+            if success:
+                self.ls_subscriptions[sub_key] = {'epic_id': None, 'running': True}
+                self.price_subscriptions[epic_id] = (sub_key, subscription)
+        return sub_key
+
+    def unsubscribe_prices(self, epic_id, listener):
+        """Stop streaming an epic's prices to listener, and unsubscribe once no one listens"""
+        self.logger.debug('ig.py API unsubscribe_prices')
+        with self.price_subscriptions_lock:
+            if epic_id not in self.price_subscriptions:
+                return
+            sub_key, subscription = self.price_subscriptions[epic_id]
+            if subscription.removelistener(listener):
+                return
+            del self.price_subscriptions[epic_id]
+        self.unsubscribe(sub_key=sub_key)
 
     def fetch_day_highlow(self, epic_id):
         self.logger.debug('ig.py API fetch_day_highlow')
-        subscription = igstream.Subscription(
+        subscription = igstream.Subscription.from_preset(
+            'lookup',
             mode="MERGE",
             items=["CHART:{}:HOUR".format(epic_id)],
             fields=["LTV", "DAY_LOW", "DAY_HIGH"]
@@ -72,10 +305,16 @@ class API(IGClient):
         res = self.igstreamclient.fetch_one(subscription)
         return res
 
+    @timed('fetch_current_price')
     def fetch_current_price(self, epic_id):
         self.logger.debug('ig.py API fetch_current_price')
+        res = self.bus.latest(epic_id) if self.bus is not None else None
+        if res is not None:
+            self.observe_spread(epic_id, res)
+            return res
         try:
-            subscription = igstream.Subscription(
+            subscription = igstream.Subscription.from_preset(
+                'lookup',
                 mode="MERGE",
                 items=["MARKET:{}".format(epic_id)],
                 fields=["MID_OPEN", "HIGH", "LOW", "CHANGE", "CHANGE_PCT", "UPDATE_TIME", "MARKET_DELAY",
@@ -91,13 +330,20 @@ class API(IGClient):
             res['values']['OFFER'] = res['snapshot']['offer']
             res['values']['CHANGE'] = res['snapshot']['netChange']
             res['values']['CHANGE_PCT'] = res['snapshot']['percentageChange']
+        self.observe_spread(epic_id, res)
         return res
 
-    def subscribe(self, epic_id, listener=on_item_update):
+    def observe_spread(self, epic_id, res):
+        # note how tight the spread gets, for the catalogue
+        if res is not None and res['values'].get('BID') is not None and res['values'].get('OFFER') is not None:
+            self.catalogue.observe_spread(epic_id, float(res['values']['OFFER']) - float(res['values']['BID']))
+
+    def subscribe(self, epic_id, listener=on_item_update, preset=None):
         """
         Create a live subscription to epic via Lightstreamer
         :param epic_id: string containing epic id
                listener: function to call on new update
+               preset: name of an igstream.PRESETS entry, or None for server defaults
         :return:
         """
         self.logger.debug('ig.py API subscribe')
@@ -107,7 +353,8 @@ class API(IGClient):
                 mode="MERGE",
                 items=["MARKET:{}".format(epic_id)],
                 fields=["MID_OPEN", "HIGH", "LOW", "CHANGE", "CHANGE_PCT", "UPDATE_TIME", "MARKET_DELAY",
-                        "MARKET_STATE", "BID", "OFFER"]
+                        "MARKET_STATE", "BID", "OFFER"],
+                **(igstream.PRESETS[preset] if preset else {})
             )
             sub_key, success = self.igstreamclient.subscribe(subscription=subscription, listener=listener)
             if success:
@@ -129,66 +376,258 @@ class API(IGClient):
         """
         self.logger.debug('ig.py API unsubscribe')
         success = False
+        # finished subscriptions are dropped, ls_subscriptions only holds running ones
         if sub_key is not None:
             self.igstreamclient.unsubscribe(sub_key)
-            self.ls_subscriptions[sub_key]['running'] = False
+            self.ls_subscriptions.pop(sub_key, None)
             success = True
             return
         elif epic_id is not None:
-            for sub_key in self.ls_subscriptions.keys():
+            for sub_key in list(self.ls_subscriptions.keys()):
                 if self.ls_subscriptions[sub_key]['running']:
                     if self.ls_subscriptions[sub_key]['epic_id'] == epic_id:
                         self.igstreamclient.unsubscribe(sub_key)
-                        self.ls_subscriptions[sub_key]['running'] = False
+                        del self.ls_subscriptions[sub_key]
                         success = True
                         return
         else:
             self.logger.debug('ig.py API unsubscribe: Unable to unsubscribe')
 
-    def placeOrder(self, prediction):
+    @timed('placeOrder')
+    def placeOrder(self, prediction, trace=None):
+        """
+        :param trace: lib.latency.Trace of the tick behind the prediction, finished once the order is sent
+        :return: the deal's dealStatus, 'ACCEPTED' or 'REJECTED' (also for orders pretrade_check turns down),
+                 None if no deal came of it
+        """
         self.logger.debug('ig.py API placeOrder')
-        data = self.handleDealingRules(prediction.get_tradedata())
+        data = self.handleDealingRules(prediction.get_tradedata(), current_price=prediction.current_price)
+
+        reasons = self.pretrade_check(data, prediction.current_price)
+        if reasons:
+            event('pretrade_rejected', "!!DEBUG!! {epic} not traded, it would fail with {reasons}",
+                  epic=data['epic'], reasons=", ".join(reasons))
+            return 'REJECTED'
 
         d = self.positions_otc(data)
+        if trace is not None:
+            trace.finish('execute')
+            self.logger.info('ig.py API placeOrder: {0}'.format(trace))
         try:
             deal_ref = d['dealReference']
         except:
-            return
+            return None
 
-        systime.sleep(2)
+        if self.paper is None:
+            with span('placeOrder.sleep'):
+                systime.sleep(2)
         # MAKE AN ORDER
 
         # CONFIRM MARKET ORDER
         d = self.confirms(deal_ref)
-        print("DEAL ID : {} - {} - {}".format(str(d['dealId']), d['dealStatus'], d['reason']))
+        event('confirm', "DEAL ID : {deal_id} - {deal_status} - {reason}", deal_id=str(d['dealId']),
+              deal_status=d['dealStatus'], reason=d['reason'])
 
         if str(d['reason']) == "ATTACHED_ORDER_LEVEL_ERROR" or str(d['reason']) == "MINIMUM_ORDER_SIZE_ERROR" or str(
                 d['reason']) == "INSUFFICIENT_FUNDS" or str(d['reason']) == "MARKET_OFFLINE":
-            print("!!DEBUG!! Not enough wonga in your account for this type of trade!!, Try again!!")
-            return None
+            event('rejected', "!!DEBUG!! Not enough wonga in your account for this type of trade!!, Try again!!")
+            return d['dealStatus']
+
+        # the position monitor picks the new position up from the TRADE stream, and closes it on our exit rules;
+        # the next order waits for nothing but the rate limit
+        self.open_positions = self.positions()
+        return d['dealStatus']
 
-        # let account stream provide updates, and let limit close it (for now)
-        # TODO: monitor trades with stream thread or waste of a stream?
-        systime.sleep(random.randint(1, 60))  # Obligatory Wait before doing next order
-        self.open_positions = super().positions()
+    @timed('handleDealingRules')
+    def handleDealingRules(self, data, dealing_rules=None, current_price=None):
+        """
+        Fit an order to the market's dealing rules, from the catalogue rather than a markets() call
+        :param current_price: bid, without it the rules and price are fetched as IGClient does
+        """
+        self.logger.debug('ig.py API handleDealingRules')
+        if dealing_rules is not None or current_price is None:
+            return super().handleDealingRules(data, dealing_rules, current_price)
+        rules = self.dealing_rules.get(data['epic'])
+        if not rules.market_orders:
+            event('market_unavailable', "!!ERROR!! This market is not available for this dealing account",
+                  epic=data['epic'])
+        return adjust_order(data, rules, float(current_price), self.guaranteed_stop(data))
+
+    @timed('pretrade_check')
+    def pretrade_check(self, data, current_price):
+        """
+        Check an order against the cached dealing rules and the streamed account balance
+        :param data: positions_otc data
+        :return: list of the reasons IG would reject it for, empty if it should go through
+        """
+        self.logger.debug('ig.py API pretrade_check')
+        guaranteed = self.guaranteed_stop(data)
+        instrument = self.catalogue.get(data['epic'])
+        price = float(current_price)
+        stop_distance = float(data['stopDistance']) if data.get('stopDistance') is not None else None
+        margin = margin_needed(float(data['size']), price, instrument.get('marginFactor'),
+                               instrument.get('marginFactorUnit'), stop_distance, guaranteed)
+        account = self.paper.account() if self.paper is not None else self.account
+        available = account.get('AVAILABLE_TO_DEAL')
+        if available is None:
+            available = account.get('AVAILABLE_CASH')
+        values = self.screener.latest(data['epic']) if self.screener is not None else None
+        return pretrade_check(data, self.dealing_rules.get(data['epic']), price, guaranteed,
+                              available=available, margin=margin,
+                              market_state=values.get('MARKET_STATE') if values else None)
+
+    def start_screener(self):
+        """
+        Stream every epic in the config into a Screener, throttled with the 'screen' preset
+        :return: True if the subscription went through, else find_next_trade falls back to polling
+        """
+        self.logger.debug('ig.py API start_screener')
+        settings = self.settings
+        epic_ids = settings.epic_ids
+        screener = Screener(epic_ids,
+                            change_high=settings.trade.Price_Change_Day_percent_high,
+                            change_low=settings.trade.Price_Change_Day_percent_low,
+                            max_spreads=settings.max_spread)
+        if self.bus is not None and self.bus.alive() and all(epic_id in self.bus for epic_id in epic_ids):
+            # prices and bars from marketbus.py, streamed here only while its heartbeat is missing
+            self.screener = screener
+            self.screener_follower = self.bus.follow(screener.on_update, epic_ids, bars_listener=self.candles.on_bars,
+                                                     state_listener=self.on_bus_state)
+            return True
+        success = self.subscribe_screen(screener)
+        if success:
+            self.screener = screener
+        else:
+            self.logger.warning('ig.py API start_screener: subscription failed, polling epics instead')
+        return success
+
+    def subscribe_screen(self, screener):
+        """
+        Subscribe the screener to MARKET updates of its epics
+        :return: True if the subscription went through
+        """
+        subscription = igstream.Subscription.from_preset(
+            'screen',
+            mode="MERGE",
+            items=["MARKET:{}".format(epic_id) for epic_id in screener.epic_ids],
+            fields=["MID_OPEN", "HIGH", "LOW", "CHANGE", "CHANGE_PCT", "UPDATE_TIME", "MARKET_DELAY",
+                    "MARKET_STATE", "BID", "OFFER"]
+        )
+        try:
+            sub_key, success = self.igstreamclient.subscribe(subscription=subscription, listener=screener.on_update)
+        except Exception:
+            success = False
+        if success:
+            self.ls_subscriptions[sub_key] = {'epic_id': None, 'running': True}
+            self.screener_sub_key = sub_key
+        return success
 
-    def find_next_trade(self):
+    def start_candles(self, bus=True):
+        """
+        Stream CHART bars of every epic at the STREAM_CANDLES scales into self.history
+        :param bus: leave out the scale the market bus brings, while the screener follows it
+        :return: True if every subscription went through
+        """
+        self.logger.debug('ig.py API start_candles')
+        scales = [scale.strip() for scale in self.config['Config'].get('STREAM_CANDLES', fallback='').split(',')]
+        success = True
+        for scale in filter(None, scales):
+            if bus and self.screener_follower is not None and scale == self.bus.scale:
+                continue
+            subscription = self.candles.subscription(self.settings.epic_ids, scale)
+            try:
+                sub_key, ok = self.igstreamclient.subscribe(subscription=subscription, listener=self.candles.on_update)
+            except Exception:
+                ok = False
+            if ok:
+                self.ls_subscriptions[sub_key] = {'epic_id': None, 'running': True}
+                self.candles_sub_keys.append(sub_key)
+            else:
+                self.logger.warning('ig.py API start_candles: {0} subscription failed, using REST history'.format(scale))
+                success = False
+        return success
+
+    def stop_streams(self):
+        """Stop the screener's and the candles' subscriptions, or the market bus follower."""
+        if self.screener_follower is not None:
+            self.screener_follower.stop()
+            self.screener_follower = None
+        if self.screener_sub_key is not None:
+            self.unsubscribe(sub_key=self.screener_sub_key)
+            self.screener_sub_key = None
+        for sub_key in self.candles_sub_keys:
+            self.unsubscribe(sub_key=sub_key)
+        self.candles_sub_keys = []
+
+    def on_bus_state(self, alive):
+        """
+        Called by the screener's BusFollower when marketbus.py's heartbeat stops or comes back:
+        stream the screener's prices and the bus's bars ourselves until it's back
+        """
+        self.logger.debug('ig.py API on_bus_state')
+        with self.streams_lock:
+            if self.screener is None or self.screener_follower is None:
+                return
+            if not alive and self.screener_sub_key is None:
+                self.logger.warning('ig.py API on_bus_state: market bus stale, streaming prices ourselves')
+                self.subscribe_screen(self.screener)
+                for sub_key in self.candles_sub_keys:
+                    self.unsubscribe(sub_key=sub_key)
+                self.candles_sub_keys = []
+                self.start_candles(bus=False)
+            elif alive and self.screener_sub_key is not None:
+                self.logger.info('ig.py API on_bus_state: market bus back, dropping our own subscriptions')
+                self.unsubscribe(sub_key=self.screener_sub_key)
+                self.screener_sub_key = None
+                for sub_key in self.candles_sub_keys:
+                    self.unsubscribe(sub_key=sub_key)
+                self.candles_sub_keys = []
+                self.start_candles()
+
+    @timed('find_next_trade')
+    def find_next_trade(self, exclude=()):
         self.logger.debug('ig.py API find_next_trade')
         """
-            Find our next trade.
+            Find our next trade, as soon as the stream shows one.
+            1) suitable daily price change as %
+            2) suitable spread as absolute or %
+            exclude: epics to skip besides those with open positions, e.g. ones still being evaluated
+        """
+        if self.screener is None:
+            return self.poll_next_trade(exclude)
+
+        while True:
+            self.screener.set_excluded([p['market']['epic'] for p in self.open_positions['positions']] + list(exclude))
+            res = self.screener.next_candidate(timeout=30)
+            if res is not None:
+                self.observe_spread(res['values']['EPIC'], res)
+                event('candidate', "{epic} Day Price Change {change_pct}% :- GOOD SPREAD",
+                      epic=res['values']['EPIC'], change_pct=res['values']['CHANGE_PCT'])
+                return res
+            event('no_candidates', "no candidates for 30s, refreshing open positions")
+            self.open_positions = self.positions()  # refresh in case a limit's been hit meanwhile
+
+    @timed('poll_next_trade')
+    def poll_next_trade(self, exclude=()):
+        self.logger.debug('ig.py API poll_next_trade')
+        """
+            Find our next trade by checking each epic in turn.
             1) suitable daily price change as %
             2) suitable spread as absolute or %
         """
-
-        epics = json.loads(self.config['Epics']['EPICS'])
-        epic_ids = list(epics.keys())
 
         while (1):
+            settings = self.settings  # one snapshot per pass, reloads apply to the next
+            epic_ids = list(settings.epic_ids)
+            Price_Change_Day_percent_h = settings.trade.Price_Change_Day_percent_high
+            Price_Change_Day_percent_l = settings.trade.Price_Change_Day_percent_low
             random.shuffle(epic_ids)
             for epic_id in epic_ids:
-                print(str(epic_id), end='')
                 if epic_id in map(lambda x: x['market']['epic'], self.open_positions['positions']):
-                    print(" already have an open position here")
+                    event('screened', "{epic} already have an open position here", epic=epic_id, outcome='open')
+                    continue
+                if epic_id in exclude:
+                    event('screened', "{epic} already being evaluated", epic=epic_id, outcome='in_flight')
                     continue
                 # systime.sleep(2) # we only get 30 API calls per minute :( but streaming doesn't count, so no sleep
 
@@ -206,39 +645,96 @@ class API(IGClient):
                 else:
                     Price_Change_Day_percent = float(res['values']['CHANGE_PCT'])
 
-                Price_Change_Day_percent_h = float(self.config['Trade']['Price_Change_Day_percent_high'])
-                Price_Change_Day_percent_l = float(self.config['Trade']['Price_Change_Day_percent_low'])
-
                 if (Price_Change_Day_percent_h > Price_Change_Day_percent > Price_Change_Day_percent_l) or (
                         (Price_Change_Day_percent_h * -1) < Price_Change_Day_percent < (
                         Price_Change_Day_percent_l * -1)):
-                    print(" Day Price Change {}% ".format(str(Price_Change_Day_percent)), end='')
                     bid_price = res['values']['BID']
                     ask_price = res['values']['OFFER']
                     spread = float(bid_price) - float(ask_price)
 
-                    if eval(self.config['Trade']['use_max_spread']) == True:
-                        max_permitted_spread = float(self.config['Trade']['max_spread'])
-                    else:
-                        max_permitted_spread = float(
-                            epics[epic_id]['minspread'] * float(self.config['Trade']['spread_multiplier']) * -1)
+                    max_permitted_spread = settings.max_spread_for(epic_id)
 
                     # if spread is less than -2, It's too big
                     if float(spread) > max_permitted_spread:
-                        print(":- GOOD SPREAD {0:.2f}>{1:.2f}".format(spread, max_permitted_spread), end="\n",
-                              flush=True)
+                        event('screened',
+                              "{epic} Day Price Change {change_pct}% :- GOOD SPREAD {spread:.2f}>{max_spread:.2f}",
+                              epic=epic_id, outcome='candidate', change_pct=Price_Change_Day_percent, spread=spread,
+                              max_spread=max_permitted_spread)
                         return res
                     else:
-                        print(":- spread not ok {0:.2f}<={1:.2f}".format(spread, max_permitted_spread), end="\n",
-                              flush=True)
+                        event('screened',
+                              "{epic} Day Price Change {change_pct}% :- spread not ok {spread:.2f}<={max_spread:.2f}",
+                              epic=epic_id, outcome='spread', change_pct=Price_Change_Day_percent, spread=spread,
+                              max_spread=max_permitted_spread)
                 else:
-                    print(": Price change {}%".format(Price_Change_Day_percent), end="\n", flush=True)
+                    event('screened', "{epic}: Price change {change_pct}%", epic=epic_id, outcome='change',
+                          change_pct=Price_Change_Day_percent)
 
-            print("sleeping for 30s, since we've hit the end of the epic list")
+            event('end_of_list', "sleeping for 30s, since we've hit the end of the epic list")
             systime.sleep(30)  # that's all of them
-            self.open_positions = super().positions()  # refresh in case a limit's been hit while we were sleeping
-
-    def fetch_lg_prices(self, epic_id):
+            self.open_positions = self.positions()  # refresh in case a limit's been hit while we were sleeping
+
+    def prices(self, epic_id, resolution):
+        self.logger.debug('ig.py API prices')
+        d = super().prices(epic_id, resolution)
+        name, points = parse_resolution(resolution)
+        if 'prices' in d:
+            self.planner.update(d.get('allowance'), points)
+            self.history.add(epic_id, name, d['prices'])
+        elif d.get('errorCode') == 'error.public-api.exceeded-account-historical-data-allowance':
+            self.planner.exhausted()
+        return d
+
+    def history_base(self, epic_id, resolution, points, wanted=()):
+        """
+        The resolution to build points bars of resolution from: HOUR for HOUR_n when HOUR is wanted too, else
+        the coarsest STREAM_CANDLES scale it's a whole multiple of, as streamed bars cost nothing to keep current.
+        DAY and longer are always fetched, IG's days end with each market's session rather than at midnight UTC.
+        :param wanted: resolutions fetched along with it
+        """
+        seconds = RESOLUTION_SECONDS[resolution]
+        if seconds >= RESOLUTION_SECONDS['DAY'] or self.candles.streams(epic_id, resolution):
+            return resolution
+        if resolution.startswith('HOUR_') and 'HOUR' in wanted:
+            return 'HOUR'
+        bases = [base for base in SCALES.values()
+                 if seconds % RESOLUTION_SECONDS[base] == 0 and self.candles.streams(epic_id, base)
+                 and (points + 1) * (seconds // RESOLUTION_SECONDS[base]) - 1 <= self.history.keep]
+        return max(bases, key=RESOLUTION_SECONDS.get) if bases else resolution
+
+    @timed('fetch_history')
+    def fetch_history(self, epic_id, resolutions, value=1.0):
+        """
+        Bars for each resolution, fetching only what the history lacks and the planner allows.
+        Some are resampled from finer bars rather than fetched, see history_base.
+        :param resolutions: e.g. ['HOUR/5', 'HOUR_2/5']
+        :param value: lib.allowance.candidate_value of the epic, decides fetches when the allowance is tight
+        :return: list of prices() style bar lists, in resolutions order, possibly short or empty
+        """
+        self.logger.debug('ig.py API fetch_history')
+        wanted = [parse_resolution(resolution) for resolution in resolutions]
+        names = set(name for name, points in wanted)
+        plan = []
+        need = {}
+        for name, points in wanted:
+            base = self.history_base(epic_id, name, points, names)
+            k = RESOLUTION_SECONDS[name] // RESOLUTION_SECONDS[base]
+            # k - 1 more, in case the oldest bucket starts part way through
+            need[base] = max(need.get(base, 0), points * k + k - 1)
+            plan.append((name, points, base))
+
+        for base, points in need.items():
+            missing = self.history.missing(epic_id, base, points, self.planner.max_age(RESOLUTION_SECONDS[base]))
+            if missing and self.planner.allow(missing, value):
+                self.prices(epic_id, '{0}/{1}'.format(base, missing))
+            elif missing:
+                self.logger.info('ig.py API fetch_history: {0} {1} from cache, allowance {2}'.format(
+                    epic_id, base, self.planner.mode()))
+
+        return [self.history.bars(epic_id, name, points, base) for name, points, base in plan]
+
+    @timed('fetch_lg_prices')
+    def fetch_lg_prices(self, epic_id, value=1.0):
         self.logger.debug('ig.py API fetch_lg_prices')
         """
 		just....don't look
@@ -291,7 +787,7 @@ class API(IGClient):
         # 		print ("!!DEBUG!! WARNING - Take Profit over high value, Might take a while for this trade!!")
         # systime.sleep(1.5)
 
-        high_resolution = eval(self.config['Trade']['high_resolution'])
+        high_resolution = self.settings.trade.high_resolution
 
         # Price resolution (MINUTE, MINUTE_2, MINUTE_3, MINUTE_5, MINUTE_10, MINUTE_15, MINUTE_30, HOUR, HOUR_2, HOUR_2, HOUR_4, DAY, WEEK, MONTH)
         # This is the high roller, For the price prediction.
@@ -299,10 +795,9 @@ class API(IGClient):
             resolutions = ['HOUR/5', 'HOUR_2/5', 'HOUR_3/5', 'HOUR_4/5', 'DAY/5']
         else:
             resolutions = ['HOUR_4/5', 'MINUTE_30/5']
-        for resolution in resolutions:
-            d = self.prices(epic_id, resolution)
+        for prices in self.fetch_history(epic_id, resolutions, value):
 
-            for i in d['prices']:
+            for i in prices:
                 tmp_list = []
                 high_price = i['highPrice']["bid"]
                 low_price = i['lowPrice']["bid"]
@@ -315,9 +810,12 @@ class API(IGClient):
                 x.append(tmp_list)
                 y.append(float(close_price))
 
+        if not x:
+            return None  # no history and no allowance to fetch it
         return (x, y)
 
-    def fetch_lg_highlow(self, epic_id):
+    @timed('fetch_lg_highlow')
+    def fetch_lg_highlow(self, epic_id, value=1.0):
         self.logger.debug('ig.py API fetch_lg_highlow')
         """
 		This fetches the data required for Prediction.linear_regression
@@ -326,13 +824,18 @@ class API(IGClient):
         ###################################################################################
         # Here we just need a value to predict the next one of.
 
-        if eval(self.config['Trade']['high_resolution']):
-            d = self.prices(epic_id, 'DAY/1')
+        if epic_id in self.candles.day_high_low:
+            # streamed with the CHART bars
+            high_price, low_price = self.candles.day_high_low[epic_id]
+            return (high_price, low_price)
 
-            for i in d['prices']:
+        prices = self.fetch_history(epic_id, ['DAY/1'], value)[0] if self.settings.trade.high_resolution else []
+        if prices:
+            for i in prices:
                 high_price = i['highPrice']["bid"]
                 low_price = i['lowPrice']["bid"]
         else:
+            # the stream's day high/low cost no allowance
             res = self.fetch_day_highlow(epic_id)
             low_price = float(res['values']['DAY_LOW'])
             high_price = float(res['values']['DAY_HIGH'])  # this is (now) an hourly volume - will that be an issue?
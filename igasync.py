@@ -0,0 +1,769 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""asyncio versions of IGClient and the Lightstreamer client.
+
+Everything runs on one event loop: REST calls are coroutines that share a
+RateLimiter, or with RATE_LIMIT_FILE set the host's SharedRateLimiter, and
+each stream session is read by a task rather than a thread. Like IGClient's,
+a call refused with a 401 logs in again once and is retried, and each REST
+request gives up after the client's timeout.
+
+    loop = asyncio.get_event_loop()
+    client = AsyncIGClient()
+    login = loop.run_until_complete(client.session())
+    stream = AsyncIGStream(client, login)
+    loop.run_until_complete(stream.connect())
+"""
+
+import asyncio
+import collections
+import functools
+import json
+import logging
+import ssl
+import time
+from urllib.parse import urlparse, urljoin, urlencode
+
+import igstream
+from igclient import AuthenticationError, load_config
+from lib.ratelimit import DEFAULT, RESERVE, SharedRateLimiter, priority_of
+from lib.settings import build_settings
+
+
+class RateLimiter(object):
+    """Sliding window limiter, defaults to IG's 30 calls per minute.
+    Lower priorities leave lib.ratelimit.RESERVE calls of the window to the higher ones."""
+
+    def __init__(self, max_calls=30-1, period=60, reserve=None):
+        self.max_calls = max_calls
+        self.period = period
+        self.reserve = dict(RESERVE if reserve is None else reserve)
+        self._calls = collections.deque()
+
+    async def acquire(self, priority=DEFAULT):
+        # nothing awaits between the check and the append, so no lock; a waiting history call holds up no order
+        limit = max(1, self.max_calls - self.reserve.get(priority, 0))
+        while True:
+            now = time.monotonic()
+            while self._calls and self._calls[0] <= now - self.period:
+                self._calls.popleft()
+            if len(self._calls) < limit:
+                self._calls.append(now)
+                return
+            await asyncio.sleep(self._calls[len(self._calls) - limit] + self.period - now)
+
+
+class SharedLimiter(object):
+    """lib.ratelimit.SharedRateLimiter for coroutines, each wait on a thread of the loop's executor."""
+
+    def __init__(self, shared):
+        self.shared = shared
+
+    async def acquire(self, priority=DEFAULT):
+        return await asyncio.get_event_loop().run_in_executor(None, self.shared.acquire, priority)
+
+
+def trackcall(f):
+    # waits on the client's shared rate limiter before each api call
+    priority = priority_of(f.__name__)
+
+    @functools.wraps(f)
+    async def wrap(self, *args, **kwargs):
+        await self.limiter.acquire(priority)
+        cst = self.auth.get('CST')
+        try:
+            return await f(self, *args, **kwargs)
+        except AuthenticationError:
+            # tokens expired under us: log in again, once, and retry
+            if cst is None:
+                raise
+            await self.relogin(cst)
+            await self.limiter.acquire(priority)
+            return await f(self, *args, **kwargs)
+    return wrap
+
+
+class HTTPResponse(object):
+    """Response read from an asyncio stream, either whole or line by line."""
+
+    def __init__(self, session, key, reader, writer, status, headers):
+        self._session = session
+        self._key = key
+        self._reader = reader
+        self._writer = writer
+        self.status = status
+        self.headers = headers
+        self.content = None
+        self.text = None
+        self._buffer = b''
+        self._eof = False
+        self._chunked = headers.get('transfer-encoding', '').lower() == 'chunked'
+        self._chunk_left = 0
+        self._remaining = int(headers['content-length']) if 'content-length' in headers else None
+        self._reusable = headers.get('connection', '').lower() != 'close' and \
+            (self._chunked or self._remaining is not None)
+
+    async def _read_some(self):
+        if self._eof:
+            return b''
+        if self._chunked:
+            if self._chunk_left == 0:
+                size_line = await self._reader.readline()
+                size = int(size_line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # skip any trailers up to the closing blank line
+                    while (await self._reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    self._eof = True
+                    return b''
+                self._chunk_left = size
+            data = await self._reader.read(self._chunk_left)
+            self._chunk_left -= len(data)
+            if self._chunk_left == 0:
+                await self._reader.readline()
+        elif self._remaining is not None:
+            data = await self._reader.read(min(self._remaining, 65536)) if self._remaining else b''
+            self._remaining -= len(data)
+        else:
+            data = await self._reader.read(65536)
+        if not data:
+            self._eof = True
+        return data
+
+    async def read(self):
+        parts = [self._buffer]
+        self._buffer = b''
+        while True:
+            data = await self._read_some()
+            if not data:
+                break
+            parts.append(data)
+        self.release()
+        return b''.join(parts)
+
+    async def readline(self):
+        while b'\n' not in self._buffer:
+            data = await self._read_some()
+            if not data:
+                line, self._buffer = self._buffer, b''
+                return line
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line + b'\n'
+
+    def release(self):
+        """Hand the connection back to the pool, or close it."""
+        if self._writer is None:
+            return
+        if self._eof and self._reusable:
+            self._session._put_idle(self._key, self._reader, self._writer)
+        else:
+            self._writer.close()
+        self._writer = None
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class HTTPSession(object):
+    """Minimal HTTP/1.1 client on asyncio streams, with keep-alive per host."""
+
+    def __init__(self, max_idle=16):
+        self.logger = logging.getLogger('HTTPSession')
+        self.max_idle = max_idle
+        self._idle = {}
+        self._ssl = None
+
+    def _put_idle(self, key, reader, writer):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.max_idle:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def _open(self, key):
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            context = self._ssl
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        return reader, writer, False
+
+    async def request(self, method, url, headers=None, body=None, stream=False):
+        """
+        Perform a request
+        :param stream: if True the body is left unread, for use with readline()
+        :return: HTTPResponse
+        """
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        key = (parsed.scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        lines = ['{0} {1} HTTP/1.1'.format(method, path), 'Host: {0}'.format(parsed.netloc)]
+        for k, v in (headers or {}).items():
+            lines.append('{0}: {1}'.format(k, v))
+        if body is not None or method in ('POST', 'PUT'):
+            lines.append('Content-Length: {0}'.format(len(body or b'')))
+        payload = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+        while True:
+            reader, writer, reused = await self._open(key)
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status_line = await reader.readline()
+            except (ConnectionError, OSError):
+                status_line = b''
+            except BaseException:
+                # cancelled, e.g. timed out, the connection's no good part way through a request
+                writer.close()
+                raise
+            if status_line:
+                break
+            writer.close()
+            if not reused:
+                raise ConnectionError('No response from {0}'.format(parsed.netloc))
+            # a pooled connection went stale, retry on a fresh one
+
+        try:
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+                if not line:
+                    break
+                k, v = line.split(':', 1)
+                response_headers[k.strip().lower()] = v.strip()
+
+            response = HTTPResponse(self, key, reader, writer, status, response_headers)
+            if status_line.startswith(b'HTTP/1.0'):
+                response._reusable = False
+            if not stream:
+                response.content = await response.read()
+                response.text = response.content.decode('utf-8')
+        except BaseException:
+            writer.close()
+            raise
+        return response
+
+    def close(self):
+        for idle in self._idle.values():
+            for reader, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncIGClient(object):
+    """Coroutine counterpart of IGClient, sharing its config and endpoints."""
+
+    def __init__(self, config=None, limiter=None, http=None, timeout=30):
+        """
+        :param timeout: seconds a REST request may take before it fails with asyncio.TimeoutError, None waits forever
+        """
+        self.logger = logging.getLogger('AsyncIGClient')
+        self.logger.debug('igasync.py AsyncIGClient __init__')
+
+        self.loggedin = False
+        self.config = load_config(config)
+        self.settings = build_settings(self.config)
+        if limiter is None and self.config['Config'].get('RATE_LIMIT_FILE', fallback=''):
+            # one budget with the other processes on this host, see lib/ratelimit.py
+            limiter = SharedLimiter(SharedRateLimiter(
+                self.config['Config']['RATE_LIMIT_FILE'],
+                client=self.config['Config'].get('RATE_LIMIT_CLIENT', fallback='') or None))
+        self.limiter = limiter or RateLimiter()
+        self.http = http or HTTPSession()
+        self.timeout = timeout
+        self._relogin_lock = asyncio.Lock()
+        self.auth = {}
+        self.allowance = {}
+        self.accountId = None
+
+        self.API_ENDPOINT = self.config['Config']['API_ENDPOINT']
+        self.API_KEY = self.config['Config']['API_KEY']
+
+        self.headers = {'Content-Type': 'application/json; charset=utf-8',
+                        'Accept': 'application/json; charset=utf-8',
+                        'X-IG-API-KEY': self.API_KEY}
+        self.authenticated_headers = self.headers
+
+    async def _handlereq(self, method, url, data=None, headers=None):
+        self.logger.debug('igasync.py AsyncIGClient _handlereq')
+        body = None if data is None else json.dumps(data)
+        # a stalled request gives up rather than holding up its caller for good
+        r = await asyncio.wait_for(
+            self.http.request(method, self.API_ENDPOINT + url, headers or self.authenticated_headers, body),
+            self.timeout)
+
+        if r.status == 401:
+            raise AuthenticationError(r.text)
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(r.text)
+        return r
+
+    async def _request_json(self, method, url, data=None, headers=None):
+        r = await self._handlereq(method, url, data, headers)
+        return json.loads(r.text)
+
+    async def _login(self):
+        # POST /session and take its tokens, see session and relogin
+        data = {"identifier": self.config['Auth']['USERNAME'], "password": self.config['Auth']['PASSWORD']}
+        session_headers = self.headers.copy()
+        session_headers.update({'Version': '2'})
+
+        r = await self._handlereq('POST', '/session', data, session_headers)
+        for h in ['CST', 'X-SECURITY-TOKEN']:
+            self.auth[h] = r.headers[h.lower()]
+
+        self.authenticated_headers = self.headers.copy()
+        self.authenticated_headers.update(self.auth)
+        self.loggedin = True
+        return json.loads(r.text)
+
+    async def relogin(self, failed_cst=None):
+        """
+        Log in again after the tokens were refused, back onto the same account
+        :param failed_cst: CST the failing call used, if another call already replaced it nothing is done
+        """
+        self.logger.debug('igasync.py AsyncIGClient relogin')
+        async with self._relogin_lock:
+            if failed_cst is not None and self.auth.get('CST') != failed_cst:
+                return
+            self.logger.info('igasync.py AsyncIGClient relogin: logging in again')
+            # straight to the endpoints, a 401 here means the credentials are refused
+            await self.limiter.acquire(priority_of('session'))
+            d = await self._login()
+            if self.accountId is not None and str(d.get('currentAccountId')) != self.accountId:
+                await self.limiter.acquire(priority_of('update_session'))
+                await self._request_json('PUT', '/session', {"accountId": self.accountId, "defaultAccount": "True"})
+
+    @trackcall
+    async def session(self, set_default=True):
+        self.logger.debug('igasync.py AsyncIGClient session')
+        login = await self._login()
+
+        d = await self.accounts()
+        for i in d['accounts']:
+            if str(i['accountType']) == self.config['Config']['ACCOUNT_TYPE']:
+                self.logger.info("Spreadbet Account ID is : " + str(i['accountId']))
+                self.accountId = str(i['accountId'])
+                break
+
+        if set_default:
+            self.logger.debug("Setting SPREADBET account as default")
+            await self.update_session({"accountId": self.accountId, "defaultAccount": "True"})
+
+        return login
+
+    @trackcall
+    async def accounts(self):
+        self.logger.debug('igasync.py AsyncIGClient accounts')
+        return await self._request_json('GET', '/accounts')
+
+    @trackcall
+    async def update_session(self, data):
+        self.logger.debug('igasync.py AsyncIGClient update_session')
+        return await self._request_json('PUT', '/session', data)
+
+    @trackcall
+    async def markets(self, epic_id):
+        self.logger.debug('igasync.py AsyncIGClient markets')
+        return await self._request_json('GET', '/markets/' + epic_id)
+
+    @trackcall
+    async def clientsentiment(self, market_id):
+        self.logger.debug('igasync.py AsyncIGClient clientsentiment')
+        return await self._request_json('GET', '/clientsentiment/' + market_id)
+
+    @trackcall
+    async def prices(self, epic_id, resolution):
+        self.logger.debug('igasync.py AsyncIGClient prices')
+        # version 3, for each bar's snapshotTimeUTC; resolution is e.g. 'HOUR/5', 5 bars
+        name, _, points = resolution.partition('/')
+        headers = dict(self.authenticated_headers, Version='3')
+        r = await self._request_json('GET', '/prices/' + epic_id + '?' + urlencode(
+            {'resolution': name, 'max': points or 10, 'pageSize': 0}), headers=headers)
+        if 'metadata' in r:
+            r.setdefault('allowance', r['metadata'].get('allowance'))
+        try:
+            self.allowance = r['allowance']
+        except Exception:
+            pass
+        return r
+
+    @trackcall
+    async def positions(self, deal_id=None):
+        self.logger.debug('igasync.py AsyncIGClient positions')
+        if deal_id is None:
+            url = '/positions'
+        else:
+            url = '/positions/' + deal_id
+        return await self._request_json('GET', url)
+
+    @trackcall
+    async def positions_otc(self, data):
+        """
+        Create a new position
+        :param data:
+        :return:
+        """
+        self.logger.debug('igasync.py AsyncIGClient positions_otc')
+        if self.settings.trade.always_guarantee_stops:
+            data['guaranteedStop'] = True
+        if self.settings.trade.never_guarantee_stops:
+            data['guaranteedStop'] = False
+        return await self._request_json('POST', '/positions/otc', data)
+
+    @trackcall
+    async def positions_otc_close(self, data):
+        """
+        Close (delete) a position
+        :param data:
+        :return:
+        """
+        self.logger.debug('igasync.py AsyncIGClient positions_otc_close')
+        # WORKAROUND AS PER .... https://labs.ig.com/node/36
+        delete_headers = self.authenticated_headers.copy()
+        delete_headers.update({'_method': "DELETE"})
+        return await self._request_json('POST', '/positions/otc', data, delete_headers)
+
+    @trackcall
+    async def confirms(self, deal_ref):
+        self.logger.debug('igasync.py AsyncIGClient confirms')
+        return await self._request_json('GET', '/confirms/' + deal_ref)
+
+    def close(self):
+        self.http.close()
+
+
+class SubscriptionUpdates(object):
+    """Async iterator over the updates pushed to one subscription.
+
+    When maxsize is reached the oldest update is dropped, so a slow consumer
+    always sees the most recent state rather than stalling the stream task.
+    """
+
+    _closed = object()
+
+    def __init__(self, subscription, maxsize=0):
+        self.sub_key = None
+        self._queue = asyncio.Queue(maxsize)
+        subscription.addlistener(self._put)
+
+    def _put(self, item_info):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(item_info)
+
+    def close(self):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(self._closed)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item_info = await self._queue.get()
+        if item_info is self._closed:
+            raise StopAsyncIteration
+        return item_info
+
+
+class AsyncLSClient(object):
+    """Lightstreamer text protocol client, read by a task on the event loop."""
+
+    def __init__(self, base_url, adapter_set="", user="", password="", http=None):
+        self.logger = logging.getLogger('AsyncLSClient')
+        self.logger.debug('igasync.py AsyncLSClient __init__')
+        self._base_url = base_url
+        self._control_url = base_url
+        self._adapter_set = adapter_set
+        self._user = user
+        self._password = password
+        self._http = http or HTTPSession()
+        self._session = {}
+        self._subscriptions = {}
+        self._current_subscription_key = 0
+        self._stream_connection = None
+        self._receive_task = None
+        self._bind_counter = 0
+
+    def _encode_params(self, params):
+        return urlencode(dict([(k, v) for (k, v) in params.items() if v]))
+
+    async def _call(self, base_url, url, body, stream=False):
+        url = urljoin(base_url, url)
+        return await self._http.request('POST', url, {'Content-Type': 'application/x-www-form-urlencoded'},
+                                        self._encode_params(body), stream=stream)
+
+    def _set_control_link_url(self, custom_address=None):
+        if custom_address is None:
+            self._control_url = self._base_url
+        else:
+            self._control_url = '{0}://{1}/'.format(urlparse(self._base_url).scheme, custom_address)
+
+    async def _control(self, params):
+        params["LS_session"] = self._session["SessionId"]
+        response = await self._call(self._control_url, igstream.CONTROL_URL_PATH, params)
+        return response.text.split('\n', 1)[0].rstrip()
+
+    async def _read_from_stream(self):
+        line = await self._stream_connection.readline()
+        if not line:
+            raise ConnectionError('Stream connection closed')
+        return line.decode("utf-8").rstrip()
+
+    async def connect(self):
+        """Establish a connection to Lightstreamer Server to create
+        a new session.
+        """
+        self.logger.debug('igasync.py AsyncLSClient connect')
+        self._stream_connection = await self._call(
+            self._base_url,
+            igstream.CONNECTION_URL_PATH,
+            {
+                "LS_op2": 'create',
+                "LS_cid": 'mgQkwtwdysogQz2BJ4Ji kOj2Bg',
+                "LS_adapter_set": self._adapter_set,
+                "LS_user": self._user,
+                "LS_password": self._password},
+            stream=True
+        )
+        await self._handle_stream(await self._read_from_stream())
+
+    async def bind(self):
+        """Replace a completely consumed connection in listening for an active
+        Session.
+        """
+        self.logger.debug('igasync.py AsyncLSClient bind')
+        self._stream_connection = await self._call(
+            self._control_url,
+            igstream.BIND_URL_PATH,
+            {"LS_session": self._session["SessionId"]},
+            stream=True
+        )
+        self._bind_counter += 1
+        await self._handle_stream(await self._read_from_stream())
+
+    async def _handle_stream(self, stream_line):
+        if stream_line == igstream.OK_CMD:
+            while 1:
+                next_stream_line = await self._read_from_stream()
+                if next_stream_line:
+                    [param, value] = next_stream_line.split(':', 1)
+                    self._session[param] = value
+                else:
+                    break
+            self._set_control_link_url(self._session.get("ControlAddress"))
+            self._receive_task = asyncio.ensure_future(self._receive())
+        else:
+            lines = [stream_line.encode('utf-8'), await self._stream_connection.read()]
+            self.logger.error("Server response error: \n{0}".format(b"\n".join(lines).decode('utf-8', 'replace')))
+            raise IOError()
+
+    async def disconnect(self):
+        self.logger.debug('igasync.py AsyncLSClient disconnect')
+        if self._stream_connection is not None:
+            self._stream_connection.close()
+            if self._receive_task is not None:
+                self._receive_task.cancel()
+                self._receive_task = None
+        else:
+            self.logger.warning("No connection to Lightstreamer")
+
+    async def destroy(self):
+        self.logger.debug('igasync.py AsyncLSClient destroy')
+        if self._stream_connection is not None:
+            server_response = await self._control({"LS_op": igstream.OP['DESTROY']})
+            if server_response == igstream.OK_CMD:
+                if self._receive_task is not None:
+                    await self._receive_task
+            else:
+                self.logger.warning("No connection to Lightstreamer")
+
+    async def subscribe(self, subscription):
+        """
+        Perform a subscription request to Lightstreamer Server.
+        :param subscription:
+        :return: _current_subscription_key (int)
+                success (bool)
+        """
+        self.logger.debug('igasync.py AsyncLSClient subscribe')
+        self._current_subscription_key += 1
+        sub_key = self._current_subscription_key
+        self._subscriptions[sub_key] = subscription
+
+        try:
+            params = {"LS_table": sub_key,
+                      "LS_op": igstream.OP['ADD'],
+                      "LS_mode": subscription.mode,
+                      "LS_schema": " ".join(subscription.field_names),
+                      "LS_id": " ".join(subscription.item_names)}
+            params.update(subscription.control_params())
+            server_response = await self._control(params)
+            success = server_response == igstream.OK_CMD
+        except Exception:
+            success = False
+            self.logger.warning("igasync.py AsyncLSClient subscribe: {0} : errors occured during subscribe, did not complete".format(subscription.item_names))
+
+        return sub_key, success
+
+    async def unsubscribe(self, subcription_key):
+        self.logger.debug('igasync.py AsyncLSClient unsubscribe')
+        if subcription_key in self._subscriptions:
+            server_response = await self._control({
+                "LS_Table": subcription_key,
+                "LS_op": igstream.OP['DELETE']
+            })
+            if server_response == igstream.OK_CMD:
+                del self._subscriptions[subcription_key]
+            else:
+                self.logger.warning("Server error:" + server_response)
+        else:
+            self.logger.warning("No subscription key {0} found!".format(subcription_key))
+
+    def _forward_update_message(self, update_message):
+        tok = update_message.split(',', 1)
+        table, item = int(tok[0]), tok[1]
+        if table in self._subscriptions:
+            self._subscriptions[table].notifyupdate(item)
+        else:
+            self.logger.warning("No subscription found!")
+
+    async def _receive(self):
+        rebind = False
+        receive = True
+        while receive:
+            try:
+                message = await self._read_from_stream()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.logger.exception("Communication error")
+                message = None
+
+            if message is None:
+                receive = False
+                self.logger.warning("No new message received")
+            elif message == igstream.PROBE_CMD:
+                pass
+            elif message.startswith(igstream.ERROR_CMD):
+                receive = False
+                self.logger.error("ERROR")
+            elif message.startswith(igstream.LOOP_CMD):
+                receive = False
+                rebind = True
+            elif message.startswith(igstream.SYNC_ERROR_CMD):
+                self.logger.error("SYNC ERROR")
+                receive = False
+            elif message.startswith(igstream.END_CMD):
+                self.logger.info("Connection closed by the server")
+                receive = False
+            elif message.startswith("Preamble"):
+                pass
+            else:
+                self._forward_update_message(message)
+
+        self._stream_connection.close()
+        if not rebind:
+            self._stream_connection = None
+            self._session.clear()
+            self._subscriptions.clear()
+            self._current_subscription_key = 0
+        else:
+            self.logger.debug("igasync.py AsyncLSClient _receive: Binding to this active session")
+            await self.bind()
+
+
+class AsyncIGStream(object):
+    """Coroutine counterpart of IGStream."""
+
+    def __init__(self, igclient, loginresponse):
+        self.logger = logging.getLogger('AsyncIGStream')
+        self.logger.debug('igasync.py AsyncIGStream __init__')
+        self.igclient = igclient
+        self.loginresponse = loginresponse
+        SERVER = self.loginresponse['lightstreamerEndpoint']
+        ACCOUNTID = self.loginresponse['currentAccountId']
+        PASSWORD = 'CST-' + self.igclient.auth['CST'] + '|XST-' + self.igclient.auth['X-SECURITY-TOKEN']
+        if not SERVER.endswith('/'):
+            SERVER += '/'
+        self.lightstreamer_client = AsyncLSClient(SERVER, "", ACCOUNTID, PASSWORD)
+        self._updates = {}
+
+    async def connect(self):
+        await self.lightstreamer_client.connect()
+
+    async def subscribe(self, subscription, listener):
+        self.logger.debug('igasync.py AsyncIGStream subscribe')
+        subscription.addlistener(listener)
+        return await self.lightstreamer_client.subscribe(subscription)
+
+    async def updates(self, subscription, maxsize=0):
+        """
+        Subscribe and iterate over the updates with `async for`
+        :param subscription: igstream.Subscription
+               maxsize: queue bound, oldest updates are dropped beyond it
+        :return: SubscriptionUpdates, with sub_key set (None if the subscribe failed)
+        """
+        self.logger.debug('igasync.py AsyncIGStream updates')
+        updates = SubscriptionUpdates(subscription, maxsize)
+        sub_key, success = await self.lightstreamer_client.subscribe(subscription)
+        if success:
+            updates.sub_key = sub_key
+            self._updates[sub_key] = updates
+        else:
+            updates.close()
+        return updates
+
+    async def unsubscribe(self, sub_key):
+        self.logger.debug('igasync.py AsyncIGStream unsubscribe')
+        await self.lightstreamer_client.unsubscribe(sub_key)
+        updates = self._updates.pop(sub_key, None)
+        if updates is not None:
+            updates.close()
+
+    async def fetch_one(self, subscription, timeout=10):
+        """Wait for the first update of a subscription, or None after timeout seconds."""
+        self.logger.debug('igasync.py AsyncIGStream fetch_one')
+        result = None
+        updates = await self.updates(subscription)
+        if updates.sub_key is None:
+            return None
+        try:
+            result = await asyncio.wait_for(updates.__anext__(), timeout)
+        except (asyncio.TimeoutError, StopAsyncIteration):
+            pass
+        await self.unsubscribe(updates.sub_key)
+        return result
+
+    async def disconnect(self):
+        self.logger.debug('igasync.py AsyncIGStream disconnect')
+        await self.lightstreamer_client.disconnect()
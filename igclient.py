@@ -16,20 +16,80 @@ import json
 import time
 import logging
 import os
+import threading
+
+from lib.dealing import adjust_order, compile_rules
+from lib.logs import event
+from lib.profiler import span, timed
+from lib.ratelimit import RESERVE, SharedRateLimiter, priority_of
+from lib.settings import build_settings
+
+# read in this order, later files override earlier ones
+CONFIG_FILES = ["default.conf", "config_docker.conf", "config.conf"]
+
+
+class AuthenticationError(Exception):
+    # the session tokens were refused (HTTP 401)
+    pass
 
 
 def trackcall(f):
     # tracks number of recent api calls (in last 60s) and sleeps accordingly
+    # threads sharing a client wait their turn while the budget is spent
+    # with a rate_limiter, the budget is shared with other processes, see lib/ratelimit.py
+    # the endpoint's priority can be overridden per call with priority=, e.g. HISTORY for background fetches
+    default_priority = priority_of(f.__name__)
+    f = timed('api.' + f.__name__)(f)
+
+    def wait(client, priority):
+        if client.rate_limiter is not None:
+            with span('api.ratelimit_wait'):
+                client.rate_limiter.acquire(priority)
+            return
+        # lower priorities leave RESERVE calls of the minute to the higher ones here too,
+        # and wait outside the lock so a history call waiting doesn't hold up an order
+        limit = max(1, 30-1 - RESERVE.get(priority, 0))
+        with span('api.ratelimit_wait'):
+            while True:
+                with client.recent_calls_lock:
+                    client.recent_calls = [x for x in client.recent_calls if x > int(time.time()-60)]
+                    if len(client.recent_calls) < limit:
+                        client.recent_calls.append(int(time.time()))
+                        return
+                time.sleep(1)
+
     def wrap(*args, **kwargs):
-        while len(args[0].recent_calls) >= 30-1:
-            time.sleep(1)
-            args[0].recent_calls = [x for x in args[0].recent_calls if x > int(time.time()-60)]
-            #args[0].recent_calls = filter(lambda x: x > int(time.time())-60, args[0].recent_calls)
-        args[0].recent_calls.append(int(time.time()))
-        return f(*args, **kwargs)
+        priority = kwargs.pop('priority', None) or default_priority
+        wait(args[0], priority)
+        cst = args[0].auth.get('CST')
+        try:
+            return f(*args, **kwargs)
+        except AuthenticationError:
+            # tokens expired under us: log in again, once, and retry
+            if args[0].session_manager is None:
+                raise
+            args[0].session_manager.relogin(cst)
+            wait(args[0], priority)
+            return f(*args, **kwargs)
     return wrap
 
 
+def load_config(config=None):
+    # reads default.conf and any overrides, filling credentials from the environment
+    if config is None:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILES)
+    # Read variables from environment variables, if necessary
+    for section, key in [('Config', 'API_KEY'), ('Auth', 'USERNAME'), ('Auth', 'PASSWORD')]:
+        if (config[section][key] == 'environment_variable') & (key in os.environ):
+            try:
+                config[section][key] = os.environ[key]
+            except:
+                # Hope for following config file to pick this up
+                pass
+    return config
+
+
 class IGClient(object):
 
     def __init__(self, config=None):
@@ -38,24 +98,18 @@ class IGClient(object):
 
         self.loggedin = False
         self.json = True # return json or obj
-        if config is None:
-            config = configparser.ConfigParser()
-            config.read("default.conf")
-            config.read("config_docker.conf")
-            config.read("config.conf")
-        # Read variables from environment variables, if necessary
-        for section, key in [('Config', 'API_KEY'), ('Auth', 'USERNAME'), ('Auth', 'PASSWORD')]:
-            if (config[section][key] == 'environment_variable') & (key in os.environ):
-                try:
-                    config[section][key] = os.environ[key]
-                except:
-                    # Hope for following config file to pick this up
-                    pass
-        self.config = config
+        self.config = load_config(config)
+        self.settings = build_settings(self.config)
         self.auth = {}
         self.debug = True
         self.allowance = {}
         self.recent_calls = []
+        self.recent_calls_lock = threading.Lock()
+        self.rate_limiter = None
+        if self.config['Config'].get('RATE_LIMIT_FILE', fallback=''):
+            self.rate_limiter = SharedRateLimiter(self.config['Config']['RATE_LIMIT_FILE'],
+                                                  client=self.config['Config'].get('RATE_LIMIT_CLIENT', fallback='') or None)
+        self.session_manager = None  # see igsession.SessionManager
 
         self.accountId = None
 
@@ -71,9 +125,19 @@ class IGClient(object):
             import httplib as http_client
         http_client.HTTPConnection.debuglevel = (0, 1)[ self.debug == True]
 
-    @trackcall
     def session(self, set_default=True):
         self.logger.debug('igclient.py IGClient session')
+        d = self.login()
+        self.select_account(set_default)
+        return d
+
+    @trackcall
+    def login(self):
+        """
+        Log in, without picking an account, see session
+        :return: the login response
+        """
+        self.logger.debug('igclient.py IGClient login')
         data = { "identifier": self.config['Auth']['USERNAME'], "password": self.config['Auth']['PASSWORD'] }
 
         self.headers = { 'Content-Type': 'application/json; charset=utf-8',
@@ -97,6 +161,14 @@ class IGClient(object):
 
         self.loggedin = True
 
+        return ((r, json.loads(r.text))[ self.json == True ])
+
+    def select_account(self, set_default=True):
+        """
+        Find the ACCOUNT_TYPE account, and make it the default if set_default
+        :return: accountId
+        """
+        self.logger.debug('igclient.py IGClient select_account')
         #GET ACCOUNTS
         d = self.accounts()
 
@@ -112,12 +184,15 @@ class IGClient(object):
             self.update_session({"accountId": self.accountId, "defaultAccount": "True"})
             # ERROR about account ID been the same, Ignore!
 
-        return ((r, json.loads(r.text))[ self.json == True ])
+        return self.accountId
 
     def _handlereq(self, r: object) -> object:
         self.logger.debug('igclient.py IGClient _handlereq')
 
-        if hasattr(r, 'text'):
+        if getattr(r, 'status_code', None) == 401:
+            raise AuthenticationError(r.text)
+
+        if hasattr(r, 'text') and self.logger.isEnabledFor(logging.DEBUG):
             if type(r.text) is str:
                 try:
                     self.logger.debug(r.text)
@@ -138,6 +213,19 @@ class IGClient(object):
         delete_headers.update({ '_method': "DELETE" })
         return delete_headers
 
+    def stream_password(self):
+        # Lightstreamer logs in with the REST session tokens
+        return 'CST-' + self.auth['CST'] + '|XST-' + self.auth['X-SECURITY-TOKEN']
+
+    @trackcall
+    def read_session(self):
+        """
+        Details of the current session, a cheap call that also keeps the tokens alive
+        :return: clientId, accountId, lightstreamerEndpoint, ...
+        """
+        self.logger.debug('igclient.py IGClient read_session')
+        return self._handlereq( requests.get(self.API_ENDPOINT + '/session', headers=self.authenticated_headers) )
+
     @trackcall
     def accounts(self):
         self.logger.debug('igclient.py IGClient accounts')
@@ -148,6 +236,7 @@ class IGClient(object):
         self.logger.debug('igclient.py IGClient update_session')
         return self._handlereq( requests.put(self.API_ENDPOINT + '/session', data=data, headers=self.authenticated_headers) )
 
+    @trackcall
     def markets(self, epic_id):
         self.logger.debug('igclient.py IGClient markets')
         return self._handlereq( requests.get(self.API_ENDPOINT + '/markets/' + epic_id, headers=self.authenticated_headers) )
@@ -160,7 +249,12 @@ class IGClient(object):
     @trackcall
     def prices(self, epic_id, resolution):
         self.logger.debug('igclient.py IGClient prices')
-        r = self._handlereq( requests.get(self.API_ENDPOINT + '/prices/' + epic_id + '/' + resolution, headers=self.authenticated_headers) )
+        # version 3, for each bar's snapshotTimeUTC; resolution is e.g. 'HOUR/5', 5 bars
+        name, _, points = resolution.partition('/')
+        headers = dict(self.authenticated_headers, Version='3')
+        r = self._handlereq( requests.get(self.API_ENDPOINT + '/prices/' + epic_id, params={'resolution': name, 'max': points or 10, 'pageSize': 0}, headers=headers) )
+        if 'metadata' in r:
+            r.setdefault('allowance', r['metadata'].get('allowance'))
         try:
             self.allowance = r['allowance']
         except Exception:
@@ -184,10 +278,7 @@ class IGClient(object):
         :return:
         """
         self.logger.debug('igclient.py IGClient positions_otc')
-        if eval(self.config['Trade']['always_guarantee_stops']):
-            data['guaranteedStop'] = True
-        if eval(self.config['Trade']['never_guarantee_stops']):
-            data['guaranteedStop'] = False
+        data['guaranteedStop'] = self.guaranteed_stop(data)
         return self._handlereq( requests.post(self.API_ENDPOINT + '/positions/otc', data=json.dumps(data), headers=self.authenticated_headers) )
 
     @trackcall
@@ -205,52 +296,31 @@ class IGClient(object):
         self.logger.debug('igclient.py IGClient confirms')
         return self._handlereq( requests.get(self.API_ENDPOINT + '/confirms/' + deal_ref, headers=self.authenticated_headers) )
 
-    def handleDealingRules(self, data):
+    def guaranteed_stop(self, data):
+        """Whether positions_otc will ask for a guaranteed stop, after [Trade] always/never_guarantee_stops"""
+        if self.settings.trade.never_guarantee_stops:
+            return False
+        if self.settings.trade.always_guarantee_stops:
+            return True
+        return bool(data.get('guaranteedStop', False))
+
+    def handleDealingRules(self, data, dealing_rules=None, current_price=None):
+        """
+        Fit an order's size, stop and limit to the market's dealing rules
+        :param dealing_rules: the market's 'dealingRules', fetched with markets() if None
+        :param current_price: bid, fetched with markets() if None
+        :return: data
+        """
         self.logger.debug('igclient.py IGClient handleDealingRules')
 
-        market = self.markets(data['epic'])
-        dealingRules = market['dealingRules']
-
-        current_price = float(market['snapshot']['bid'])
-
-        r = 'marketOrderPreference'
-        if dealingRules[r] == 'NOT_AVAILABLE':
-            print("!!ERROR!! This market is not available for this dealing account")
-
-        r = 'maxStopOrLimitDistance'
-        if dealingRules[r]['unit'] == 'PERCENTAGE':
-            if current_price/100 * float(dealingRules[r]['value']) < float(data['limitDistance']):
-              data['limitDistance'] = str(format(current_price/100 * float(dealingRules[r]['value']), '.2f'))
-        elif dealingRules[r]['unit'] == 'POINTS':
-            if float(dealingRules[r]['value']) < float(data['limitDistance']):
-              data['limitDistance'] = str(dealingRules[r]['value'])
-
-        if ('guaranteedStop' in data and data['guaranteedStop'] == True) or self.config['Trade']['always_guarantee_stops']:
-            r = 'minControlledRiskStopDistance'
-        else: # data['guaranteedStop'] == False
-            r = 'minNormalStopOrLimitDistance'
-        if dealingRules[r]['unit'] == 'PERCENTAGE':
-            if current_price/100 * float(dealingRules[r]['value']) > float(data['stopDistance']):
-                data['stopDistance'] = str(format(current_price/100 * float(dealingRules[r]['value']), '.2f'))
-        elif dealingRules[r]['unit'] == 'POINTS':
-            if float(dealingRules[r]['value']) > float(data['stopDistance']):
-                data['stopDistance'] = str(dealingRules[r]['value'])
-
-        r = 'minDealSize'
-        if dealingRules[r]['unit'] == 'POINTS':
-            if float(dealingRules[r]['value']) > float(data['size']):
-                data['size'] = str(dealingRules[r]['value'])
-        elif dealingRules[r]['unit'] == 'PERCENTAGE':
-            pass # err...what? we have to buy sell a percentage of everything?
-
-        # minStepDistance
-        # hmmm...i'm not doing this one :D
-        # if our bid is smaller than the permitted amount, that's because:
-        # we have no faith in the step being big enough;
-        # or we don't have permission to make a step that big
-        # either way, we shouldn't change it just to let the trade go through
-        # it should fail
-
-        # trailingStopsPreference # TODO
-
-        return data
+        if dealing_rules is None or current_price is None:
+            market = self.markets(data['epic'])
+            dealing_rules = market['dealingRules']
+            current_price = float(market['snapshot']['bid'])
+
+        rules = compile_rules(dealing_rules)
+        if not rules.market_orders:
+            event('market_unavailable', "!!ERROR!! This market is not available for this dealing account",
+                  epic=data['epic'])
+
+        return adjust_order(data, rules, float(current_price), self.guaranteed_stop(data))
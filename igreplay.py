@@ -0,0 +1,230 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Record a Lightstreamer session and replay it through LSClient.
+
+A recording is a gzip text file, one record per line:
+
+    <microseconds since previous record> <raw stream line>
+    <microseconds since previous record> #SUB {"table": 1, "mode": ..., "items": [...], "fields": [...]}
+
+Replay with ReplayIGStream, which has the IGStream subscribe/fetch_one API.
+Subscriptions are matched to recorded tables by mode, items and fields:
+
+    stream = ReplayIGStream('session.lsrec.gz', speed=10)  # None for flat out
+    stream.subscribe(subscription, listener)
+    stream.run()
+
+or from the command line, to measure dispatch throughput:
+
+    python igreplay.py session.lsrec.gz [--speed N]
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import threading
+import time
+
+import igstream
+
+SUBSCRIPTION_TAG = '#SUB '
+
+
+class StreamRecorder(object):
+    """Writes raw stream lines with monotonic receive times, see LSClient(recorder=...)."""
+
+    flush_interval = 5  # seconds
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('StreamRecorder')
+        self.logger.debug('igreplay.py StreamRecorder __init__')
+        self.path = path
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+        self._last_flush = self._last
+
+    def _write(self, text):
+        with self._lock:
+            if self._file is None:
+                return
+            now = time.monotonic()
+            self._file.write('{0} {1}\n'.format(int((now - self._last) * 1000000), text))
+            self._last = now
+            if now - self._last_flush > self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+    def record(self, line):
+        self._write(line)
+
+    def record_subscription(self, sub_key, subscription):
+        self._write(SUBSCRIPTION_TAG + json.dumps({'table': sub_key,
+                                                   'mode': subscription.mode,
+                                                   'items': subscription.item_names,
+                                                   'fields': subscription.field_names}))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_recording(path):
+    """Yield (seconds since previous record, text) for each record in a recording."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for record in f:
+            delta, _, text = record.rstrip('\n').partition(' ')
+            yield int(delta) / 1000000.0, text
+
+
+class _ReplayConnection(object):
+    def close(self):
+        pass
+
+
+class ReplayLSClient(igstream.LSClient):
+    """LSClient reading a recording instead of the network.
+
+    speed None replays as fast as possible, otherwise at speed x real time.
+    """
+
+    server_lag = False  # the recording's stamps are from its own day
+
+    def __init__(self, path, speed=None, dispatch_queue_size=0):
+        super(ReplayLSClient, self).__init__('http://replay/', dispatch_queue_size=dispatch_queue_size)
+        self.logger = logging.getLogger('ReplayLSClient')
+        self.path = path
+        self.speed = speed
+        self.line_count = 0
+        self.recorded_tables = {}
+        for delta, text in read_recording(path):
+            if text.startswith(SUBSCRIPTION_TAG):
+                table = json.loads(text[len(SUBSCRIPTION_TAG):])
+                self.recorded_tables[table['table']] = table
+        self._records = None
+        self._stream_connection = _ReplayConnection()
+
+    def _call(self, base_url, url, body):
+        raise IOError('No network calls during replay')
+
+    def _control(self, params):
+        return igstream.OK_CMD
+
+    def _read_from_stream(self):
+        for delta, text in self._records:
+            if text.startswith(SUBSCRIPTION_TAG):
+                continue
+            if self.speed:
+                self._clock += delta / self.speed
+                wait = self._clock - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+            self.line_count += 1
+            return text
+        # a recording ends like a session closed by the server
+        return igstream.END_CMD
+
+    def _read_header(self):
+        if self._read_from_stream() != igstream.OK_CMD:
+            raise IOError('{0} does not start with a session'.format(self.path))
+        while 1:
+            line = self._read_from_stream()
+            if not line:
+                break
+            [param, value] = line.split(':', 1)
+            self._session[param] = value
+
+    def connect(self):
+        self._records = read_recording(self.path)
+        self._clock = time.monotonic()
+        self._stream_connection = _ReplayConnection()
+        self._read_header()
+        self._start_dispatch()
+
+    def bind(self):
+        # a LOOP in the recording is followed by the rebound session's header
+        self._read_header()
+        self._receive()
+
+    def subscribe(self, subscription):
+        """Attach a subscription to the recorded table with the same mode, items and fields."""
+        for key, table in sorted(self.recorded_tables.items()):
+            if key not in self._subscriptions and table['mode'] == subscription.mode and \
+                    table['items'] == list(subscription.item_names) and table['fields'] == list(subscription.field_names):
+                self._subscriptions[key] = subscription
+                return key, True
+        self.logger.warning("igreplay.py ReplayLSClient subscribe: {0} not in recording".format(subscription.item_names))
+        return None, False
+
+    def unsubscribe(self, subcription_key):
+        self._subscriptions.pop(subcription_key, None)
+
+    def _forward_update_message(self, update_message, received=None):
+        # tables nobody subscribed to during the replay are skipped quietly
+        if int(update_message.split(',', 1)[0]) in self._subscriptions:
+            super(ReplayLSClient, self)._forward_update_message(update_message, received)
+
+
+class ReplayIGStream(igstream.IGStream):
+    """IGStream over a recording: subscribe as usual, then run() or start()."""
+
+    def __init__(self, path, speed=None, dispatch_queue_size=0):
+        self.logger = logging.getLogger('ReplayIGStream')
+        self.logger.debug('igreplay.py ReplayIGStream __init__')
+        self.recorder = None
+        self.lightstreamer_client = ReplayLSClient(path, speed, dispatch_queue_size)
+        self.lightstreamer_client.connect()
+
+    def subscribe_recorded(self, listener):
+        """Subscribe listener to every table in the recording."""
+        for key, table in sorted(self.lightstreamer_client.recorded_tables.items()):
+            subscription = igstream.Subscription(mode=table['mode'], items=table['items'], fields=table['fields'])
+            self.subscribe(subscription, listener)
+
+    def run(self):
+        """Replay on the calling thread, returning once the recording is exhausted."""
+        self.lightstreamer_client._receive()
+
+    def start(self):
+        """Replay on a background thread, like a live stream."""
+        thread = threading.Thread(name="STREAM-REPLAY-THREAD", target=self.run)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded Lightstreamer session')
+    parser.add_argument('path')
+    parser.add_argument('--speed', type=float, default=None, help='x real time, default as fast as possible')
+    args = parser.parse_args()
+
+    updates = [0]
+
+    def count(item_info):
+        updates[0] += 1
+
+    stream = ReplayIGStream(args.path, speed=args.speed)
+    stream.subscribe_recorded(count)
+    start = time.monotonic()
+    stream.run()
+    elapsed = time.monotonic() - start
+    print("{0} lines, {1} updates in {2:.3f}s ({3:.0f} updates/s)".format(
+        stream.lightstreamer_client.line_count, updates[0], elapsed, updates[0] / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
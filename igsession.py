@@ -0,0 +1,218 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Keep one IG session across restarts.
+
+IG's v2 session tokens (CST and X-SECURITY-TOKEN) stay valid for 6 hours after
+their last use, and can be kept alive that way for up to 72 hours. SessionManager
+saves them to a file only the current user can read, reuses them at startup
+while they are valid, keeps them in use from a background thread, and logs in
+again shortly before the 72 hours are up, or whenever a call gets a 401.
+
+The client's auth headers and stream_password() always come from the manager's
+current tokens, so REST calls and new Lightstreamer connections share them:
+
+    manager = SessionManager(client, 'session.json')
+    d = manager.login()  # login response, either saved or fresh
+    manager.start()
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from igclient import AuthenticationError
+
+
+class SessionManager(object):
+
+    lifetime = 6 * 3600  # tokens lapse after this long unused
+    max_lifetime = 72 * 3600  # and can't be kept alive past this
+
+    def __init__(self, client, path=None, keepalive_interval=1800, refresh_margin=900):
+        """
+        :param client: IGClient to log in
+        :param path: file to keep the tokens in, None keeps them in memory only
+        :param keepalive_interval: seconds between calls keeping the tokens alive
+        :param refresh_margin: log in again this many seconds before max_lifetime is up
+        """
+        self.logger = logging.getLogger('SessionManager')
+        self.logger.debug('igsession.py SessionManager __init__')
+        self.client = client
+        self.path = path
+        self.keepalive_interval = keepalive_interval
+        self.refresh_margin = refresh_margin
+        self.restored = False
+
+        self._state = None  # what gets saved, see _store
+        self._lock = threading.RLock()
+        self._logging_in = False
+        self._stop = threading.Event()
+        self._thread = None
+        client.session_manager = self
+
+    def _owner(self):
+        # a saved session is only any use for the same endpoint and user
+        return {'endpoint': self.client.API_ENDPOINT, 'username': self.client.config['Auth']['USERNAME']}
+
+    def _store(self, d):
+        now = time.time()
+        self._state = dict(self._owner(),
+                           auth=dict(self.client.auth),
+                           accountId=self.client.accountId,
+                           loginresponse=d,
+                           created=now,
+                           expires=now + self.lifetime)
+        self.save()
+
+    def _touch(self):
+        # the tokens were just used, so they last another lifetime, within max_lifetime
+        self._state['expires'] = min(time.time() + self.lifetime, self._state['created'] + self.max_lifetime)
+        self.save()
+
+    def save(self):
+        if not self.path or self._state is None:
+            return
+        self._state['accountId'] = self.client.accountId
+        tmp = self.path + '.tmp'
+        # readable by the current user only, it's as good as a password for the next few hours
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._state, f)
+        os.replace(tmp, self.path)
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            self.logger.warning('igsession.py SessionManager _load: ignoring {0}, {1}'.format(self.path, e))
+            return None
+        for key, value in self._owner().items():
+            if state.get(key) != value:
+                return None
+        if state.get('expires', 0) - time.time() < self.refresh_margin:
+            return None
+        return state
+
+    def _use(self, state):
+        # point the client at saved tokens
+        self.client.auth = dict(state['auth'])
+        self.client.headers = {'Content-Type': 'application/json; charset=utf-8',
+                               'Accept': 'application/json; charset=utf-8',
+                               'X-IG-API-KEY': self.client.API_KEY}
+        self.client.headers.update(self.client.auth)
+        self.client.authenticated_headers = self.client.headers
+        self.client.accountId = state['accountId']
+        self.client.loggedin = True
+
+    def restore(self):
+        """
+        Reuse saved tokens if they are still good
+        :return: the saved login response, or None
+        """
+        self.logger.debug('igsession.py SessionManager restore')
+        state = self._load()
+        if state is None:
+            return None
+        with self._lock:
+            self._use(state)
+            # a 401 now means the saved tokens are no good, rather than a reason to log in again
+            self._logging_in = True
+            try:
+                # one call instead of logging in, choosing the account and setting it as default
+                current = self.client.read_session()
+            except AuthenticationError:
+                self.logger.info('igsession.py SessionManager restore: saved session refused')
+                self.client.loggedin = False
+                return None
+            finally:
+                self._logging_in = False
+            self._state = state
+        d = state['loginresponse']
+        d['lightstreamerEndpoint'] = current.get('lightstreamerEndpoint', d['lightstreamerEndpoint'])
+        self._touch()
+        self.restored = True
+        self.logger.info('igsession.py SessionManager restore: reusing session from {0}'.format(self.path))
+        return d
+
+    def login(self):
+        """
+        Log in, reusing saved tokens if possible. After a fresh login client.accountId is None,
+        call client.select_account() and then save().
+        :return: login response
+        """
+        self.logger.debug('igsession.py SessionManager login')
+        d = self.restore()
+        if d is None:
+            self.restored = False
+            with self._lock:
+                self._logging_in = True
+                try:
+                    d = self.client.login()
+                finally:
+                    self._logging_in = False
+                self.client.accountId = None
+                self._store(d)
+        return d
+
+    def relogin(self, failed_cst=None):
+        """
+        Log in again after the tokens were refused.
+        :param failed_cst: CST the failing call used, if other threads already replaced it nothing is done
+        """
+        self.logger.debug('igsession.py SessionManager relogin')
+        with self._lock:
+            if self._logging_in:
+                # logging in itself got a 401, the credentials are wrong
+                raise AuthenticationError('login refused')
+            if failed_cst is not None and self.client.auth.get('CST') != failed_cst:
+                return
+            self._logging_in = True
+            try:
+                self.logger.info('igsession.py SessionManager relogin: logging in again')
+                d = self.client.session()
+                self._store(d)
+            finally:
+                self._logging_in = False
+
+    def _due(self):
+        # seconds until something needs doing
+        renew_at = self._state['created'] + self.max_lifetime - self.refresh_margin
+        return max(0, min(self.keepalive_interval, renew_at - time.time()))
+
+    def _run(self):
+        while not self._stop.wait(self._due()):
+            try:
+                with self._lock:
+                    if time.time() >= self._state['created'] + self.max_lifetime - self.refresh_margin:
+                        self.relogin()
+                    else:
+                        self.client.read_session()
+                        self._touch()
+            except Exception:
+                self.logger.exception('igsession.py SessionManager _run: keepalive failed')
+                self._stop.wait(60)
+
+    def start(self):
+        self.logger.debug('igsession.py SessionManager start')
+        if self._thread is None:
+            self._thread = threading.Thread(name="SESSION-THREAD", target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -14,11 +14,15 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import collections
 import sys
 import logging
 import threading
 import time
-import traceback
+import zlib
+
+from lib.latency import TRACKER, update_lag
+from lib.logs import event
 
 # log = logging.getLogger()
 
@@ -30,6 +34,7 @@ PY2 = sys.version_info[0] == 2
 if PY3:
     from urllib.request import urlopen as _urlopen
     from urllib.parse import (urlparse as parse_url, urljoin, urlencode)
+    import queue
 
 
     def _url_encode(params):
@@ -48,6 +53,7 @@ else:
     from urllib import (urlopen as _urlopen, urlencode)
     from urlparse import urlparse as parse_url
     from urlparse import urljoin
+    import Queue as queue
 
 
     def _url_encode(params):
@@ -69,6 +75,7 @@ CONTROL_URL_PATH = "lightstreamer/control.txt"
 OP = {
     'ADD': 'add',  # Request parameter to create and activate a new Table.
     'DELETE': 'delete',  # Request parameter to delete a previously created Table.
+    'RECONF': 'reconf',  # Request parameter to change the max frequency of a Table.
     'DESTROY': "destroy"  # Request parameter to force closure of an existing session.
 }
 
@@ -80,11 +87,36 @@ ERROR_CMD = "ERROR"
 SYNC_ERROR_CMD = "SYNC ERROR"
 OK_CMD = "OK"
 
+# Subscription settings per use, see Subscription.from_preset
+#   record: every tick, for recording
+#   screen: at most one update per second per item, backing off further
+#           when the local dispatch queue builds up
+#   lookup: the snapshot, with as little traffic after it as possible
+#   candles: CHART bars kept up to date once a second, never throttled so bars don't miss their close
+#   monitor: every price change of an epic we hold a position in, the monitor batches them itself
+PRESETS = {
+    'record': {'max_frequency': 'unfiltered', 'buffer_size': None, 'snapshot': True, 'adaptive': False},
+    'screen': {'max_frequency': 1.0, 'buffer_size': 1, 'snapshot': True, 'adaptive': True},
+    'lookup': {'max_frequency': 0.1, 'buffer_size': 1, 'snapshot': True, 'adaptive': False},
+    'candles': {'max_frequency': 1.0, 'buffer_size': 1, 'snapshot': True, 'adaptive': False},
+    'monitor': {'max_frequency': 'unfiltered', 'buffer_size': None, 'snapshot': True, 'adaptive': False},
+}
+
 
 class Subscription(object):
-    """Represents a Subscription to be submitted to a Lightstreamer Server."""
-
-    def __init__(self, mode, items, fields, adapter=""):
+    """Represents a Subscription to be submitted to a Lightstreamer Server.
+
+    max_frequency is updates per second per item, 'unfiltered' or None for
+    the server default; buffer_size is a number, 'unlimited' or None;
+    snapshot is True, False or the number of snapshot events (DISTINCT).
+    With adaptive set, LSClient lowers the frequency (down to min_frequency)
+    while its dispatch queue is backed up, and restores it afterwards.
+    Only the latest history updates are kept for fetch_one, listeners get
+    every one; a long running subscription would otherwise hold them all.
+    """
+
+    def __init__(self, mode, items, fields, adapter="", max_frequency=None, buffer_size=None, snapshot=True,
+                 adaptive=False, min_frequency=0.1, history=1):
         self.logger = logging.getLogger('Subscription')
         self.logger.debug('igstream.py Subscription __init__')
         self.item_names = items
@@ -92,15 +124,59 @@ class Subscription(object):
         self.field_names = fields
         self.adapter = adapter
         self.mode = mode
-        self.snapshot = "true"
+        self.snapshot = snapshot
+        self.max_frequency = max_frequency
+        self.buffer_size = buffer_size
+        self.adaptive = adaptive and isinstance(max_frequency, (int, float))
+        self.min_frequency = min_frequency
+        self.current_frequency = max_frequency
         self._listeners = []
-        self._results = []
+        self._results = collections.deque(maxlen=history)
+
+    @classmethod
+    def from_preset(cls, preset, mode, items, fields, adapter=""):
+        return cls(mode, items, fields, adapter, **PRESETS[preset])
+
+    def options(self):
+        """Keyword arguments to build a Subscription with the same settings."""
+        return {'max_frequency': self.max_frequency,
+                'buffer_size': self.buffer_size,
+                'snapshot': self.snapshot,
+                'adaptive': self.adaptive,
+                'min_frequency': self.min_frequency,
+                'history': self._results.maxlen}
+
+    def control_params(self):
+        """Table parameters for the LS_op=add control request."""
+        params = {}
+        if self.snapshot is True:
+            params["LS_snapshot"] = "true"
+        elif self.snapshot is False:
+            params["LS_snapshot"] = "false"
+        elif self.snapshot is not None:
+            params["LS_snapshot"] = str(self.snapshot)
+        if self.current_frequency is not None:
+            params["LS_requested_max_frequency"] = str(self.current_frequency)
+        if self.buffer_size is not None:
+            params["LS_requested_buffer_size"] = str(self.buffer_size)
+        return params
+
+    def adapt_frequency(self, factor):
+        """Scale the current frequency within [min_frequency, max_frequency].
+        :return: the new frequency, or None if it did not change
+        """
+        if not self.adaptive:
+            return None
+        frequency = min(self.max_frequency, max(self.min_frequency, self.current_frequency * factor))
+        if frequency == self.current_frequency:
+            return None
+        self.current_frequency = frequency
+        return frequency
 
     def _decode(self, value, last):
         """Decode the field value according to
         Lightstremar Text Protocol specifications.
         """
-        self.logger.debug('igstream.py Subscription _decode')
         if value == "$":
             return u''
         elif value == "#":
@@ -116,11 +192,20 @@ class Subscription(object):
         self.logger.debug('igstream.py Subscription __init__')
         self._listeners.append(listener)
 
-    def notifyupdate(self, item_line):
+    def removelistener(self, listener):
+        """:return: how many listeners are left"""
+        self.logger.debug('igstream.py Subscription removelistener')
+        if listener in self._listeners:
+            # a new list, so a dispatch going through the old one isn't disturbed
+            self._listeners = [l for l in self._listeners if l != listener]
+        return len(self._listeners)
+
+    def notifyupdate(self, item_line, received=None, server_lag=True):
         """Invoked by LSClient each time Lightstreamer Server pushes
         a new item event.
+        :param received: time.monotonic() the line was read, now if None
+        :param server_lag: whether to time the update from its UPDATE_TIME stamp
         """
-        self.logger.debug('igstream.py Subscription notifyupdate')
         # Tokenize the item line as sent by Lightstreamer
         toks = item_line.rstrip('\r\n').split('|')
         undecoded_item = dict(list(zip(self.field_names, toks[1:])))
@@ -139,8 +224,15 @@ class Subscription(object):
         item_info = {
             'pos': item_pos,
             'name': self.item_names[item_pos - 1],
-            'values': self._items_map[item_pos]
+            'values': self._items_map[item_pos],
+            'received': time.monotonic() if received is None else received
         }
+        if received is not None:
+            TRACKER.record('dispatch', time.monotonic() - received)
+        # only a stamp that came with this update says how old it is
+        if server_lag and undecoded_item.get('UPDATE_TIME'):
+            item_info['lag'] = update_lag(item_info['values'])
+            TRACKER.observe_lag(item_info['lag'], item_info['name'])
 
         self._results.append(item_info)
         # Update each registered listener with new event
@@ -149,9 +241,20 @@ class Subscription(object):
 
 
 class LSClient(object):
-    """Manages the communication with Lightstreamer Server"""
+    """Manages the communication with Lightstreamer Server
+
+    With dispatch_queue_size set, updates are handed to a separate dispatch
+    thread through a bounded queue, so slow listeners don't hold up reading
+    the stream, and adaptive subscriptions are throttled while it backs up.
+    A recorder (igreplay.StreamRecorder) receives every raw stream line.
+    """
+
+    adapt_interval = 2.0  # seconds between frequency adjustments
+    adapt_high_watermark = 0.5  # fraction of the dispatch queue
+    adapt_low_watermark = 0.1
+    server_lag = True  # time updates from the server's stamps, see lib/latency.py
 
-    def __init__(self, base_url, adapter_set="", user="", password=""):
+    def __init__(self, base_url, adapter_set="", user="", password="", dispatch_queue_size=0, recorder=None):
         self.logger = logging.getLogger('LSClient')
         self.logger.debug('igstream.py LSClient __init__')
         self._base_url = parse_url(base_url)
@@ -161,9 +264,15 @@ class LSClient(object):
         self._session = {}
         self._subscriptions = {}
         self._current_subscription_key = 0
+        self._subscription_key_lock = threading.Lock()
         self._stream_connection = None
         self._stream_connection_thread = None
         self._bind_counter = 0
+        self._dispatch_queue_size = dispatch_queue_size
+        self._dispatch_queue = queue.Queue(dispatch_queue_size) if dispatch_queue_size else None
+        self._dispatch_thread = None
+        self._last_adapt = 0
+        self._recorder = recorder
 
     def _encode_params(self, params):
         """Encode the parameter for HTTP POST submissions, but
@@ -207,9 +316,9 @@ class LSClient(object):
 
     def _read_from_stream(self):
         """Read a single line of content of the Stream Connection."""
-        self.logger.debug('igstream.py LSClient _read_from_stream')
         line = self._stream_connection.readline().decode("utf-8").rstrip()
-        self.logger.debug(line)
+        if self._recorder is not None:
+            self._recorder.record(line)
         return line
 
     def connect(self):
@@ -225,7 +334,8 @@ class LSClient(object):
                 "LS_cid": 'mgQkwtwdysogQz2BJ4Ji kOj2Bg',
                 "LS_adapter_set": self._adapter_set,
                 "LS_user": self._user,
-                "LS_password": self._password}
+                # a callable password is asked again on each connect, in case the tokens were renewed
+                "LS_password": self._password() if callable(self._password) else self._password}
         )
 
         while 1:
@@ -273,6 +383,8 @@ class LSClient(object):
             )
             self._stream_connection_thread.setDaemon(True)
             self._stream_connection_thread.start()
+
+            self._start_dispatch()
         else:
             lines = self._stream_connection.readlines()
             lines.insert(0, stream_line)
@@ -297,7 +409,7 @@ class LSClient(object):
             # Close the HTTP connection
             self._stream_connection.close()
             self.logger.debug("igstream.py LSClient disconnect: Connection closed")
-            print("DISCONNECTED FROM LIGHTSTREAMER")
+            event('stream_disconnected', "DISCONNECTED FROM LIGHTSTREAMER")
         else:
             self.logger.warning("No connection to Lightstreamer")
 
@@ -323,26 +435,36 @@ class LSClient(object):
                 success (bool)
         """
         self.logger.debug('igstream.py LSClient subscribe')
-        # Register the Subscription with a new subscription key
-        self._current_subscription_key += 1
-        self._subscriptions[self._current_subscription_key] = subscription
+        # Register the Subscription with a new subscription key, keys are handed out
+        # under a lock since concurrent fetch_one calls subscribe from several threads
+        with self._subscription_key_lock:
+            self._current_subscription_key += 1
+            subscription_key = self._current_subscription_key
+        self._subscriptions[subscription_key] = subscription
 
         try:
             # Send the control request to perform the subscription
-            server_response = self._control({"LS_session": self._session['SessionId'],
-                                             "LS_table": self._current_subscription_key,
-                                             "LS_op": OP['ADD'],
-                                             # "LS_data_adapter": subscription.adapter,
-                                             "LS_mode": subscription.mode,
-                                             "LS_schema": " ".join(subscription.field_names),
-                                             "LS_id": " ".join(subscription.item_names)})
+            params = {"LS_session": self._session['SessionId'],
+                      "LS_table": subscription_key,
+                      "LS_op": OP['ADD'],
+                      # "LS_data_adapter": subscription.adapter,
+                      "LS_mode": subscription.mode,
+                      "LS_schema": " ".join(subscription.field_names),
+                      "LS_id": " ".join(subscription.item_names)}
+            params.update(subscription.control_params())
+            server_response = self._control(params)
             success = server_response == 'OK'
             self.logger.debug("igstream.py LSClient subscribe: {0} Server response ---> <{1}>".format(subscription.item_names, server_response))
+            if success and self._recorder is not None:
+                self._recorder.record_subscription(subscription_key, subscription)
         except:
             success = False
             self.logger.warning("igstream.py LSClient subscribe: {0} : errors occured during subscribe, did not complete".format(subscription.item_names))
-        
-        return self._current_subscription_key, success
+        if not success:
+            # the server has no such table, so nothing will unsubscribe it
+            self._subscriptions.pop(subscription_key, None)
+
+        return subscription_key, success
 
     def unsubscribe(self, subcription_key):
         """Unregister the Subscription associated to the
@@ -364,32 +486,82 @@ class LSClient(object):
         else:
             self.logger.warning("No subscription key {0} found!".format(subcription_key))
 
-    def _forward_update_message(self, update_message):
+    def _forward_update_message(self, update_message, received=None):
         """Forwards the real time update to the relative
         Subscription instance for further dispatching to its listeners.
         """
-        self.logger.debug('igstream.py LSClient _forward_update_message')
-        self.logger.debug(
-            "igstream.py LSClient _forward_update_message: Received update message ---> <{0}>".format(update_message))
         tok = update_message.split(',', 1)
         table, item = int(tok[0]), tok[1]
         if table in self._subscriptions:
-            self._subscriptions[table].notifyupdate(item)
+            self._subscriptions[table].notifyupdate(item, received, self.server_lag)
         else:
             self.logger.warning("No subscription found!")
 
+    def _start_dispatch(self):
+        if self._dispatch_queue is not None and self._dispatch_thread is None:
+            self._dispatch_thread = threading.Thread(name="STREAM-DISPATCH-THREAD", target=self._dispatch)
+            self._dispatch_thread.setDaemon(True)
+            self._dispatch_thread.start()
+
+    def _dispatch(self):
+        while True:
+            message, received = self._dispatch_queue.get()
+            try:
+                self._forward_update_message(message, received)
+            except Exception:
+                self.logger.exception("igstream.py LSClient _dispatch: listener error")
+
+    def _adapt_frequency(self):
+        """Throttle adaptive subscriptions while the dispatch queue is backed up,
+        and open them up again once it has drained.
+        """
+        now = time.time()
+        if now - self._last_adapt < self.adapt_interval:
+            return
+        backlog = self._dispatch_queue.qsize()
+        if backlog >= self._dispatch_queue_size * self.adapt_high_watermark:
+            factor = 0.5
+        elif backlog <= self._dispatch_queue_size * self.adapt_low_watermark:
+            factor = 2.0
+        else:
+            return
+        self._last_adapt = now
+        for sub_key, subscription in list(self._subscriptions.items()):
+            frequency = subscription.adapt_frequency(factor)
+            if frequency is not None:
+                self.logger.info("igstream.py LSClient: dispatch backlog {0}, table {1} max frequency now {2}".format(
+                    backlog, sub_key, frequency))
+                # control requests block, so keep them off the stream thread
+                reconf = threading.Thread(target=self.reconfigure, args=(sub_key, frequency))
+                reconf.setDaemon(True)
+                reconf.start()
+
+    def reconfigure(self, subcription_key, max_frequency):
+        """Change the max frequency of a live subscription."""
+        self.logger.debug('igstream.py LSClient reconfigure')
+        try:
+            server_response = self._control({
+                "LS_table": subcription_key,
+                "LS_op": OP['RECONF'],
+                "LS_requested_max_frequency": str(max_frequency)
+            })
+            if server_response != OK_CMD:
+                self.logger.warning("Server error:" + server_response)
+        except Exception:
+            self.logger.warning("igstream.py LSClient reconfigure: {0} : errors occured during reconf".format(subcription_key))
+
     def _receive(self):
         self.logger.debug('igstream.py LSClient _receive')
         rebind = False
         receive = True
         while receive:
-            self.logger.debug("igstream.py LSClient _receive: Waiting for a new message")
             try:
                 message = self._read_from_stream()
-                self.logger.debug("igstream.py LSClient _receive: Received message ---> <{0}>".format(message))
+                received = time.monotonic()
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug("igstream.py LSClient _receive: Received message ---> <{0}>".format(message))
             except Exception:
-                self.logger.error("Communication error")
-                print(traceback.format_exc())
+                self.logger.exception("igstream.py LSClient _receive: Communication error")
                 message = None
 
             if message is None:
@@ -425,8 +597,12 @@ class LSClient(object):
             elif message.startswith("Preamble"):
                 # Skipping Preamble message, keep on receiving messages.
                 self.logger.debug("igstream.py LSClient _receive: Preamble")
+            elif self._dispatch_queue is not None:
+                self._dispatch_queue.put((message, received))
+                TRACKER.observe_backlog(self._dispatch_queue.qsize(), self._dispatch_queue_size)
+                self._adapt_frequency()
             else:
-                self._forward_update_message(message)
+                self._forward_update_message(message, received)
 
         if not rebind:
             self.logger.debug("igstream.py LSClient _receive: Closing connection")
@@ -444,7 +620,7 @@ class LSClient(object):
 
 class IGStream(object):
 
-    def __init__(self, igclient=None, loginresponse=None):
+    def __init__(self, igclient=None, loginresponse=None, dispatch_queue_size=0, record_path=None):
         from igclient import IGClient
 
         self.logger = logging.getLogger('IGStream')
@@ -460,16 +636,21 @@ class IGStream(object):
         self.loginresponse = loginresponse
         SERVER = self.loginresponse['lightstreamerEndpoint']
         ACCOUNTID = self.loginresponse['currentAccountId']
-        PASSWORD = 'CST-' + self.igclient.auth['CST'] + '|XST-' + self.igclient.auth['X-SECURITY-TOKEN']
+        PASSWORD = self.igclient.stream_password
+
+        self.recorder = None
+        if record_path:
+            from igreplay import StreamRecorder
+            self.recorder = StreamRecorder(record_path)
 
         # Establishing a new connection to Lightstreamer Server
         self.logger.debug("igstream.py IGStream: Starting connection")
-        self.lightstreamer_client = LSClient(SERVER, "", ACCOUNTID, PASSWORD)
+        self.lightstreamer_client = LSClient(SERVER, "", ACCOUNTID, PASSWORD, dispatch_queue_size, self.recorder)
         try:
             self.lightstreamer_client.connect()
-        except Exception as e:
-            print("Unable to connect to Lightstreamer Server: {}".format(SERVER))
-            print(traceback.format_exc())
+        except Exception:
+            self.logger.exception("igstream.py IGStream: Unable to connect to Lightstreamer Server: {0}".format(SERVER))
+            event('stream_connect_failed', "Unable to connect to Lightstreamer Server: {server}", server=SERVER)
             sys.exit(1)
 
     def fetch_one(self, subscription):
@@ -501,8 +682,8 @@ class IGStream(object):
                 else:
                     time.sleep(0.01)
 
-        # clean up
-        self.unsubscribe(sub_key)
+            # clean up
+            self.unsubscribe(sub_key)
 
         return results
 
@@ -525,3 +706,170 @@ class IGStream(object):
         self.logger.debug('igstream.py IGStream disconnect')
         # Disconnecting
         self.lightstreamer_client.disconnect()
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class ShardedIGStream(object):
+    """Spreads subscriptions over several Lightstreamer sessions.
+
+    TRADE and ACCOUNT items keep a dedicated session (shard 0). Other items
+    are hashed onto shards 1..max_sessions, each holding at most
+    items_per_session items, so an item lands on the same shard whenever
+    there is room for it. Every shard is its own LSClient with its own
+    stream thread, and callers see the same API as IGStream.
+    """
+
+    dedicated_prefixes = ('TRADE:', 'ACCOUNT:')
+
+    def __init__(self, igclient=None, loginresponse=None, items_per_session=40, max_sessions=4,
+                 dispatch_queue_size=0, record_path=None):
+        from igclient import IGClient
+
+        self.logger = logging.getLogger('ShardedIGStream')
+        self.logger.debug('igstream.py ShardedIGStream __init__')
+
+        if igclient == None or loginresponse == None:
+            igclient = IGClient()
+            loginresponse = igclient.session()
+        self.igclient = igclient
+        self.loginresponse = loginresponse
+        self.items_per_session = items_per_session
+        self.max_sessions = max_sessions
+        self.dispatch_queue_size = dispatch_queue_size
+        self.record_path = record_path
+        self._recorders = []
+
+        self._server = self.loginresponse['lightstreamerEndpoint']
+        self._accountid = self.loginresponse['currentAccountId']
+        self._password = self.igclient.stream_password
+
+        self._shards = {}  # shard -> LSClient
+        self._shard_load = {}  # shard -> number of subscribed items
+        self._assigned = {}  # item name -> [shard, reference count]
+        self._subscriptions = {}  # sub_key -> [(shard, shard sub_key, item names)]
+        self._current_subscription_key = 0
+        self._lock = threading.RLock()
+
+    def _client(self, shard):
+        if shard not in self._shards:
+            self.logger.debug("igstream.py ShardedIGStream: Starting connection for shard {0}".format(shard))
+            recorder = None
+            if self.record_path:
+                # one recording per session, e.g. session.lsrec.gz.0, session.lsrec.gz.1
+                from igreplay import StreamRecorder
+                recorder = StreamRecorder('{0}.{1}'.format(self.record_path, shard))
+                self._recorders.append(recorder)
+            client = LSClient(self._server, "", self._accountid, self._password, self.dispatch_queue_size, recorder)
+            client.connect()
+            self._shards[shard] = client
+        return self._shards[shard]
+
+    def shard_for(self, item):
+        """Pick the shard for an item name, without reserving it."""
+        if item in self._assigned:
+            return self._assigned[item][0]
+        if item.startswith(self.dedicated_prefixes):
+            return 0
+        start = zlib.crc32(item.encode('utf-8')) % self.max_sessions
+        for i in range(self.max_sessions):
+            shard = 1 + (start + i) % self.max_sessions
+            if self._shard_load.get(shard, 0) < self.items_per_session:
+                return shard
+        raise IOError("All {0} stream sessions are full".format(self.max_sessions))
+
+    def _acquire(self, shard, item):
+        self._shard_load[shard] = self._shard_load.get(shard, 0) + 1
+        self._assigned.setdefault(item, [shard, 0])[1] += 1
+
+    def _release(self, shard, item):
+        self._shard_load[shard] -= 1
+        self._assigned[item][1] -= 1
+        if self._assigned[item][1] == 0:
+            del self._assigned[item]
+
+    @staticmethod
+    def _forwarder(subscription, positions):
+        # map the shard's item positions back onto the caller's subscription
+        def forward(item_info):
+            item_info['pos'] = positions[item_info['pos'] - 1]
+            for on_item_update in subscription._listeners:
+                on_item_update(item_info)
+        return forward
+
+    def subscribe(self, subscription, listener):
+        self.logger.debug('igstream.py ShardedIGStream subscribe')
+        subscription.addlistener(listener)
+
+        with self._lock:
+            groups = {}
+            try:
+                for pos, item in enumerate(subscription.item_names, 1):
+                    shard = self.shard_for(item)
+                    groups.setdefault(shard, []).append((pos, item))
+                    self._acquire(shard, item)
+            except IOError:
+                for shard, members in groups.items():
+                    for _, item in members:
+                        self._release(shard, item)
+                raise
+
+            self._current_subscription_key += 1
+            sub_key = self._current_subscription_key
+            # every shard's items, with its sub_key once subscribed
+            children = self._subscriptions[sub_key] = [(shard, None, [item for _, item in members])
+                                                       for shard, members in sorted(groups.items())]
+
+            for i, (shard, _, items) in enumerate(children):
+                child = Subscription(mode=subscription.mode,
+                                     items=items,
+                                     fields=subscription.field_names,
+                                     adapter=subscription.adapter,
+                                     **subscription.options())
+                child.addlistener(self._forwarder(subscription, [pos for pos, _ in groups[shard]]))
+                try:
+                    child_key, child_success = self._client(shard).subscribe(child)
+                except Exception:
+                    self.logger.warning("igstream.py ShardedIGStream subscribe: unable to connect shard {0}".format(shard))
+                    child_key, child_success = None, False
+                if not child_success:
+                    # callers don't keep a failed sub_key, so nothing would unsubscribe the shards
+                    # that went through: drop them, and every item's place, now
+                    self.unsubscribe(sub_key)
+                    return sub_key, False
+                children[i] = (shard, child_key, items)
+
+        return sub_key, True
+
+    def unsubscribe(self, sub_key):
+        self.logger.debug('igstream.py ShardedIGStream unsubscribe')
+        with self._lock:
+            for shard, child_key, items in self._subscriptions.pop(sub_key, []):
+                if child_key is not None:
+                    self._shards[shard].unsubscribe(child_key)
+                for item in items:
+                    self._release(shard, item)
+
+    def fetch_one(self, subscription, timeout=10):
+        self.logger.debug('igstream.py ShardedIGStream fetch_one')
+        results = []
+        received = threading.Event()
+
+        def on_item_update(item_info):
+            results.append(item_info)
+            received.set()
+
+        sub_key, success = self.subscribe(subscription=subscription, listener=on_item_update)
+        if success:
+            received.wait(timeout)
+        self.unsubscribe(sub_key)
+
+        return results[0] if results else None
+
+    def disconnect(self):
+        self.logger.debug('igstream.py ShardedIGStream disconnect')
+        with self._lock:
+            for client in self._shards.values():
+                client.disconnect()
+            for recorder in self._recorders:
+                recorder.close()
@@ -0,0 +1,90 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The account balance as the ACCOUNT stream reports it, and checks that turn
+down orders IG would reject, before they cost a positions_otc and a confirms call.
+"""
+
+import threading
+import time
+
+import igstream
+from lib.dealing import violations
+
+ACCOUNT_FIELDS = ["PNL", "DEPOSIT", "AVAILABLE_CASH", "AVAILABLE_TO_DEAL", "FUNDS", "MARGIN", "EQUITY"]
+
+
+class AccountMirror(object):
+
+    def __init__(self):
+        self.values = {}
+        self.updated_at = None
+        self._lock = threading.Lock()
+
+    def subscription(self, account_id):
+        return igstream.Subscription(
+            mode="MERGE",
+            items=["ACCOUNT:{0}".format(account_id)],
+            fields=ACCOUNT_FIELDS)
+
+    def on_update(self, item_info):
+        values = {}
+        for field, value in item_info['values'].items():
+            try:
+                values[field] = float(value)
+            except (TypeError, ValueError):
+                pass
+        with self._lock:
+            self.values.update(values)
+            self.updated_at = time.time()
+
+    def get(self, field):
+        """:return: the latest value, or None before the stream has sent one"""
+        with self._lock:
+            return self.values.get(field)
+
+
+def margin_needed(size, price, margin_factor, margin_factor_unit='PERCENTAGE', stop_distance=None, guaranteed=False):
+    """
+    The least margin IG could ask for, so the check never turns down an order that might go through
+    :return: margin, or None if the instrument's margin factor is unknown
+    """
+    if margin_factor is None:
+        return None
+    if margin_factor_unit == 'PERCENTAGE':
+        margin = size * price * float(margin_factor) / 100
+    else:
+        margin = size * float(margin_factor)
+    if guaranteed and stop_distance:
+        # a guaranteed stop caps the margin at what the stop can lose
+        margin = min(margin, size * stop_distance)
+    return margin
+
+
+def pretrade_check(order, rules, price, guaranteed, available=None, margin=None, market_state=None):
+    """
+    :param order: positions_otc data, after handleDealingRules
+    :param rules: the market's lib.dealing.CompiledRules
+    :param price: current price
+    :param guaranteed: whether the stop will be guaranteed
+    :param available: AVAILABLE_TO_DEAL, None to skip the funds check
+    :param margin: margin_needed for the order, None to skip the funds check
+    :param market_state: MARKET_STATE from the stream, None if unknown
+    :return: list of the reasons IG would give for rejecting the order, empty if it should go through
+    """
+    reasons = []
+    if market_state is not None and market_state != 'TRADEABLE':
+        reasons.append('MARKET_OFFLINE')
+    reasons.extend(violations(order, rules, price, guaranteed))
+    if available is not None and margin is not None and margin > available:
+        reasons.append('INSUFFICIENT_FUNDS')
+    return reasons
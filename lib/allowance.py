@@ -0,0 +1,151 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Spend the weekly historical data allowance so it lasts until it resets.
+
+prices() responses report remainingAllowance and allowanceExpiry (seconds to
+the reset). AllowancePlanner tracks what we spend, projects that rate to the
+reset, and answers whether a fetch of n points should go ahead:
+
+    NORMAL   spend as needed, cached bars are refreshed after a minute
+    FRUGAL   the projection runs out before the reset: cached bars are only
+             refreshed once a new bar has opened, and only candidates worth
+             at least the median of recent ones get fresh points
+    OFFLINE  down to the reserve: cached bars only
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import numpy as np
+
+NORMAL = 'NORMAL'
+FRUGAL = 'FRUGAL'
+OFFLINE = 'OFFLINE'
+
+
+def candidate_value(change_pct, bid, offer, change_low, change_high, max_spread):
+    """
+    How clearly an epic passes the screening thresholds, works on arrays too
+    :return: 0 at a threshold, up to 1 mid band with a spread well inside max_spread (negative)
+    """
+    change = np.abs(change_pct)
+    band = max(change_high - change_low, 1e-9)
+    inside = np.clip(np.minimum(change - change_low, change_high - change) / (band / 2), 0, 1)
+    spread_room = np.clip(((bid - offer) - max_spread) / np.maximum(np.abs(max_spread), 1e-9), 0, 1)
+    return inside * (0.5 + 0.5 * spread_room)
+
+
+class AllowancePlanner(object):
+
+    def __init__(self, reserve=500, window=6 * 3600, fresh_age=60):
+        """
+        :param reserve: points never spent, kept for the odd essential fetch after a restart
+        :param window: seconds of spending the rate is measured over
+        :param fresh_age: seconds cached bars are good for in NORMAL mode
+        """
+        self.logger = logging.getLogger('AllowancePlanner')
+        self.logger.debug('allowance.py AllowancePlanner __init__')
+        self.reserve = reserve
+        self.window = window
+        self.fresh_age = fresh_age
+
+        self.remaining = None  # unknown until the first prices() call
+        self.expires_at = None
+        self._spent = collections.deque()  # (time, points)
+        self._values = collections.deque(maxlen=50)
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._mode = NORMAL
+
+    def update(self, allowance, points):
+        """
+        Note a prices() call
+        :param allowance: the response's 'allowance', or None if it had none
+        :param points: points asked for
+        """
+        now = time.time()
+        with self._lock:
+            self._spent.append((now, points))
+            if allowance:
+                self.remaining = int(allowance['remainingAllowance'])
+                self.expires_at = now + int(allowance['allowanceExpiry'])
+            elif self.remaining is not None:
+                self.remaining -= points
+        self._log_mode()
+
+    def exhausted(self):
+        """The API refused a prices() call for lack of allowance."""
+        with self._lock:
+            self.remaining = 0
+        self._log_mode()
+
+    def rate(self, now=None):
+        """Points per second over the window."""
+        now = now or time.time()
+        with self._lock:
+            while self._spent and self._spent[0][0] < now - self.window:
+                self._spent.popleft()
+            spent = sum(points for t, points in self._spent)
+        return spent / max(min(self.window, now - self._started), 60)
+
+    def projected(self, now=None):
+        """Points we'll want before the allowance resets, at the current rate."""
+        now = now or time.time()
+        if self.expires_at is None:
+            return 0
+        return self.rate(now) * max(0, self.expires_at - now)
+
+    def mode(self, now=None):
+        now = now or time.time()
+        if self.remaining is None:
+            return NORMAL
+        if self.expires_at is not None and now >= self.expires_at:
+            return NORMAL  # reset by now, the next response will tell
+        if self.remaining <= self.reserve:
+            return OFFLINE
+        if self.projected(now) > self.remaining - self.reserve:
+            return FRUGAL
+        return NORMAL
+
+    def _log_mode(self):
+        mode = self.mode()
+        if mode != self._mode:
+            self.logger.warning('allowance.py AllowancePlanner: {0} -> {1}, {2} points left'.format(
+                self._mode, mode, self.remaining))
+            self._mode = mode
+
+    def max_age(self, seconds):
+        """How old cached bars of a resolution (in seconds) may be in the current mode."""
+        mode = self.mode()
+        if mode == NORMAL:
+            return min(self.fresh_age, seconds)
+        if mode == FRUGAL:
+            return seconds
+        return float('inf')
+
+    def allow(self, points, value=1.0):
+        """
+        Should a fetch of points go ahead
+        :param value: candidate_value of the epic it's for
+        """
+        mode = self.mode()
+        with self._lock:
+            self._values.append(value)
+            floor = float(np.median(self._values))
+            if mode == OFFLINE or (self.remaining is not None and self.remaining - points < self.reserve):
+                return False
+            if mode == FRUGAL:
+                return value >= floor
+        return True
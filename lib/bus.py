@@ -0,0 +1,428 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Market data shared between the processes on one host through a memory mapped file.
+
+marketbus.py owns the MARKET and CHART subscriptions and writes them with a
+MarketBus; any number of processes map the same file with a BusReader and
+read prices without a stream session of their own:
+
+    reader = BusReader('/dev/shm/igtrader-marketbus')
+    reader.quote('CS.D.EURUSD.TODAY.IP')      # (bid, offer)
+    reader.bars('CS.D.EURUSD.TODAY.IP')       # the latest bars, oldest first
+    reader.follow(screener.on_update)         # MARKET stream style updates
+    reader.follow(screener.on_update, bars_listener=candles.on_bars)  # and the bars as they change
+
+The file holds a header, the epic ids, a board of one row per epic with its
+latest MARKET fields, and a ring of the latest bars per epic. reader.board
+and reader.bar_rings are numpy views straight onto the mapping, nothing is
+copied; a row can change while it's read through them. quote(), row(),
+snapshot() and bars() copy instead, checking each row's sequence number: the
+writer makes it odd before changing the row and even again after, and a
+copy taken while it was odd or that saw it change is taken again. Nothing
+ever waits for a lock. This relies on stores becoming visible in order,
+as they do on x86.
+
+The writer stamps a heartbeat every second. A reader whose writer stopped
+notices it going stale, and reopens the file once a new writer has
+replaced it.
+"""
+
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b'IGBUS\x00\x00\x01'
+VERSION = 1
+
+# magic, version, epics, bars per epic, writer pid, CHART scale, created, heartbeat
+HEADER = struct.Struct('<8sIIII16sdd')
+HEADER_SIZE = 64
+HEARTBEAT_OFFSET = 48
+EPIC_ID_SIZE = 40
+
+MARKET_FIELDS = ["MID_OPEN", "HIGH", "LOW", "CHANGE", "CHANGE_PCT", "UPDATE_TIME", "MARKET_DELAY", "MARKET_STATE",
+                 "BID", "OFFER"]
+STATES = ('TRADEABLE', 'EDIT', 'CLOSED', 'OFFLINE', 'SUSPENDED', 'AUCTION', 'AUCTION_NO_EDIT')
+
+BOARD_DTYPE = np.dtype([('seq', '<u8'), ('updated', '<f8'), ('bid', '<f8'), ('offer', '<f8'), ('mid_open', '<f8'),
+                        ('high', '<f8'), ('low', '<f8'), ('change', '<f8'), ('change_pct', '<f8'),
+                        ('update_time', '<f8'), ('delay', '<f8'), ('state', '<i8')])
+BAR_DTYPE = np.dtype([('time', '<f8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8'),
+                      ('volume', '<f8')])
+
+
+def default_path():
+    shm = '/dev/shm'
+    return os.path.join(shm if os.path.isdir(shm) else tempfile.gettempdir(), 'igtrader-marketbus')
+
+
+def _rings_dtype(n_bars):
+    return np.dtype([('seq', '<u8'), ('count', '<u8'), ('bars', BAR_DTYPE, (n_bars,))])
+
+
+def _round_up(n, to=64):
+    return (n + to - 1) // to * to
+
+
+def _layout(n_epics, n_bars):
+    """:return: offsets of the epic ids, board and bar rings, and the file size"""
+    epics = HEADER_SIZE
+    board = epics + _round_up(n_epics * EPIC_ID_SIZE)
+    rings = board + _round_up(n_epics * BOARD_DTYPE.itemsize)
+    return epics, board, rings, rings + _round_up(n_epics * _rings_dtype(n_bars).itemsize)
+
+
+def _float(value):
+    if value is None or value == '':
+        return np.nan
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def _seconds(update_time):
+    # HH:MM:SS -> seconds into the day
+    if not update_time:
+        return np.nan
+    h, m, s = update_time.split(':')
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+def _str(value):
+    return None if math.isnan(value) else repr(float(value))
+
+
+class MarketBus(object):
+    """The writing side, one per file, see the module docstring."""
+
+    def __init__(self, epic_ids, path=None, n_bars=120, scale='1MINUTE'):
+        """
+        :param epic_ids: epics on the board, in order
+        :param path: file to map, replaced if it exists, default_path() if None
+        :param n_bars: bars kept per epic
+        :param scale: the CHART scale of the bars
+        """
+        self.logger = logging.getLogger('MarketBus')
+        self.logger.debug('bus.py MarketBus __init__')
+        self.path = path or default_path()
+        self.epic_ids = list(epic_ids)
+        self.n_bars = n_bars
+        self.scale = scale
+        self._index = dict((epic_id, i) for i, epic_id in enumerate(self.epic_ids))
+        self._lock = threading.Lock()
+        n = len(self.epic_ids)
+        epics, board, rings, size = _layout(n, n_bars)
+
+        # built aside and renamed, so readers only ever map a whole file
+        tmp = self.path + '.tmp'
+        fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        for i, epic_id in enumerate(self.epic_ids):
+            self._mm[epics + i * EPIC_ID_SIZE:epics + (i + 1) * EPIC_ID_SIZE] = \
+                epic_id.encode('ascii').ljust(EPIC_ID_SIZE, b'\x00')
+        self.board = np.frombuffer(self._mm, BOARD_DTYPE, n, board)
+        self.rings = np.frombuffer(self._mm, _rings_dtype(n_bars), n, rings)
+        for field in BOARD_DTYPE.names:
+            if field not in ('seq', 'state'):
+                self.board[field] = np.nan
+        self.board['state'] = -1
+        self.rings['bars']['time'] = np.nan
+        self._heartbeat = np.frombuffer(self._mm, '<f8', 1, HEARTBEAT_OFFSET)
+        now = time.time()
+        self._mm[0:HEADER.size] = HEADER.pack(MAGIC, VERSION, n, n_bars, os.getpid(), scale.encode('ascii'), now, now)
+        self._mm.flush()
+        os.replace(tmp, self.path)
+
+    def heartbeat(self):
+        self._heartbeat[0] = time.time()
+
+    def on_market(self, item_info):
+        """MARKET stream listener, with MARKET_FIELDS."""
+        i = self._index.get(item_info['name'].split(':', 1)[1])
+        if i is None:
+            return
+        values = item_info['values']
+        state = values.get('MARKET_STATE')
+        row = (time.time(), _float(values.get('BID')), _float(values.get('OFFER')),
+               _float(values.get('MID_OPEN')), _float(values.get('HIGH')), _float(values.get('LOW')),
+               _float(values.get('CHANGE')), _float(values.get('CHANGE_PCT')), _seconds(values.get('UPDATE_TIME')),
+               _float(values.get('MARKET_DELAY')), STATES.index(state) if state in STATES else -1)
+        seq = self.board['seq']
+        with self._lock:
+            s = int(seq[i])
+            seq[i] = s + 1
+            self.board[i] = (s + 1,) + row
+            seq[i] = s + 2
+
+    def on_chart(self, item_info):
+        """CHART:{epic}:{scale} stream listener, with lib.candles.FIELDS."""
+        _, epic_id, scale = item_info['name'].split(':')
+        i = self._index.get(epic_id)
+        values = item_info['values']
+        if i is None or scale != self.scale or not values.get('UTM') or not values.get('BID_CLOSE'):
+            return
+        bar = (int(values['UTM']) / 1000.0, _float(values.get('BID_OPEN')), _float(values.get('BID_HIGH')),
+               _float(values.get('BID_LOW')), _float(values.get('BID_CLOSE')), _float(values.get('LTV') or 0))
+        seq = self.rings['seq']
+        count = self.rings['count']
+        bars = self.rings['bars']
+        with self._lock:
+            s = int(seq[i])
+            seq[i] = s + 1
+            n = int(count[i])
+            if n and bars[i, (n - 1) % self.n_bars]['time'] == bar[0]:
+                bars[i, (n - 1) % self.n_bars] = bar
+            else:
+                bars[i, n % self.n_bars] = bar
+                count[i] = n + 1
+            seq[i] = s + 2
+
+    def run_heartbeat(self, stop, interval=1.0):
+        """Stamp the heartbeat every interval seconds until the threading.Event stop is set."""
+        while not stop.wait(interval):
+            self.heartbeat()
+
+    def close(self):
+        # readers see the heartbeat go stale
+        self._mm.flush()
+
+
+class BusReader(object):
+    """The reading side, any number per file, see the module docstring."""
+
+    def __init__(self, path=None, max_age=5.0):
+        """
+        :param path: file a MarketBus writes, default_path() if None
+        :param max_age: seconds without a heartbeat before the writer counts as gone
+        """
+        self.logger = logging.getLogger('BusReader')
+        self.logger.debug('bus.py BusReader __init__')
+        self.path = path or default_path()
+        self.max_age = max_age
+        self._open()
+
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n, n_bars, pid, scale, created, _ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('bus.py BusReader: {0} is not a version {1} market bus'.format(self.path, VERSION))
+        epics, board, rings, _ = _layout(n, n_bars)
+        self._mm = mm
+        self.epic_ids = [mm[epics + i * EPIC_ID_SIZE:epics + (i + 1) * EPIC_ID_SIZE].rstrip(b'\x00').decode('ascii')
+                         for i in range(n)]
+        self._index = dict((epic_id, i) for i, epic_id in enumerate(self.epic_ids))
+        self.n_bars = n_bars
+        self.scale = scale.rstrip(b'\x00').decode('ascii')
+        self.writer_pid = pid
+        self.board = np.frombuffer(mm, BOARD_DTYPE, n, board)
+        self.bar_rings = np.frombuffer(mm, _rings_dtype(n_bars), n, rings)
+        self._heartbeat = np.frombuffer(mm, '<f8', 1, HEARTBEAT_OFFSET)
+
+    def age(self):
+        """Seconds since the writer's last heartbeat."""
+        return time.time() - float(self._heartbeat[0])
+
+    def alive(self):
+        """Whether the writer is still there, reopening the file if a new one replaced it."""
+        if self.age() <= self.max_age:
+            return True
+        try:
+            if os.stat(self.path).st_ino != self._inode:
+                self._open()
+                self.logger.info('bus.py BusReader: reopened {0}, writer pid {1}'.format(self.path, self.writer_pid))
+        except (IOError, OSError, ValueError):
+            return False
+        return self.age() <= self.max_age
+
+    def __contains__(self, epic_id):
+        return epic_id in self._index
+
+    @staticmethod
+    def _consistent(seq, i, read):
+        while True:
+            s = seq[i]
+            if not s & 1:
+                value = read()
+                if seq[i] == s:
+                    return value
+            time.sleep(0)
+
+    def row(self, epic_id):
+        """:return: a copy of the epic's board row, None if it isn't on the board"""
+        i = self._index.get(epic_id)
+        if i is None:
+            return None
+        return self._consistent(self.board['seq'], i, lambda: self.board[i].copy())
+
+    def quote(self, epic_id):
+        """:return: (bid, offer), None if there's no price yet or the writer is gone"""
+        row = self.row(epic_id)
+        if row is None or not self.alive() or math.isnan(row['bid']) or math.isnan(row['offer']):
+            return None
+        return float(row['bid']), float(row['offer'])
+
+    def latest(self, epic_id):
+        """:return: the epic's row as a MARKET stream update, None if it has no price or the writer is gone"""
+        row = self.row(epic_id)
+        if row is None or not self.alive() or math.isnan(row['bid']) or math.isnan(row['offer']):
+            return None
+        return self.item_info(self._index[epic_id], row)
+
+    def snapshot(self):
+        """:return: a copy of the whole board, every row as the writer left it"""
+        seq = self.board['seq']
+        before = seq.copy()
+        board = self.board.copy()
+        torn = np.flatnonzero((board['seq'] != before) | (seq != before) | (before & 1).astype(bool))
+        for i in torn:
+            board[i] = self._consistent(seq, i, lambda: self.board[i].copy())
+        return board
+
+    def bars(self, epic_id):
+        """:return: a copy of the epic's bars, oldest first, None if it isn't on the board"""
+        i = self._index.get(epic_id)
+        if i is None:
+            return None
+        return self._ring(i)[1]
+
+    def _ring(self, i):
+        """:return: (bars ever written, a copy of the ring's bars oldest first) of row i"""
+        count, bars = self._consistent(self.bar_rings['seq'], i,
+                                       lambda: (int(self.bar_rings['count'][i]), self.bar_rings['bars'][i].copy()))
+        if count < self.n_bars:
+            return count, bars[:count]
+        return count, np.roll(bars, -(count % self.n_bars))
+
+    def item_info(self, i, row):
+        """A board row as a MARKET stream update, 'received' on this process's time.monotonic() clock."""
+        state = int(row['state'])
+        update_time = row['update_time']
+        values = {'BID': _str(row['bid']), 'OFFER': _str(row['offer']), 'MID_OPEN': _str(row['mid_open']),
+                  'HIGH': _str(row['high']), 'LOW': _str(row['low']), 'CHANGE': _str(row['change']),
+                  'CHANGE_PCT': _str(row['change_pct']),
+                  'MARKET_DELAY': None if math.isnan(row['delay']) else str(int(row['delay'])),
+                  'MARKET_STATE': STATES[state] if 0 <= state < len(STATES) else None,
+                  'UPDATE_TIME': None if math.isnan(update_time) else '{0:02d}:{1:02d}:{2:02d}'.format(
+                      int(update_time // 3600), int(update_time // 60 % 60), int(update_time % 60))}
+        return {'pos': i + 1, 'name': 'MARKET:' + self.epic_ids[i], 'values': values,
+                'received': time.monotonic() - (time.time() - float(row['updated']))}
+
+    def follow(self, listener, epic_ids=None, interval=0.05, bars_listener=None, state_listener=None):
+        """
+        Call listener with a MARKET stream style update for each board row that changes, on a thread of its own
+        :param epic_ids: just these, every epic on the board if None
+        :param bars_listener: callable(epic_id, scale, bars) with the bars that changed, oldest first, if given
+        :param state_listener: callable(alive) when the writer goes stale, False, and when it's back, True
+        :return: BusFollower, stop() it to stop
+        """
+        follower = BusFollower(self, listener, epic_ids, interval, bars_listener, state_listener)
+        follower.start()
+        return follower
+
+
+class BusFollower(object):
+
+    def __init__(self, reader, listener, epic_ids=None, interval=0.05, bars_listener=None, state_listener=None):
+        self.logger = logging.getLogger('BusFollower')
+        self.reader = reader
+        self.listener = listener
+        self.epic_ids = epic_ids
+        self.interval = interval
+        self.bars_listener = bars_listener
+        self.state_listener = state_listener
+        self.stale = False
+        self._stop = threading.Event()
+
+    def _rows(self):
+        if self.epic_ids is None:
+            return np.arange(len(self.reader.epic_ids))
+        return np.array([self.reader._index[e] for e in self.epic_ids if e in self.reader], dtype=int)
+
+    def _state(self, alive):
+        self.stale = not alive
+        if self.state_listener is not None:
+            try:
+                self.state_listener(alive)
+            except Exception:
+                self.logger.exception('bus.py BusFollower: state listener failed')
+
+    def _bars(self, rows, seen_bars, counts):
+        rings = self.reader.bar_rings
+        for k in np.flatnonzero(rings['seq'][rows] != seen_bars):
+            i = rows[k]
+            seen_bars[k] = rings['seq'][i]
+            count, bars = self.reader._ring(i)
+            # the bars added since last time, and the one before them that may have been updated
+            new = bars[-min(len(bars), count - int(counts[k]) + 1):]
+            counts[k] = count
+            if len(new):
+                try:
+                    self.bars_listener(self.reader.epic_ids[i], self.reader.scale, new)
+                except Exception:
+                    self.logger.exception('bus.py BusFollower: bars listener failed')
+
+    def _run(self):
+        rows = self._rows()
+        inode = self.reader._inode
+        seen = np.zeros(len(rows), dtype='<u8')
+        seen_bars = np.zeros(len(rows), dtype='<u8')
+        counts = np.zeros(len(rows), dtype='<u8')
+        while not self._stop.wait(self.interval):
+            if not self.reader.alive():
+                if not self.stale:
+                    self.logger.warning('bus.py BusFollower: no heartbeat from {0} for {1:.0f}s'.format(
+                        self.reader.path, self.reader.age()))
+                    self._state(False)
+                continue
+            if self.stale:
+                self.logger.info('bus.py BusFollower: {0} is back'.format(self.reader.path))
+                self._state(True)
+            if self.reader._inode != inode:
+                # a new writer, whose sequence numbers start over
+                rows, inode = self._rows(), self.reader._inode
+                seen = np.zeros(len(rows), dtype='<u8')
+                seen_bars = np.zeros(len(rows), dtype='<u8')
+                counts = np.zeros(len(rows), dtype='<u8')
+            seq = self.reader.board['seq'][rows]
+            for k in np.flatnonzero(seq != seen):
+                i = rows[k]
+                row = self.reader._consistent(self.reader.board['seq'], i, lambda: self.reader.board[i].copy())
+                seen[k] = row['seq']
+                try:
+                    self.listener(self.reader.item_info(i, row))
+                except Exception:
+                    self.logger.exception('bus.py BusFollower: listener failed')
+            if self.bars_listener is not None:
+                self._bars(rows, seen_bars, counts)
+
+    def start(self):
+        thread = threading.Thread(name="MARKETBUS-THREAD", target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,90 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Price bars built from CHART:{epic}:{scale} stream items.
+
+Each update carries the bar's start time (UTM) and its bid open, high, low and
+close so far; CONS_END is 1 on the update that closes it. Bars go into a
+lib.history.PriceHistory, where they keep REST-fetched bars current, so
+fetch_history finds them fresh and spends neither API calls nor allowance.
+on_bars takes the same bars from lib.bus instead, where marketbus.py streams them.
+"""
+
+import logging
+import threading
+
+import igstream
+
+# CHART scale -> prices() resolution
+SCALES = {'SECOND': 'SECOND', '1MINUTE': 'MINUTE', '5MINUTE': 'MINUTE_5', 'HOUR': 'HOUR'}
+
+FIELDS = ["UTM", "BID_OPEN", "BID_HIGH", "BID_LOW", "BID_CLOSE", "LTV", "CONS_END", "DAY_HIGH", "DAY_LOW"]
+
+
+class CandleBuilder(object):
+
+    def __init__(self, history):
+        """
+        :param history: lib.history.PriceHistory the bars go into
+        """
+        self.logger = logging.getLogger('CandleBuilder')
+        self.logger.debug('candles.py CandleBuilder __init__')
+        self.history = history
+        self.resolutions = {}  # epic_id -> set of resolutions streamed
+        self.day_high_low = {}  # epic_id -> (DAY_HIGH, DAY_LOW)
+        self.completed = 0  # bars closed by CONS_END
+        self._closed = set()  # (epic_id, resolution, bar time) already closed
+        self._lock = threading.Lock()
+
+    def subscription(self, epic_ids, scale):
+        if scale not in SCALES:
+            raise ValueError('no CHART scale {0}, one of {1}'.format(scale, ', '.join(sorted(SCALES))))
+        return igstream.Subscription.from_preset(
+            'candles',
+            mode="MERGE",
+            items=["CHART:{0}:{1}".format(epic_id, scale) for epic_id in epic_ids],
+            fields=FIELDS)
+
+    def streams(self, epic_id, resolution):
+        return resolution in self.resolutions.get(epic_id, ())
+
+    def on_update(self, item_info):
+        _, epic_id, scale = item_info['name'].split(':')
+        resolution = SCALES[scale]
+        values = item_info['values']
+        if values.get('DAY_HIGH') and values.get('DAY_LOW'):
+            self.day_high_low[epic_id] = (float(values['DAY_HIGH']), float(values['DAY_LOW']))
+        if not values.get('UTM') or not values.get('BID_CLOSE'):
+            return  # market closed, no bar yet
+        bar_time = int(values['UTM']) / 1000.0
+        key = (epic_id, resolution, bar_time)
+        with self._lock:
+            self.resolutions.setdefault(epic_id, set()).add(resolution)
+            if key in self._closed:
+                return  # late update of a closed bar
+            if values.get('CONS_END') == '1':
+                self._closed.add(key)
+                self.completed += 1
+                if len(self._closed) > 10000:
+                    self._closed = set(k for k in self._closed if k[2] >= bar_time)
+        self.history.update_bar(epic_id, resolution, bar_time,
+                                float(values['BID_OPEN']), float(values['BID_HIGH']), float(values['BID_LOW']),
+                                float(values['BID_CLOSE']), float(values.get('LTV') or 0))
+
+    def on_bars(self, epic_id, scale, bars):
+        """lib.bus.BusFollower bars listener: bars of the CHART scale, oldest first."""
+        resolution = SCALES.get(scale)
+        if resolution is None:
+            return
+        with self._lock:
+            self.resolutions.setdefault(epic_id, set()).add(resolution)
+        self.history.update_bars(epic_id, resolution, bars)
@@ -0,0 +1,180 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Instrument details that rarely change, kept on disk between runs.
+
+Per epic: marketId, name, lotSize, marginFactor and its unit, dealingRules,
+openingHours, the smallest spread seen (offer - bid, in points) and when the
+entry was last fetched.
+Entries come from markets() responses. Missing ones are fetched on first use;
+stale ones are served as they are and refreshed on a background thread.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+CATALOGUE_VERSION = 2
+
+
+class InstrumentCatalogue(object):
+
+    def __init__(self, path, fetch, max_age=86400, pause=0, save_interval=30, refresh_fetch=None):
+        """
+        :param path: json file, '' or None keeps the catalogue in memory only
+        :param fetch: callable(epic_id) returning a markets() response, for epics get() hasn't seen
+        :param refresh_fetch: fetch for the background thread, e.g. at a lower priority, fetch if None
+        :param max_age: seconds before an entry is refreshed
+        :param pause: seconds between background fetches, 0 leaves the pacing to fetch's rate limit
+        :param save_interval: seconds between saves while entries change
+        """
+        self.logger = logging.getLogger('InstrumentCatalogue')
+        self.logger.debug('catalogue.py InstrumentCatalogue __init__')
+        self.path = path
+        self.fetch = fetch
+        self.refresh_fetch = refresh_fetch or fetch
+        self.max_age = max_age
+        self.pause = pause
+        self.save_interval = save_interval
+
+        self._instruments = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._pending = set()
+        self._refresh_queue = queue.Queue()
+        self._thread = None
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                d = json.load(f)
+            if d.get('version') != CATALOGUE_VERSION:
+                self.logger.info('catalogue.py InstrumentCatalogue load: old format, starting afresh')
+                return
+            with self._lock:
+                self._instruments = d['instruments']
+            self.logger.info('catalogue.py InstrumentCatalogue load: {0} instruments'.format(len(self._instruments)))
+        except (IOError, ValueError, KeyError) as e:
+            self.logger.warning('catalogue.py InstrumentCatalogue load: ignoring {0}, {1}'.format(self.path, e))
+
+    def save(self):
+        """Write the catalogue if it changed, replacing the file atomically."""
+        with self._lock:
+            if not self.path or not self._dirty:
+                return
+            data = json.dumps({'version': CATALOGUE_VERSION, 'instruments': self._instruments},
+                              indent=1, sort_keys=True)
+            self._dirty = False
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+    def update(self, epic_id, market):
+        """Store the instrument details of a markets() response."""
+        instrument = market['instrument']
+        entry = {'marketId': instrument['marketId'],
+                 'name': instrument.get('name'),
+                 'lotSize': instrument.get('lotSize'),
+                 'marginFactor': instrument.get('marginFactor'),
+                 'marginFactorUnit': instrument.get('marginFactorUnit'),
+                 'openingHours': instrument.get('openingHours'),
+                 'dealingRules': market.get('dealingRules'),
+                 'updated': time.time()}
+        with self._lock:
+            entry['minSpread'] = self._instruments.get(epic_id, {}).get('minSpread')
+            self._instruments[epic_id] = entry
+            self._pending.discard(epic_id)
+            self._dirty = True
+        snapshot = market.get('snapshot') or {}
+        if snapshot.get('bid') is not None and snapshot.get('offer') is not None:
+            self.observe_spread(epic_id, float(snapshot['offer']) - float(snapshot['bid']))
+        return entry
+
+    def observe_spread(self, epic_id, spread):
+        """Keep the smallest offer - bid seen for an epic already in the catalogue."""
+        with self._lock:
+            entry = self._instruments.get(epic_id)
+            if entry is not None and spread > 0 and (entry['minSpread'] is None or spread < entry['minSpread']):
+                entry['minSpread'] = spread
+                self._dirty = True
+
+    def _stale(self, entry, now):
+        return now - entry['updated'] > self.max_age
+
+    def get(self, epic_id):
+        """
+        :return: the catalogue entry, fetching it first if the epic is new
+        """
+        with self._lock:
+            entry = self._instruments.get(epic_id)
+        if entry is None:
+            return self.update(epic_id, self.fetch(epic_id))
+        if self._stale(entry, time.time()):
+            self.refresh([epic_id])
+        return entry
+
+    def market_id(self, epic_id):
+        return self.get(epic_id)['marketId']
+
+    def dealing_rules(self, epic_id):
+        return self.get(epic_id)['dealingRules']
+
+    def refresh(self, epic_ids):
+        """Queue missing or stale epics for the background thread."""
+        now = time.time()
+        with self._lock:
+            for epic_id in epic_ids:
+                entry = self._instruments.get(epic_id)
+                if epic_id not in self._pending and (entry is None or self._stale(entry, now)):
+                    self._pending.add(epic_id)
+                    self._refresh_queue.put(epic_id)
+
+    def _run(self):
+        last_save = time.time()
+        while True:
+            try:
+                epic_id = self._refresh_queue.get(timeout=self.save_interval)
+            except queue.Empty:
+                epic_id = None
+            if epic_id is not None:
+                try:
+                    self.update(epic_id, self.refresh_fetch(epic_id))
+                except Exception:
+                    self.logger.warning('catalogue.py InstrumentCatalogue _run: could not fetch {0}'.format(epic_id))
+                    with self._lock:
+                        self._pending.discard(epic_id)
+                if self.pause:
+                    time.sleep(self.pause)
+            if time.time() - last_save >= self.save_interval or self._refresh_queue.empty():
+                self.save()
+                last_save = time.time()
+
+    def start(self):
+        self.logger.debug('catalogue.py InstrumentCatalogue start')
+        if self._thread is None:
+            self._thread = threading.Thread(name="CATALOGUE-THREAD", target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+            # the thread dies with the process, so save what it had so far
+            atexit.register(self.save)
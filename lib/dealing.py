@@ -0,0 +1,168 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""A market's dealingRules as numbers, to fit orders to them without asking the API.
+
+compile_rules() turns a markets() 'dealingRules' dict into a CompiledRules of
+arrays, one column per rule in RULES, with PERCENTAGE rules flagged so they can
+be scaled by price. Rows of several epics stack into one CompiledRules, and
+adjust_orders()/check_orders() then fit or check a whole batch of orders at
+once; adjust_order()/violations() do the same for one positions_otc payload.
+
+Orders are fitted as handleDealingRules does: the size is raised to
+minDealSize, and the stop and limit distances are moved inside the minimum
+and maxStopOrLimitDistance. minStepDistance is the smallest trailing stop
+increment, an order asking for less is left to fail.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+RULES = ('minDealSize', 'minStepDistance', 'minNormalStopOrLimitDistance', 'minControlledRiskStopDistance',
+         'maxStopOrLimitDistance')
+MIN_SIZE, MIN_STEP, MIN_DISTANCE, MIN_GUARANTEED_DISTANCE, MAX_DISTANCE = range(len(RULES))
+
+CompiledRules = collections.namedtuple('CompiledRules', ['values', 'percent', 'market_orders', 'trailing_stops'])
+
+
+def compile_rules(dealing_rules):
+    """
+    :param dealing_rules: a markets() response's 'dealingRules'
+    :return: CompiledRules, missing rules are nan and never apply
+    """
+    values = np.full(len(RULES), np.nan)
+    percent = np.zeros(len(RULES), dtype=bool)
+    for i, name in enumerate(RULES):
+        rule = dealing_rules.get(name)
+        if not rule or rule.get('value') is None:
+            continue
+        if name == 'minDealSize' and rule.get('unit') == 'PERCENTAGE':
+            continue  # a percentage of what? not something we can check
+        values[i] = float(rule['value'])
+        percent[i] = rule.get('unit') == 'PERCENTAGE'
+    return CompiledRules(values, percent,
+                         np.bool_(dealing_rules.get('marketOrderPreference') != 'NOT_AVAILABLE'),
+                         np.bool_(dealing_rules.get('trailingStopsPreference') != 'NOT_AVAILABLE'))
+
+
+def stack_rules(rules):
+    """One CompiledRules with a row per epic."""
+    return CompiledRules(*[np.stack(column) for column in zip(*rules)])
+
+
+def limits(rules, price):
+    """Each rule in points at price, rows × RULES for stacked rules and an array of prices."""
+    price = np.asarray(price, dtype=float)[..., None]
+    return np.where(rules.percent, price / 100 * rules.values, rules.values)
+
+
+def _clip(distance, low, high):
+    # nan distances (none asked for) stay nan, nan limits don't apply
+    return np.where(np.isnan(distance), distance, np.fmin(np.fmax(distance, low), high))
+
+
+def adjust_orders(rules, price, size, stop, limit, guaranteed):
+    """
+    Fit orders to the rules, every argument may be an array of one per order
+    :param stop: stop distances, nan for none
+    :param limit: limit distances, nan for none
+    :param guaranteed: whether each stop is guaranteed
+    :return: size, stop, limit as float arrays
+    """
+    points = limits(rules, price)
+    min_stop = np.where(guaranteed, points[..., MIN_GUARANTEED_DISTANCE], points[..., MIN_DISTANCE])
+    size = np.fmax(np.asarray(size, dtype=float), points[..., MIN_SIZE])
+    stop = _clip(np.asarray(stop, dtype=float), min_stop, points[..., MAX_DISTANCE])
+    limit = _clip(np.asarray(limit, dtype=float), points[..., MIN_DISTANCE], points[..., MAX_DISTANCE])
+    return size, stop, limit
+
+
+def check_orders(rules, price, size, stop, limit, guaranteed, market=True, trailing_increment=np.nan):
+    """
+    Orders as they are against the rules, arguments as adjust_orders
+    :param market: whether each is a MARKET order
+    :param trailing_increment: trailing stop increments, nan for no trailing stop
+    :return: OrderedDict of IG reason -> bool array, True where the order would be rejected for it
+    """
+    points = limits(rules, price)
+    size = np.asarray(size, dtype=float)
+    stop = np.asarray(stop, dtype=float)
+    limit = np.asarray(limit, dtype=float)
+    trailing_increment = np.asarray(trailing_increment, dtype=float)
+    min_stop = np.where(guaranteed, points[..., MIN_GUARANTEED_DISTANCE], points[..., MIN_DISTANCE])
+    with np.errstate(invalid='ignore'):
+        attached = (stop < min_stop) | (stop > points[..., MAX_DISTANCE]) | \
+                   (limit < points[..., MIN_DISTANCE]) | (limit > points[..., MAX_DISTANCE])
+        trailing = ~np.isnan(trailing_increment)
+        attached |= trailing & (~rules.trailing_stops | (trailing_increment < points[..., MIN_STEP]))
+        return collections.OrderedDict([
+            ('MARKET_ORDERS_NOT_ALLOWED_ON_ACCOUNT', np.asarray(market) & ~rules.market_orders),
+            ('MINIMUM_ORDER_SIZE_ERROR', size < points[..., MIN_SIZE]),
+            ('ATTACHED_ORDER_LEVEL_ERROR', attached)])
+
+
+def _distance(data, key):
+    return np.nan if data.get(key) is None else float(data[key])
+
+
+def adjust_order(data, rules, price, guaranteed):
+    """
+    Fit a positions_otc payload to one epic's rules, like handleDealingRules
+    :return: data, with any size, stopDistance or limitDistance changed as strings
+    """
+    size, stop, limit = adjust_orders(rules, price, float(data['size']), _distance(data, 'stopDistance'),
+                                      _distance(data, 'limitDistance'), guaranteed)
+    for key, old, new in (('size', float(data['size']), size),
+                          ('stopDistance', _distance(data, 'stopDistance'), stop),
+                          ('limitDistance', _distance(data, 'limitDistance'), limit)):
+        if not np.isnan(new) and new != old:
+            data[key] = format(float(new), '.2f')
+    return data
+
+
+def violations(data, rules, price, guaranteed):
+    """:return: list of the reasons IG would reject a positions_otc payload for under these rules"""
+    trailing_increment = _distance(data, 'trailingStopIncrement') if data.get('trailingStop') else np.nan
+    reasons = check_orders(rules, price, float(data['size']), _distance(data, 'stopDistance'),
+                           _distance(data, 'limitDistance'), guaranteed,
+                           market=data.get('orderType') == 'MARKET', trailing_increment=trailing_increment)
+    return [reason for reason, failed in reasons.items() if failed]
+
+
+class DealingRulesBook(object):
+
+    def __init__(self, lookup):
+        """
+        :param lookup: callable(epic_id) returning an entry with 'dealingRules' and 'updated',
+        e.g. InstrumentCatalogue.get
+        """
+        self.lookup = lookup
+        self._compiled = {}  # epic_id -> (entry's updated, CompiledRules)
+        self._lock = threading.Lock()
+
+    def get(self, epic_id):
+        """:return: the epic's CompiledRules, compiled again only when the entry changes"""
+        entry = self.lookup(epic_id)
+        with self._lock:
+            cached = self._compiled.get(epic_id)
+            if cached is not None and cached[0] == entry['updated']:
+                return cached[1]
+        rules = compile_rules(entry['dealingRules'] or {})
+        with self._lock:
+            self._compiled[epic_id] = (entry['updated'], rules)
+        return rules
+
+    def stack(self, epic_ids):
+        """:return: CompiledRules with a row per epic, for adjust_orders and check_orders"""
+        return stack_rules([self.get(epic_id) for epic_id in epic_ids])
@@ -0,0 +1,179 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Price bars kept from prices() calls, so a fetch only asks for bars we don't have.
+
+Bars are held per epic and resolution in NumPy arrays of bid prices. Coarser
+hourly resolutions (HOUR_2, HOUR_3, HOUR_4) can be resampled from HOUR bars,
+aligned to multiples of the resolution since the epoch, rather than fetched.
+bars() returns the prices() list format, so existing code reads either.
+"""
+
+import calendar
+import math
+import threading
+import time
+
+import numpy as np
+
+RESOLUTION_SECONDS = {'SECOND': 1, 'MINUTE': 60, 'MINUTE_2': 120, 'MINUTE_3': 180, 'MINUTE_5': 300,
+                      'MINUTE_10': 600, 'MINUTE_15': 900, 'MINUTE_30': 1800, 'HOUR': 3600, 'HOUR_2': 7200,
+                      'HOUR_3': 10800, 'HOUR_4': 14400, 'DAY': 86400, 'WEEK': 604800, 'MONTH': 2592000}
+
+FIELDS = ('time', 'open', 'high', 'low', 'close', 'volume')
+
+
+def parse_resolution(resolution):
+    """'HOUR_2/5' -> ('HOUR_2', 5)"""
+    name, _, points = resolution.partition('/')
+    return name, int(points or 1)
+
+
+def parse_snapshot_time(bar):
+    """
+    Epoch seconds of a prices() bar, UTC like the stream's UTM
+    :param bar: with snapshotTimeUTC as version 3 sends it, else snapshotTime taken as local time
+    """
+    if bar.get('snapshotTimeUTC'):
+        return float(calendar.timegm(time.strptime(bar['snapshotTimeUTC'], '%Y-%m-%dT%H:%M:%S')))
+    # older recordings: in the account's time zone, right only on a host in the same one
+    return time.mktime(time.strptime(bar['snapshotTime'], '%Y/%m/%d %H:%M:%S'))
+
+
+class BarSeries(object):
+    """Bars of one epic at one resolution, oldest first."""
+
+    __slots__ = FIELDS + ('seconds', 'fetched_at')
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.fetched_at = 0
+        for field in FIELDS:
+            setattr(self, field, np.empty(0))
+
+    def __len__(self):
+        return len(self.time)
+
+    def merge(self, columns, keep):
+        """Add bars, replacing any with the same time, and keep the newest keep."""
+        new_time = np.asarray(columns['time'], dtype=float)
+        old = ~np.isin(self.time, new_time)
+        for field in FIELDS:
+            setattr(self, field, np.concatenate([getattr(self, field)[old], np.asarray(columns[field], dtype=float)]))
+        order = np.argsort(self.time, kind='stable')[-keep:]
+        for field in FIELDS:
+            setattr(self, field, getattr(self, field)[order])
+
+    def resample(self, seconds):
+        """Bars of a whole multiple of this resolution: first open, max high, min low, last close, summed volume."""
+        if seconds == self.seconds or not len(self):
+            return dict((field, getattr(self, field)) for field in FIELDS)
+        bucket = np.floor(self.time / seconds)
+        starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        ends = np.r_[starts[1:], len(bucket)] - 1
+        return {'time': bucket[starts] * seconds,
+                'open': self.open[starts],
+                'high': np.maximum.reduceat(self.high, starts),
+                'low': np.minimum.reduceat(self.low, starts),
+                'close': self.close[ends],
+                'volume': np.add.reduceat(self.volume, starts)}
+
+
+class PriceHistory(object):
+
+    def __init__(self, keep=200):
+        """
+        :param keep: bars kept per epic and resolution
+        """
+        self.keep = keep
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _get(self, epic_id, resolution):
+        key = (epic_id, resolution)
+        if key not in self._series:
+            self._series[key] = BarSeries(RESOLUTION_SECONDS[resolution])
+        return self._series[key]
+
+    def add(self, epic_id, resolution, prices, fetched_at=None):
+        """
+        Keep the bars of a prices() response
+        :param resolution: e.g. 'HOUR', without the point count
+        :param prices: the response's 'prices' list
+        """
+        columns = dict((field, []) for field in FIELDS)
+        for i in prices:
+            columns['time'].append(parse_snapshot_time(i))
+            for field in ('open', 'high', 'low', 'close'):
+                columns[field].append(i[field + 'Price']['bid'])
+            columns['volume'].append(i.get('lastTradedVolume') or 0)
+        with self._lock:
+            series = self._get(epic_id, resolution)
+            series.merge(columns, self.keep)
+            series.fetched_at = fetched_at or time.time()
+
+    def update_bar(self, epic_id, resolution, bar_time, open_, high, low, close, volume):
+        """Set one bar, e.g. from the stream: the newest is updated in place, a later one appended."""
+        with self._lock:
+            series = self._get(epic_id, resolution)
+            if len(series) and series.time[-1] == bar_time:
+                series.open[-1], series.high[-1], series.low[-1] = open_, high, low
+                series.close[-1], series.volume[-1] = close, volume
+            else:
+                series.merge({'time': [bar_time], 'open': [open_], 'high': [high], 'low': [low],
+                              'close': [close], 'volume': [volume]}, self.keep)
+            series.fetched_at = time.time()
+
+    def update_bars(self, epic_id, resolution, bars):
+        """Set several bars at once, e.g. from the market bus: columns or a structured array of FIELDS."""
+        with self._lock:
+            series = self._get(epic_id, resolution)
+            series.merge(bars, self.keep)
+            series.fetched_at = time.time()
+
+    def missing(self, epic_id, resolution, points, max_age, now=None):
+        """
+        How many bars to fetch so the newest points bars are no older than max_age
+        :return: 0 if what we have will do, else a count including the bar still forming
+        """
+        now = now or time.time()
+        with self._lock:
+            series = self._series.get((epic_id, resolution))
+            if series is None or not len(series):
+                return points
+            if now - series.fetched_at <= max_age and len(series) >= points:
+                return 0
+            # the newest bar we have may have closed since, so ask for it again
+            since = int(math.ceil((now - series.time[-1]) / series.seconds)) + 1
+            return min(points, max(1, since)) if len(series) >= points else points
+
+    def bars(self, epic_id, resolution, points, base=None):
+        """
+        The newest points bars in prices() format, resampled from base if given
+        :return: list, shorter than points if we don't have enough
+        """
+        with self._lock:
+            series = self._series.get((epic_id, base or resolution))
+            if series is None:
+                return []
+            columns = series.resample(RESOLUTION_SECONDS[resolution])
+        columns = dict((field, values.tolist()) for field, values in columns.items())
+        n = len(columns['time'])
+        prices = []
+        for i in range(max(0, n - points), n):
+            bar = {'snapshotTime': time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(columns['time'][i])),
+                   'snapshotTimeUTC': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(columns['time'][i])),
+                   'lastTradedVolume': columns['volume'][i]}
+            for field in ('open', 'high', 'low', 'close'):
+                bar[field + 'Price'] = {'bid': columns[field][i], 'ask': None, 'lastTraded': None}
+            prices.append(bar)
+        return prices
@@ -0,0 +1,180 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""How stale our prices are, and how long a tick takes to become an order.
+
+Every stream update carries 'received', the time.monotonic() its line was
+read, and MARKET updates 'lag', seconds from the server's UPDATE_TIME (UK
+time, to the second) to then; a CHART's UTM is its bar's start, not when it
+was sent, so it isn't used. A Trace follows the update that made an epic
+a candidate through the pipeline, timing each stage from the last:
+
+    lag            server -> received
+    dispatch       received -> listeners, the dispatch queue and parsing
+    screen         received -> find_next_trade returned it
+    enrich         client sentiment and price history
+    predict        the regression
+    execute        placeOrder up to positions_otc returning
+    tick_to_trade  received -> positions_otc returned
+
+TRACKER keeps the latest window of each for percentiles, and feeds the
+profiler as 'latency.<stage>' when that's on. It warns, at most once every
+alert_interval, when lag goes over lag_alert seconds or a dispatch queue is
+more than backlog_alert full.
+"""
+
+import calendar
+import collections
+import itertools
+import logging
+import threading
+import time
+
+import numpy as np
+
+from lib.profiler import PROFILER
+
+STAGES = ('lag', 'dispatch', 'screen', 'enrich', 'predict', 'execute', 'tick_to_trade')
+
+_uk_offset = [None, 0]  # hour it's for, offset
+
+
+def _last_sunday(year, month):
+    last = calendar.monthrange(year, month)[1]
+    return last - (calendar.weekday(year, month, last) + 1) % 7
+
+
+def uk_offset(t):
+    """Seconds UK time is ahead of UTC at t, 3600 in British Summer Time."""
+    hour = int(t // 3600)
+    if _uk_offset[0] != hour:
+        year = time.gmtime(t).tm_year
+        start = calendar.timegm((year, 3, _last_sunday(year, 3), 1, 0, 0))
+        end = calendar.timegm((year, 10, _last_sunday(year, 10), 1, 0, 0))
+        _uk_offset[:] = [hour, 3600 if start <= t < end else 0]
+    return _uk_offset[1]
+
+
+def update_lag(values, now=None):
+    """
+    Seconds from the server stamping an update to now
+    :param values: the update's fields, with UPDATE_TIME as HH:MM:SS UK time
+    :return: seconds, None without a stamp
+    """
+    now = time.time() if now is None else now
+    if values.get('UPDATE_TIME'):
+        h, m, s = values['UPDATE_TIME'].split(':')
+        lag = ((now + uk_offset(now)) - (int(h) * 3600 + int(m) * 60 + float(s))) % 86400
+        # a stamp just ahead of our clock, not one from yesterday
+        return lag - 86400 if lag > 43200 else lag
+    return None
+
+
+class LatencyTracker(object):
+
+    def __init__(self, window=1000, lag_alert=5.0, backlog_alert=0.8, alert_interval=60):
+        """
+        :param window: latest samples kept per stage
+        :param lag_alert: seconds of stream lag to warn at, 0 for never
+        :param backlog_alert: fraction of a full dispatch queue to warn at, 0 for never
+        """
+        self.logger = logging.getLogger('LatencyTracker')
+        self.window = window
+        self.lag_alert = lag_alert
+        self.backlog_alert = backlog_alert
+        self.alert_interval = alert_interval
+        self.alerts = collections.Counter()
+        self._samples = {}
+        self._alerted = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            samples = self._samples.get(stage)
+            if samples is None:
+                samples = self._samples[stage] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+        if PROFILER.enabled:
+            PROFILER.record('latency.' + stage, seconds)
+
+    def observe_lag(self, seconds, name):
+        self.record('lag', seconds)
+        if self.lag_alert and seconds > self.lag_alert:
+            self.alert('lag', 'igstream: {0} is {1:.1f}s behind the server'.format(name, seconds))
+
+    def observe_backlog(self, size, capacity):
+        if self.backlog_alert and capacity and size >= capacity * self.backlog_alert:
+            self.alert('backlog', 'igstream: dispatch queue {0}/{1} full'.format(size, capacity))
+
+    def alert(self, kind, message):
+        now = time.monotonic()
+        with self._lock:
+            self.alerts[kind] += 1
+            if now - self._alerted.get(kind, -self.alert_interval) < self.alert_interval:
+                return
+            self._alerted[kind] = now
+        self.logger.warning(message)
+
+    def percentiles(self, stage, q=(50, 90, 99)):
+        """:return: {percentile: seconds} over the stage's window, None before any samples"""
+        with self._lock:
+            samples = np.array(self._samples.get(stage, ()), dtype=float)
+        if not len(samples):
+            return None
+        return collections.OrderedDict(zip(q, np.percentile(samples, q)))
+
+    def summary(self):
+        with self._lock:
+            counts = dict((stage, len(samples)) for stage, samples in self._samples.items())
+        result = collections.OrderedDict()
+        for stage in [stage for stage in STAGES if stage in counts] + sorted(set(counts) - set(STAGES)):
+            p = self.percentiles(stage)
+            result[stage] = {'count': counts[stage], 'p50': float(p[50]), 'p90': float(p[90]), 'p99': float(p[99])}
+        return result
+
+    def format_summary(self):
+        return ', '.join('{0} p50 {1:.3f}s p99 {2:.3f}s'.format(stage, s['p50'], s['p99'])
+                         for stage, s in self.summary().items())
+
+
+TRACKER = LatencyTracker()
+
+_trace_ids = itertools.count(1)
+
+
+class Trace(object):
+    """The way of one stream update through the pipeline, see the module docstring."""
+    __slots__ = ('trace_id', 'epic_id', 'received', 'stamps')
+
+    def __init__(self, epic_id, received=None):
+        self.trace_id = next(_trace_ids)
+        self.epic_id = epic_id
+        self.received = time.monotonic() if received is None else received
+        self.stamps = [('received', self.received)]
+
+    def mark(self, stage):
+        """Time stage, from the last mark."""
+        now = time.monotonic()
+        TRACKER.record(stage, now - self.stamps[-1][1])
+        self.stamps.append((stage, now))
+        return now
+
+    def finish(self, stage):
+        """Time the last stage, and the whole way from the tick."""
+        now = self.mark(stage)
+        TRACKER.record('tick_to_trade', now - self.received)
+        return now - self.received
+
+    def __str__(self):
+        return 'trace {0} {1}: '.format(self.trace_id, self.epic_id) + ' '.join(
+            '{0} +{1:.3f}s'.format(stage, t - previous)
+            for (_, previous), (stage, t) in zip(self.stamps, self.stamps[1:]))
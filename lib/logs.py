@@ -0,0 +1,160 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Logging that keeps file and console I/O off the stream and trading threads.
+
+setup() puts a queue in front of the handlers: logging calls only append
+the record, and a listener thread formats and writes it. When the queue is
+full, records are dropped and counted instead of blocking the caller.
+
+What used to be printed goes through event(). It prints to the console as
+before, and is also written as a JSON line to the event log, with its
+fields, for tools to read:
+
+    event('candidate', '{epic} Day Price Change {change_pct}% :- GOOD SPREAD', epic=epic_id, change_pct=pct)
+
+Per-tick events go through a Sampler, which lets one per key through every
+interval seconds and counts the rest.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
+CONSOLE_FORMAT = '%(name)-12s: %(levelname)-8s %(message)s'
+
+EVENTS = logging.getLogger('events')
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records rather than wait for room in the queue."""
+
+    def __init__(self, queue_):
+        super(DroppingQueueHandler, self).__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the queue stays in this process, so the record goes as it is and is formatted on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per event() record."""
+
+    def format(self, record):
+        d = {'time': round(record.created, 3), 'event': record.event, 'message': record.getMessage()}
+        d.update(record.fields)
+        return json.dumps(d, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    """CONSOLE_FORMAT, with events printed bare as they were before."""
+
+    def format(self, record):
+        if hasattr(record, 'event'):
+            return record.getMessage()
+        return super(ConsoleFormatter, self).format(record)
+
+
+class _EventsOnly(logging.Filter):
+    def filter(self, record):
+        return hasattr(record, 'event')
+
+
+def setup(filename='logfile.txt', level='INFO', console_level='INFO', events_file=None, queue_size=10000,
+          filemode='w'):
+    """
+    Log through a queue to filename, the console and, for event() records, events_file as JSON lines
+    :param level: for the log file, e.g. 'DEBUG'
+    :param console_level: for the console
+    :param events_file: None for no event log
+    :return: the DroppingQueueHandler, its dropped counts records lost to a full queue
+    """
+    handlers = []
+    if filename:
+        handler = logging.FileHandler(filename, mode=filemode)
+        handler.setLevel(level)
+        handler.setFormatter(logging.Formatter(FORMAT, datefmt='%y-%m-%d %H:%M:%S'))
+        handlers.append(handler)
+    console = logging.StreamHandler()
+    console.setLevel(console_level)
+    console.setFormatter(ConsoleFormatter(CONSOLE_FORMAT))
+    handlers.append(console)
+    if events_file:
+        handler = logging.FileHandler(events_file, mode='a')
+        handler.setLevel(logging.INFO)
+        handler.addFilter(_EventsOnly())
+        handler.setFormatter(JSONFormatter())
+        handlers.append(handler)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger('')
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    # records below every handler's level are never even made
+    root.setLevel(min(handler.level for handler in handlers))
+    return queue_handler
+
+
+def setup_from_config(config, filename=None):
+    """setup() with the [Config] LOG_* and EVENT_LOG settings, filename instead of LOG_FILE if given."""
+    section = config['Config']
+    return setup(filename=filename or section.get('LOG_FILE', fallback='logfile.txt') or None,
+                 level=section.get('LOG_LEVEL', fallback='INFO').upper(),
+                 console_level=section.get('LOG_CONSOLE_LEVEL', fallback='INFO').upper(),
+                 events_file=section.get('EVENT_LOG', fallback='') or None,
+                 queue_size=section.getint('LOG_QUEUE_SIZE', fallback=10000))
+
+
+def event(kind, message, **fields):
+    """Console output, as a record of the 'events' logger carrying kind and fields."""
+    if EVENTS.isEnabledFor(logging.INFO):
+        EVENTS.info(message.format(**fields), extra={'event': kind, 'fields': fields})
+
+
+class Sampler(object):
+    """Lets one event per key through every interval seconds."""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.suppressed = 0
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last.get(key, -self.interval) < self.interval:
+                self.suppressed += 1
+                return False
+            self._last[key] = now
+            return True
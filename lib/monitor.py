@@ -0,0 +1,268 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Open positions priced from the stream, closed by our own exit rules.
+
+The position set starts from a positions() response and is kept current by
+OPU updates on the TRADE stream; prices come from MARKET subscriptions of the
+positions' epics, dropped once no position is left on them. Positions are held as columns of NumPy arrays, and every
+batch of price updates is evaluated in one pass on the monitor thread:
+
+    pnl       unrealised profit, in the account currency
+    to_stop   points the price can still move against us before the stop
+    to_limit  points to go before the limit
+
+Exit rules, each off at 0:
+
+    trailing_stop  close once the price is this many points off its best since opening
+    max_hold       close after this many seconds
+    target_pnl     close once pnl reaches this much
+"""
+
+import calendar
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+COLUMNS = ('row', 'sign', 'size', 'scale', 'level', 'stop_level', 'limit_level', 'opened_at', 'best', 'retry_at')
+
+
+def _float(value):
+    return np.nan if value in (None, '') else float(value)
+
+
+class PositionMonitor(object):
+
+    def __init__(self, close, subscribe, trailing_stop=0, max_hold=0, target_pnl=0, retry=10, unsubscribe=None):
+        """
+        :param close: callable(data) closing a position, e.g. IGClient.positions_otc_close
+        :param subscribe: callable(epic_id, listener) subscribing to the epic's MARKET BID and OFFER
+        :param unsubscribe: callable(epic_id, listener) undoing subscribe once no position is left on the epic
+        :param retry: seconds before trying again to close a position that didn't
+        """
+        self.logger = logging.getLogger('PositionMonitor')
+        self.logger.debug('monitor.py PositionMonitor __init__')
+        self.close = close
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.retry = retry
+        self.set_rules(trailing_stop, max_hold, target_pnl)
+
+        self.epic_ids = []
+        self._epic_index = {}
+        self.bid = np.empty(0)
+        self.offer = np.empty(0)
+        self._subscribed = set()  # epics the monitor thread subscribed to
+
+        self.deal_ids = []
+        for column in COLUMNS:
+            setattr(self, column, np.empty(0))
+        self.pnl = self.to_stop = self.to_limit = np.empty(0)
+        self.closed = 0  # positions closed by the exit rules
+
+        self._lock = threading.Lock()
+        self._updated = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def set_rules(self, trailing_stop, max_hold, target_pnl):
+        self.trailing_stop = float(trailing_stop)
+        self.max_hold = float(max_hold)
+        self.target_pnl = float(target_pnl)
+
+    def _epic_row(self, epic_id):
+        # under _lock
+        row = self._epic_index.get(epic_id)
+        if row is None:
+            row = self._epic_index[epic_id] = len(self.epic_ids)
+            self.epic_ids.append(epic_id)
+            self.bid = np.append(self.bid, np.nan)
+            self.offer = np.append(self.offer, np.nan)
+        return row
+
+    def _add(self, position, epic_id, bid=None, offer=None):
+        # under _lock, position as in a positions() response or an OPU update
+        deal_id = position['dealId']
+        if deal_id in self.deal_ids:
+            self._remove(deal_id)
+        row = self._epic_row(epic_id)
+        if bid is not None and offer is not None and np.isnan(self.bid[row]):
+            self.bid[row], self.offer[row] = float(bid), float(offer)
+        sign = 1.0 if position['direction'] == 'BUY' else -1.0
+        level = float(position['level'])
+        values = {'row': row, 'sign': sign, 'size': float(position['size']),
+                  'scale': float(position.get('contractSize') or 1),
+                  'level': level,
+                  'stop_level': _float(position.get('stopLevel')),
+                  'limit_level': _float(position.get('limitLevel')),
+                  'opened_at': self._opened_at(position),
+                  'best': level, 'retry_at': 0}
+        self.deal_ids.append(deal_id)
+        for column in COLUMNS:
+            setattr(self, column, np.append(getattr(self, column), values[column]))
+
+    def _opened_at(self, position):
+        created = position.get('createdDateUTC')
+        if created:
+            try:
+                return calendar.timegm(time.strptime(created[:19], '%Y-%m-%dT%H:%M:%S'))
+            except ValueError:
+                pass
+        return time.time()
+
+    def _remove(self, deal_id):
+        # under _lock
+        keep = np.array([d != deal_id for d in self.deal_ids], dtype=bool)
+        self.deal_ids = [d for d in self.deal_ids if d != deal_id]
+        for column in COLUMNS:
+            setattr(self, column, getattr(self, column)[keep])
+
+    def load(self, positions):
+        """Start from a positions() response."""
+        with self._lock:
+            for p in positions['positions']:
+                self._add(p['position'], p['market']['epic'], p['market'].get('bid'), p['market'].get('offer'))
+        self._updated.set()
+
+    def on_trade(self, item_info):
+        """TRADE stream listener, keeps the position set in step with OPU updates."""
+        opu = item_info['values'].get('OPU')
+        if not opu:
+            return
+        if not isinstance(opu, dict):
+            opu = json.loads(opu)
+        if opu.get('dealStatus') != 'ACCEPTED':
+            return
+        with self._lock:
+            if opu.get('status') == 'DELETED':
+                if opu['dealId'] in self.deal_ids:
+                    self._remove(opu['dealId'])
+            elif opu['dealId'] not in self.deal_ids or opu.get('status') == 'UPDATED':
+                previous = self._column_values(opu['dealId'])
+                self._add(opu, opu['epic'])
+                if previous is not None:
+                    # an update keeps when it opened, how far it got and the contract size OPU leaves out
+                    self.opened_at[-1], self.best[-1], self.scale[-1] = previous
+        self._updated.set()
+
+    def _column_values(self, deal_id):
+        if deal_id not in self.deal_ids:
+            return None
+        i = self.deal_ids.index(deal_id)
+        return self.opened_at[i], self.best[i], self.scale[i]
+
+    def on_price(self, item_info):
+        """MARKET stream listener."""
+        epic_id = item_info['name'].split(':', 1)[1]
+        values = item_info['values']
+        with self._lock:
+            row = self._epic_index.get(epic_id)
+            if row is None:
+                return
+            if values.get('BID'):
+                self.bid[row] = float(values['BID'])
+            if values.get('OFFER'):
+                self.offer[row] = float(values['OFFER'])
+        self._updated.set()
+
+    def evaluate(self, now=None):
+        """
+        Price every position and close those an exit rule says to
+        :return: deal ids closed
+        """
+        now = now or time.time()
+        with self._lock:
+            if not self.deal_ids:
+                self.pnl = self.to_stop = self.to_limit = np.empty(0)
+                return []
+            sign = self.sign
+            # what closing would get: the bid for a long, the offer for a short
+            price = np.where(sign > 0, self.bid[self.row.astype(int)], self.offer[self.row.astype(int)])
+            with np.errstate(invalid='ignore'):
+                self.best = np.where(np.isnan(price), self.best,
+                                     np.where(sign > 0, np.fmax(self.best, price), np.fmin(self.best, price)))
+                self.pnl = sign * (price - self.level) * self.size * self.scale
+                self.to_stop = sign * (price - self.stop_level)
+                self.to_limit = sign * (self.limit_level - price)
+
+                exit_ = np.zeros(len(sign), dtype=bool)
+                if self.trailing_stop > 0:
+                    exit_ |= sign * (self.best - price) >= self.trailing_stop
+                if self.max_hold > 0:
+                    exit_ |= now - self.opened_at >= self.max_hold
+                if self.target_pnl > 0:
+                    exit_ |= self.pnl >= self.target_pnl
+                exit_ &= ~np.isnan(price) & (self.retry_at <= now)
+            rows = np.flatnonzero(exit_)
+            self.retry_at[rows] = now + self.retry
+            exits = [(self.deal_ids[i], 'SELL' if sign[i] > 0 else 'BUY', self.size[i], float(self.pnl[i]))
+                     for i in rows]
+
+        closed = []
+        for deal_id, direction, size, pnl in exits:
+            try:
+                self.close({'dealId': deal_id, 'direction': direction, 'size': str(size), 'orderType': 'MARKET'})
+            except Exception:
+                self.logger.exception('monitor.py PositionMonitor evaluate: closing {0} failed'.format(deal_id))
+                continue
+            self.logger.info('monitor.py PositionMonitor evaluate: closed {0} at {1:.2f}'.format(deal_id, pnl))
+            closed.append(deal_id)
+        self.closed += len(closed)
+        return closed
+
+    def _subscribe_pending(self):
+        # subscribe to the epics positions were opened on, and unsubscribe from those without any left
+        with self._lock:
+            held = set(self.epic_ids[row] for row in np.unique(self.row.astype(int)))
+            epic_ids, gone = held - self._subscribed, self._subscribed - held
+            if self.unsubscribe is None:
+                gone = set()
+            for epic_id in gone:
+                # no ticks from here on, so no stale price for the next position
+                row = self._epic_index[epic_id]
+                self.bid[row] = self.offer[row] = np.nan
+            self._subscribed = (self._subscribed | epic_ids) - gone
+        for epic_id in epic_ids:
+            try:
+                self.subscribe(epic_id, self.on_price)
+            except Exception:
+                self.logger.exception('monitor.py PositionMonitor: could not subscribe to {0}'.format(epic_id))
+        for epic_id in gone:
+            try:
+                self.unsubscribe(epic_id, self.on_price)
+            except Exception:
+                self.logger.exception('monitor.py PositionMonitor: could not unsubscribe from {0}'.format(epic_id))
+
+    def _run(self):
+        while not self._stop.is_set():
+            # ticks arriving while a batch is evaluated make up the next batch, time stops need a second's tick
+            self._updated.wait(1)
+            self._updated.clear()
+            self._subscribe_pending()
+            try:
+                self.evaluate()
+            except Exception:
+                self.logger.exception('monitor.py PositionMonitor _run: evaluate failed')
+
+    def start(self):
+        self.logger.debug('monitor.py PositionMonitor start')
+        if self._thread is None:
+            self._thread = threading.Thread(name="POSITION-MONITOR-THREAD", target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._updated.set()
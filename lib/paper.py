@@ -0,0 +1,285 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Paper trading: IGClient's trading calls, filled in memory.
+
+PaperBroker has positions(), positions_otc(), positions_otc_close() and
+confirms() with the responses IG gives, so it can stand in for the REST API
+without touching the account or the order rate budget. Prices come from
+MARKET stream updates passed to on_price(), live or from igreplay:
+
+    broker = PaperBroker(quote=api.quote, subscribe=api.subscribe_prices)
+    broker.listeners.append(monitor.on_trade)  # gets OPU and CONFIRMS like the TRADE stream
+    ref = broker.positions_otc(data)['dealReference']
+    broker.confirms(ref)
+
+Orders fill at the offer (BUY) or the bid (SELL), and are rejected with IG's
+reasons for a missing price, the dealing rules and margin when an instrument
+lookup is given. Each price update closes positions whose stop or limit it
+reaches: at the level for limits and guaranteed stops, at the price for
+stops it gapped through.
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+import uuid
+
+from lib.account import margin_needed
+from lib.dealing import compile_rules, violations
+
+ACCOUNT_ID = 'PAPER'
+CONFIRMS_KEPT = 1000  # latest deal confirmations confirms() can look up
+
+
+class PaperBroker(object):
+
+    def __init__(self, quote=None, subscribe=None, instrument=None, balance=10000.0, currency='GBP',
+                 unsubscribe=None):
+        """
+        :param quote: callable(epic_id) returning (bid, offer) or None, for epics no update has priced yet
+        :param subscribe: callable(epic_id, listener) subscribing listener to the epic's MARKET BID and OFFER
+        :param unsubscribe: callable(epic_id, listener) undoing subscribe once no position is left on the epic
+        :param instrument: callable(epic_id) returning a catalogue entry, for dealing rules and margin
+        :param balance: starting cash
+        """
+        self.logger = logging.getLogger('PaperBroker')
+        self.logger.debug('paper.py PaperBroker __init__')
+        self.quote = quote
+        self.subscribe = subscribe
+        self.unsubscribe = unsubscribe
+        self.instrument = instrument
+        self.cash = float(balance)
+        self.currency = currency
+        self.listeners = []  # called with TRADE stream style item_info for OPU and CONFIRMS
+
+        self.prices = {}  # epic_id -> (bid, offer)
+        self.open = {}  # dealId -> position
+        self.confirmations = collections.OrderedDict()  # dealReference -> confirm, the latest CONFIRMS_KEPT
+        self.realised = 0.0
+        self._subscribed = set()
+        self._unwatch = set()  # epics closed out of, unsubscribed on the next trading call
+        self._lock = threading.RLock()
+
+    # prices
+
+    def on_price(self, item_info):
+        """MARKET stream listener, also closes positions the new price reaches the stop or limit of."""
+        epic_id = item_info['name'].split(':', 1)[1]
+        values = item_info['values']
+        with self._lock:
+            bid, offer = self.prices.get(epic_id, (None, None))
+            if values.get('BID'):
+                bid = float(values['BID'])
+            if values.get('OFFER'):
+                offer = float(values['OFFER'])
+            if bid is None or offer is None:
+                return
+            self.prices[epic_id] = (bid, offer)
+            self._check_levels(epic_id, bid, offer)
+
+    def price(self, epic_id):
+        with self._lock:
+            price = self.prices.get(epic_id)
+        if price is None and self.quote is not None:
+            price = self.quote(epic_id)
+            if price is not None:
+                with self._lock:
+                    self.prices.setdefault(epic_id, (float(price[0]), float(price[1])))
+        self._watch(epic_id)
+        return price
+
+    def _watch(self, epic_id):
+        with self._lock:
+            self._unwatch.discard(epic_id)
+            if self.subscribe is None or epic_id in self._subscribed:
+                return
+            self._subscribed.add(epic_id)
+        try:
+            self.subscribe(epic_id, self.on_price)
+        except Exception:
+            with self._lock:
+                self._subscribed.discard(epic_id)
+            self.logger.exception('paper.py PaperBroker: could not subscribe to {0}'.format(epic_id))
+
+    def _unwatch_closed(self):
+        # not from _close, which may run on the stream thread, and never under _lock
+        if self.unsubscribe is None:
+            return
+        with self._lock:
+            epic_ids = [e for e in self._unwatch if not any(p['epic'] == e for p in self.open.values())]
+            self._unwatch.clear()
+            self._subscribed.difference_update(epic_ids)
+            for epic_id in epic_ids:
+                self.prices.pop(epic_id, None)
+        for epic_id in epic_ids:
+            try:
+                self.unsubscribe(epic_id, self.on_price)
+            except Exception:
+                self.logger.exception('paper.py PaperBroker: could not unsubscribe from {0}'.format(epic_id))
+
+    # account
+
+    def _pnl(self, position):
+        bid, offer = self.prices.get(position['epic'], (position['level'], position['level']))
+        close = bid if position['direction'] == 'BUY' else offer
+        sign = 1 if position['direction'] == 'BUY' else -1
+        return sign * (close - position['level']) * position['size']
+
+    def account(self):
+        """The ACCOUNT stream fields."""
+        with self._lock:
+            pnl = sum(self._pnl(p) for p in self.open.values())
+            margin = sum(p['margin'] for p in self.open.values())
+            funds = self.cash + self.realised
+            return {'PNL': round(pnl, 2), 'DEPOSIT': round(margin, 2), 'MARGIN': round(margin, 2),
+                    'FUNDS': round(funds, 2), 'EQUITY': round(funds + pnl, 2),
+                    'AVAILABLE_CASH': round(funds + pnl - margin, 2), 'AVAILABLE_TO_DEAL': round(funds + pnl - margin, 2)}
+
+    # events
+
+    def _emit(self, field, payload):
+        item_info = {'pos': 1, 'name': 'TRADE:' + ACCOUNT_ID, 'values': {field: json.dumps(payload)}}
+        for listener in self.listeners:
+            try:
+                listener(item_info)
+            except Exception:
+                self.logger.exception('paper.py PaperBroker: {0} listener failed'.format(field))
+
+    def _confirm(self, deal_ref, deal_id, epic_id, deal_status, reason, **extra):
+        confirm = {'dealReference': deal_ref, 'dealId': deal_id, 'epic': epic_id, 'dealStatus': deal_status,
+                   'reason': reason, 'status': extra.pop('status', 'OPEN' if deal_status == 'ACCEPTED' else None),
+                   'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'affectedDeals': []}
+        confirm.update(extra)
+        self.confirmations[deal_ref] = confirm
+        while len(self.confirmations) > CONFIRMS_KEPT:
+            self.confirmations.popitem(last=False)
+        self._emit('CONFIRMS', confirm)
+        return confirm
+
+    # IGClient's trading calls
+
+    def positions(self, deal_id=None):
+        self._unwatch_closed()
+        with self._lock:
+            if deal_id is not None:
+                position = self.open.get(deal_id)
+                return None if position is None else self._position_json(position)
+            return {'positions': [self._position_json(p) for p in self.open.values()]}
+
+    def _position_json(self, position):
+        bid, offer = self.prices.get(position['epic'], (None, None))
+        fields = ('dealId', 'dealReference', 'direction', 'size', 'level', 'stopLevel', 'limitLevel', 'currency',
+                  'createdDateUTC')
+        return {'position': dict(((k, position[k]) for k in fields), contractSize=1.0,
+                                 controlledRisk=position['guaranteedStop']),
+                'market': {'epic': position['epic'], 'instrumentName': position['epic'], 'bid': bid, 'offer': offer,
+                           'marketStatus': 'TRADEABLE'}}
+
+    def positions_otc(self, data):
+        """Open a position. :return: {'dealReference': ...}, confirms() says whether it was accepted"""
+        self.logger.debug('paper.py PaperBroker positions_otc')
+        self._unwatch_closed()
+        deal_ref = data.get('dealReference') or uuid.uuid4().hex[:15].upper()
+        deal_id = 'DIPAPER' + uuid.uuid4().hex[:9].upper()
+        epic_id = data.get('epic')
+        direction = data.get('direction')
+        size = float(data.get('size') or 0)
+        guaranteed = bool(data.get('guaranteedStop'))
+        price = self.price(epic_id)
+        with self._lock:
+            if direction not in ('BUY', 'SELL') or size <= 0:
+                self._confirm(deal_ref, deal_id, epic_id, 'REJECTED', 'UNKNOWN')
+                return {'dealReference': deal_ref}
+            if price is None:
+                self._confirm(deal_ref, deal_id, epic_id, 'REJECTED', 'MARKET_OFFLINE')
+                return {'dealReference': deal_ref}
+            bid, offer = self.prices.get(epic_id, price)
+            level = offer if direction == 'BUY' else bid
+            entry = self.instrument(epic_id) if self.instrument is not None else None
+            if entry is not None:
+                reasons = violations(data, compile_rules(entry.get('dealingRules') or {}), level, guaranteed)
+                if reasons:
+                    self._confirm(deal_ref, deal_id, epic_id, 'REJECTED', reasons[0])
+                    return {'dealReference': deal_ref}
+            stop = float(data['stopDistance']) if data.get('stopDistance') else None
+            limit = float(data['limitDistance']) if data.get('limitDistance') else None
+            margin = None
+            if entry is not None:
+                margin = margin_needed(size, level, entry.get('marginFactor'), entry.get('marginFactorUnit'),
+                                       stop, guaranteed)
+            margin = margin or 0.0
+            if margin > self.account()['AVAILABLE_TO_DEAL']:
+                self._confirm(deal_ref, deal_id, epic_id, 'REJECTED', 'INSUFFICIENT_FUNDS')
+                return {'dealReference': deal_ref}
+            sign = 1 if direction == 'BUY' else -1
+            position = {'dealId': deal_id, 'dealReference': deal_ref, 'epic': epic_id, 'direction': direction,
+                        'size': size, 'level': level,
+                        'stopLevel': level - sign * stop if stop else None,
+                        'limitLevel': level + sign * limit if limit else None,
+                        'guaranteedStop': guaranteed, 'currency': data.get('currencyCode') or self.currency,
+                        'createdDateUTC': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()), 'margin': margin}
+            self.open[deal_id] = position
+            self._emit('OPU', self._opu(position, 'OPEN'))
+            self._confirm(deal_ref, deal_id, epic_id, 'ACCEPTED', 'SUCCESS', level=level, size=size,
+                          direction=direction, stopLevel=position['stopLevel'], limitLevel=position['limitLevel'],
+                          guaranteedStop=guaranteed)
+        return {'dealReference': deal_ref}
+
+    def positions_otc_close(self, data):
+        """Close a position by dealId. :return: {'dealReference': ...}"""
+        self.logger.debug('paper.py PaperBroker positions_otc_close')
+        deal_ref = uuid.uuid4().hex[:15].upper()
+        with self._lock:
+            position = self.open.get(data.get('dealId'))
+            if position is None:
+                self._confirm(deal_ref, data.get('dealId'), None, 'REJECTED', 'POSITION_NOT_FOUND')
+                return {'dealReference': deal_ref}
+            bid, offer = self.prices.get(position['epic'], (position['level'], position['level']))
+            self._close(position, deal_ref, bid if position['direction'] == 'BUY' else offer)
+        self._unwatch_closed()
+        return {'dealReference': deal_ref}
+
+    def confirms(self, deal_ref):
+        with self._lock:
+            return self.confirmations.get(deal_ref)
+
+    # fills
+
+    def _opu(self, position, status):
+        return dict(((k, v) for k, v in position.items() if k != 'margin'), status=status, dealStatus='ACCEPTED',
+                    timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+    def _close(self, position, deal_ref, level):
+        # under _lock
+        sign = 1 if position['direction'] == 'BUY' else -1
+        profit = sign * (level - position['level']) * position['size']
+        self.realised += profit
+        del self.open[position['dealId']]
+        self._unwatch.add(position['epic'])
+        self._emit('OPU', self._opu(dict(position, level=level), 'DELETED'))
+        self._confirm(deal_ref, position['dealId'], position['epic'], 'ACCEPTED', 'SUCCESS', status='CLOSED',
+                      level=level, size=position['size'], profit=round(profit, 2), profitCurrency=position['currency'])
+
+    def _check_levels(self, epic_id, bid, offer):
+        # under _lock
+        for position in [p for p in self.open.values() if p['epic'] == epic_id]:
+            sign = 1 if position['direction'] == 'BUY' else -1
+            price = bid if sign > 0 else offer
+            stop, limit = position['stopLevel'], position['limitLevel']
+            if stop is not None and sign * (price - stop) <= 0:
+                # a gap through a stop fills at the price, unless it's guaranteed
+                self._close(position, uuid.uuid4().hex[:15].upper(), stop if position['guaranteedStop'] else price)
+            elif limit is not None and sign * (price - limit) >= 0:
+                self._close(position, uuid.uuid4().hex[:15].upper(), limit)
@@ -0,0 +1,259 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""The faig.py decision loop split into stages joined by bounded queues:
+
+    screen (1 thread)  ->  enrich (workers threads)  ->  predict (1 thread)  ->  execute (1 thread)
+
+screen:  api.find_next_trade, skipping epics already in flight
+enrich:  client sentiment, then prices and high/low for candidates passing quick_check
+predict: linear regression
+execute: api.placeOrder
+
+Enrichment workers share the API's trackcall budget, so with enough workers the
+number of decisions a minute is set by the API allowance rather than by latency.
+An epic is in flight from screening until its order is placed or it is dropped,
+so it can't be ordered twice. Full queues block the stage before them. Each
+screened candidate ends up counted in counts as ordered (its deal accepted),
+rejected (by the checks, the prediction or the deal), stale or failed.
+"""
+
+import itertools
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from lib.allowance import candidate_value
+from lib.latency import TRACKER, Trace
+from lib.logs import event
+from lib.prediction import Prediction
+
+ALGORITHMS = ['LinearRegression']
+
+_STOP = object()
+
+
+class Candidate(object):
+    __slots__ = ('epic_id', 'values', 'value', 'found_at', 'prediction', 'x', 'y', 'high_price', 'low_price', 'trace')
+
+    def __init__(self, epic_id, values, value, trace=None):
+        self.epic_id = epic_id
+        self.values = values
+        self.value = value
+        self.trace = trace
+        self.found_at = time.time()
+        self.prediction = None
+        self.x = self.y = None
+        self.high_price = self.low_price = None
+
+
+class TradePipeline(object):
+
+    def __init__(self, api, workers=4, queue_size=8, max_age=60):
+        """
+        :param api: ig.API
+        :param workers: enrichment threads
+        :param queue_size: bound of each queue between stages
+        :param max_age: seconds after screening a candidate is too stale to order
+        """
+        self.logger = logging.getLogger('TradePipeline')
+        self.logger.debug('pipeline.py TradePipeline __init__')
+        self.api = api
+        self.workers = max(1, workers)
+        self.max_age = max_age
+
+        # most valuable first, they get the historical data allowance when it runs short
+        self.to_enrich = queue.PriorityQueue(queue_size)
+        self._order = itertools.count()
+        self.to_predict = queue.Queue(queue_size)
+        self.to_execute = queue.Queue(queue_size)
+
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._enrich_threads = []
+        self._predict_thread = self._execute_thread = None
+        self.counts = {'screened': 0, 'rejected': 0, 'stale': 0, 'failed': 0, 'ordered': 0}
+
+    def _claim(self, epic_id):
+        with self._in_flight_lock:
+            if epic_id in self._in_flight:
+                return False
+            self._in_flight.add(epic_id)
+            self.counts['screened'] += 1
+            return True
+
+    def _release(self, candidate, outcome):
+        with self._in_flight_lock:
+            self._in_flight.discard(candidate.epic_id)
+            self.counts[outcome] += 1
+
+    def format_counts(self):
+        """e.g. '12 screened: 3 ordered, 7 rejected, 1 stale, 1 failed, 0 in flight'"""
+        with self._in_flight_lock:
+            counts = dict(self.counts)
+            in_flight = len(self._in_flight)
+        return '{0} screened: {1} ordered, {2} rejected, {3} stale, {4} failed, {5} in flight'.format(
+            counts['screened'], counts['ordered'], counts['rejected'], counts['stale'], counts['failed'], in_flight)
+
+    def in_flight(self):
+        with self._in_flight_lock:
+            return frozenset(self._in_flight)
+
+    def _screen(self):
+        while not self._stopping.is_set():
+            try:
+                d = self.api.find_next_trade(exclude=self.in_flight())
+            except Exception:
+                self.logger.exception('pipeline.py TradePipeline _screen: find_next_trade failed')
+                time.sleep(5)
+                continue
+            epic_id = d['values']['EPIC']
+            if self._stopping.is_set() or not self._claim(epic_id):
+                continue
+            # timed from the tick that made it a candidate
+            trace = Trace(epic_id, d.get('received'))
+            trace.mark('screen')
+            value = self.value(epic_id, d['values'])
+            self.to_enrich.put((-value, next(self._order), Candidate(epic_id, d['values'], value, trace)))
+
+    def value(self, epic_id, values):
+        settings = self.api.settings
+        try:
+            return float(candidate_value(float(values['CHANGE_PCT'] or 0), float(values['BID']), float(values['OFFER']),
+                                         settings.trade.Price_Change_Day_percent_low,
+                                         settings.trade.Price_Change_Day_percent_high,
+                                         settings.max_spread_for(epic_id)))
+        except (KeyError, TypeError, ValueError):
+            return 0.0
+
+    def _enrich(self):
+        while True:
+            candidate = self.to_enrich.get()[2]
+            if candidate is _STOP:
+                break
+            try:
+                prediction = Prediction(self.api.settings)
+                prediction.epic_id = candidate.epic_id
+                prediction.current_price = float(candidate.values['BID'])
+                prediction.set_marketdata(self.api.clientsentiment(candidate.epic_id))
+                if prediction.quick_check() is None:
+                    # no point pulling in market data, we'll reject this later on anyway
+                    self._release(candidate, 'rejected')
+                    continue
+                candidate.prediction = prediction
+                xy = self.api.fetch_lg_prices(candidate.epic_id, candidate.value)
+                if xy is None:
+                    self.logger.info('pipeline.py TradePipeline _enrich: {0} no price history'.format(candidate.epic_id))
+                    self._release(candidate, 'rejected')
+                    continue
+                candidate.x, candidate.y = xy
+                candidate.high_price, candidate.low_price = self.api.fetch_lg_highlow(candidate.epic_id, candidate.value)
+            except Exception:
+                self.logger.exception('pipeline.py TradePipeline _enrich: {0}'.format(candidate.epic_id))
+                self._release(candidate, 'failed')
+                continue
+            candidate.trace.mark('enrich')
+            self.to_predict.put(candidate)
+
+    def _predict(self):
+        while True:
+            candidate = self.to_predict.get()
+            if candidate is _STOP:
+                break
+            prediction = candidate.prediction
+            try:
+                algorithm = prediction.settings.trade.algorithm
+                if algorithm == 'LinearRegression':
+                    prediction.linear_regression(x=candidate.x, y=candidate.y,
+                                                 high_price=candidate.high_price, low_price=candidate.low_price)
+                else:
+                    self.logger.error('pipeline.py TradePipeline _predict: Trading Algorithm: {} not found'.format(algorithm))
+            except Exception:
+                self.logger.exception('pipeline.py TradePipeline _predict: {0}'.format(candidate.epic_id))
+                self._release(candidate, 'failed')
+                continue
+            if prediction.direction_to_trade is None:
+                event('no_direction', "!!DEBUG!! Literally NO decent trade direction could be determined",
+                      epic=candidate.epic_id)
+                self._release(candidate, 'rejected')
+                continue
+            candidate.trace.mark('predict')
+            self.to_execute.put(candidate)
+
+    def _execute(self):
+        while True:
+            candidate = self.to_execute.get()
+            if candidate is _STOP:
+                break
+            if time.time() - candidate.found_at > self.max_age:
+                self.logger.info('pipeline.py TradePipeline _execute: {0} too old to order'.format(candidate.epic_id))
+                self._release(candidate, 'stale')
+                continue
+            try:
+                status = self.api.placeOrder(candidate.prediction, trace=candidate.trace)
+            except Exception:
+                self.logger.exception('pipeline.py TradePipeline _execute: {0}'.format(candidate.epic_id))
+                self._release(candidate, 'failed')
+                continue
+            if status == 'ACCEPTED':
+                # placeOrder refreshed open_positions, so screening skips this epic from now on
+                self._release(candidate, 'ordered')
+            elif status == 'REJECTED':
+                self._release(candidate, 'rejected')
+            else:
+                self._release(candidate, 'failed')
+
+    def _start(self, name, target):
+        thread = threading.Thread(name=name, target=target)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def start(self):
+        self.logger.debug('pipeline.py TradePipeline start')
+        self._execute_thread = self._start("PIPELINE-EXECUTE-THREAD", self._execute)
+        self._predict_thread = self._start("PIPELINE-PREDICT-THREAD", self._predict)
+        self._enrich_threads = [self._start("PIPELINE-ENRICH-THREAD-{0}".format(i), self._enrich)
+                                for i in range(self.workers)]
+        return self._start("PIPELINE-SCREEN-THREAD", self._screen)
+
+    def run(self, report_interval=300):
+        """Run until stop() is called from another thread, logging latencies every report_interval seconds."""
+        screen = self.start()
+        reported = time.time()
+        while screen.is_alive():
+            screen.join(1)
+            if time.time() - reported >= report_interval:
+                reported = time.time()
+                self.logger.info('pipeline.py TradePipeline: {0}'.format(self.format_counts()))
+                self.logger.info('pipeline.py TradePipeline: {0}'.format(TRACKER.format_summary()))
+                if self.api.rate_limiter is not None:
+                    self.logger.info('pipeline.py TradePipeline: API calls {0}'.format(self.api.rate_limiter.format_usage()))
+
+    def stop(self):
+        """Stop screening, and wait for candidates already queued to finish, stage by stage."""
+        self.logger.debug('pipeline.py TradePipeline stop')
+        self._stopping.set()
+        for thread in self._enrich_threads:
+            self.to_enrich.put((float('inf'), next(self._order), _STOP))
+        for thread in self._enrich_threads:
+            thread.join()
+        self.to_predict.put(_STOP)
+        self._predict_thread.join()
+        self.to_execute.put(_STOP)
+        self._execute_thread.join()
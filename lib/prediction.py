@@ -10,30 +10,38 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import logging
+
 import numpy as np
 
+from lib.logs import event
+from lib.profiler import timed
+
 class Prediction(object):
 
-	def __init__(self, config):
-		self.config = config
-		self.predict_accuracy = float(config['Trade']['predict_accuracy'])
-		self.use_clientsentiment = eval(config['Trade']['use_clientsentiment'])
-		self.clientsentiment_contrarian = eval(config['Trade']['clientsentiment_contrarian'])
-		self.clientsentiment_value = float(config['Trade']['clientsentiment_value'])
-		self.hightrend_watermark = float(config['Trade']['hightrend_watermark'])
-		self.greed = float(config['Trade']['greed'])
+	def __init__(self, settings):
+		# settings: lib.settings.Settings snapshot
+		self.logger = logging.getLogger('Prediction')
+		trade = settings.trade
+		self.settings = settings
+		self.predict_accuracy = trade.predict_accuracy
+		self.use_clientsentiment = trade.use_clientsentiment
+		self.clientsentiment_contrarian = trade.clientsentiment_contrarian
+		self.clientsentiment_value = trade.clientsentiment_value
+		self.hightrend_watermark = trade.hightrend_watermark
+		self.greed = trade.greed
 
 		self.epic_id = None
 		self.current_price = None
 		self.direction_to_trade = None
-		self.stopdistance = float(config['Trade']['stopDistance_value'])
+		self.stopdistance = trade.stopDistance_value
 
 		self.limitDistance = 4 # initial setting to be overridden
 		self.ordertype = "MARKET"
 		self.expirytype = "DFB"
 		self.currencycode = "GBP"
 		self.forceopen = True
-		self.size = float(config['Trade']['size'])
+		self.size = trade.size
 
 	def get_tradedata(self):
 		return {  "direction": self.direction_to_trade,
@@ -71,8 +79,9 @@ class Prediction(object):
 		elif self.longPositionPercentage >= self.hightrend_watermark:
 				self.direction_to_trade = "BUY"
 		else:
-				print ("No Trade This time")
-				print ("!!DEBUG shortPositionPercentage:{} longPositionPercentage:{} clientsentiment_value:{} hightrend_watermark:{}".format(self.shortPositionPercentage, self.longPositionPercentage, self.clientsentiment_value, self.hightrend_watermark))
+				event('no_trade', "No Trade This time, !!DEBUG shortPositionPercentage:{short_pct} longPositionPercentage:{long_pct} clientsentiment_value:{sentiment_value} hightrend_watermark:{hightrend_watermark}",
+					  epic=self.epic_id, short_pct=self.shortPositionPercentage, long_pct=self.longPositionPercentage,
+					  sentiment_value=self.clientsentiment_value, hightrend_watermark=self.hightrend_watermark)
 				return None
 
 	def trade_type_by_priceprediction(self):
@@ -96,7 +105,9 @@ class Prediction(object):
 		price_prediction = self.price_prediction
 		price_diff = float(current_price - price_prediction)
 
-		print ("price_diff:{} score:{} current_price:{} limitDistance:{} predict_accuracy:{} price_prediction:{}".format(price_diff, score, current_price, self.limitDistance, self.predict_accuracy, price_prediction))
+		event('direction', "price_diff:{price_diff} score:{score} current_price:{current_price} limitDistance:{limit_distance} predict_accuracy:{predict_accuracy} price_prediction:{prediction}",
+			  epic=self.epic_id, price_diff=price_diff, score=score, current_price=current_price,
+			  limit_distance=self.limitDistance, predict_accuracy=self.predict_accuracy, prediction=price_prediction)
 
 		self.limitDistance = round(price_diff * score * self.greed, 1) # vary according to certainty and greed
 		if self.limitDistance < 0:
@@ -118,6 +129,7 @@ class Prediction(object):
 
 		return self.direction_to_trade
 
+	@timed('linear_regression')
 	def linear_regression(self, x, y, high_price, low_price):
 
 		from sklearn.linear_model import LinearRegression
@@ -134,7 +146,8 @@ class Prediction(object):
 		pred_ict = np.asarray(pred_ict) #To Numpy Array, hacky but good!! 
 		pred_ict = pred_ict.reshape(1, -1)
 		self.price_prediction = genius_regression_model.predict(pred_ict)
-		print ("PRICE PREDICTION FOR PRICE " + self.epic_id + " IS : " + str(self.price_prediction))
+		event('prediction', "PRICE PREDICTION FOR PRICE {epic} IS : {prediction}", epic=self.epic_id,
+			  prediction=self.price_prediction)
 
 		self.score = genius_regression_model.score(x,y)
 		predictions = { 'intercept': genius_regression_model.intercept_, 
@@ -142,8 +155,6 @@ class Prediction(object):
 										'current_price': self.current_price, 
 										'predicted_value': self.price_prediction, 
 										'accuracy' : self.score }
-		print ("-----------------DEBUG-----------------")
-		print (predictions)
-		print ("-----------------DEBUG-----------------")
+		self.logger.debug('prediction.py Prediction linear_regression: {0}'.format(predictions))
 		self.determine_trade_direction()
 
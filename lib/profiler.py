@@ -0,0 +1,240 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Where the trading loop spends its time, as Prometheus metrics.
+
+Stages are timed with the timed() decorator or a span() block, under a name:
+
+    @timed('find_next_trade')
+    def find_next_trade(self, exclude=()):
+        ...
+
+    with span('placeOrder.sleep'):
+        time.sleep(2)
+
+Every IGClient endpoint is timed as 'api.<method>' and the wait for the
+trackcall rate limit as 'api.ratelimit_wait'. Each name gets a latency
+histogram, a call count and an error count (calls that raised). Timing is
+off until enable() is called; while off a span costs one attribute check.
+
+render() gives the Prometheus text format, MetricsExporter writes it to a file
+for node_exporter's textfile collector and/or serves it on /metrics.
+"""
+
+import bisect
+import functools
+import logging
+import os
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+_clock = time.perf_counter
+
+# seconds, from a dict lookup to a rate limited API call
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Profiler(object):
+
+    def __init__(self, buckets=BUCKETS):
+        self.enabled = False
+        self.buckets = tuple(buckets)
+        self._stats = {}  # name -> [count per bucket, sum, count, errors]
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, error=False):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = [[0] * len(self.buckets), 0.0, 0, 0]
+            stat[0][i] += 1
+            stat[1] += seconds
+            stat[2] += 1
+            if error:
+                stat[3] += 1
+
+    def snapshot(self):
+        """:return: {name: {'count', 'sum', 'errors', 'buckets'}}, buckets as cumulative counts"""
+        with self._lock:
+            stats = dict((name, (list(b), s, c, e)) for name, (b, s, c, e) in self._stats.items())
+        result = {}
+        for name, (buckets, total, count, errors) in stats.items():
+            cumulative, running = [], 0
+            for n in buckets:
+                running += n
+                cumulative.append(running)
+            result[name] = {'count': count, 'sum': total, 'errors': errors, 'buckets': cumulative}
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def render(self, prefix='igtrader'):
+        """:return: the metrics in the Prometheus text exposition format"""
+        lines = ['# HELP {0}_span_seconds Time spent in each stage of the trading loop'.format(prefix),
+                 '# TYPE {0}_span_seconds histogram'.format(prefix)]
+        snapshot = self.snapshot()
+        for name in sorted(snapshot):
+            stat = snapshot[name]
+            for le, n in zip(self.buckets, stat['buckets']):
+                lines.append('{0}_span_seconds_bucket{{span="{1}",le="{2}"}} {3}'.format(
+                    prefix, name, '+Inf' if le == float('inf') else repr(le), n))
+            lines.append('{0}_span_seconds_sum{{span="{1}"}} {2!r}'.format(prefix, name, stat['sum']))
+            lines.append('{0}_span_seconds_count{{span="{1}"}} {2}'.format(prefix, name, stat['count']))
+        lines += ['# HELP {0}_span_errors_total Calls of each stage that raised'.format(prefix),
+                  '# TYPE {0}_span_errors_total counter'.format(prefix)]
+        for name in sorted(snapshot):
+            lines.append('{0}_span_errors_total{{span="{1}"}} {2}'.format(prefix, name, snapshot[name]['errors']))
+        return '\n'.join(lines) + '\n'
+
+
+PROFILER = Profiler()
+
+
+def enable():
+    PROFILER.enabled = True
+
+
+def disable():
+    PROFILER.enabled = False
+
+
+class _Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        PROFILER.record(self.name, _clock() - self.start, exc_type is not None)
+        return False
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(name):
+    """Time a with block under name."""
+    if not PROFILER.enabled:
+        return _NO_SPAN
+    return _Span(name)
+
+
+def timed(name):
+    """Decorator timing every call of a function under name."""
+    def decorate(f):
+        @functools.wraps(f)
+        def wrap(*args, **kwargs):
+            if not PROFILER.enabled:
+                return f(*args, **kwargs)
+            start = _clock()
+            error = True
+            try:
+                result = f(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                PROFILER.record(name, _clock() - start, error)
+        return wrap
+    return decorate
+
+
+class MetricsExporter(object):
+
+    def __init__(self, profiler=PROFILER, path=None, port=0, interval=15, host='127.0.0.1'):
+        """
+        :param path: file rewritten with the metrics every interval seconds, None for none
+        :param port: serve the metrics on http://host:port/metrics, 0 for no server
+        """
+        self.logger = logging.getLogger('MetricsExporter')
+        self.logger.debug('profiler.py MetricsExporter __init__')
+        self.profiler = profiler
+        self.path = path
+        self.port = port
+        self.interval = interval
+        self.host = host
+        self.server = None
+        self._stop = threading.Event()
+
+    def write(self):
+        # written aside and renamed, so a collector never reads half a file
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.profiler.render())
+        os.replace(tmp, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                self.logger.exception('profiler.py MetricsExporter: could not write {0}'.format(self.path))
+
+    def _handler(self):
+        profiler = self.profiler
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = profiler.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.logger.debug('profiler.py MetricsExporter start')
+        if self.path:
+            thread = threading.Thread(name="METRICS-FILE-THREAD", target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+        if self.port:
+            self.server = HTTPServer((self.host, self.port), self._handler())
+            thread = threading.Thread(name="METRICS-HTTP-THREAD", target=self.server.serve_forever)
+            thread.setDaemon(True)
+            thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+        if self.path:
+            self.write()
@@ -0,0 +1,179 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""One API call budget for every process on the host using the same key.
+
+IG allows about 30 calls a minute per API key, and on its own each IGClient
+assumes it has all of them. With [Config] RATE_LIMIT_FILE set, trackcall
+takes its calls from a SharedRateLimiter instead: a sliding window of the
+last minute's calls, kept in that file and updated under an exclusive lock,
+so faig.py, streamer.py and any other scripts side by side stay within one
+budget between them.
+
+Each call has a priority by endpoint. Lower priorities leave some of the
+window to the higher ones, so orders go out while history fetches wait:
+
+    trade    positions, positions_otc, positions_otc_close, confirms: the whole window
+    default  everything else: all but RESERVE['default'] calls
+    history  prices: all but RESERVE['history'] calls
+
+A call can also name its priority, e.g. the instrument catalogue's background
+refresh calls markets(epic_id, priority=HISTORY).
+
+The file also counts calls and seconds waited per client, see usage(), and
+
+    python -m lib.ratelimit ratelimit.json
+
+prints them.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+TRADE = 'trade'
+DEFAULT = 'default'
+HISTORY = 'history'
+
+PRIORITIES = {
+    'positions': TRADE,
+    'positions_otc': TRADE,
+    'positions_otc_close': TRADE,
+    'confirms': TRADE,
+    'prices': HISTORY,
+}
+
+# calls of the window each priority leaves to those above it
+RESERVE = {TRADE: 0, DEFAULT: 4, HISTORY: 8}
+
+
+def priority_of(name):
+    """Priority of an IGClient method."""
+    return PRIORITIES.get(name, DEFAULT)
+
+
+def default_client_name():
+    return '{0}:{1}'.format(os.path.basename(sys.argv[0] or 'python'), os.getpid())
+
+
+class SharedRateLimiter(object):
+
+    def __init__(self, path, client=None, max_calls=30-1, period=60, reserve=None, forget=86400):
+        """
+        :param path: file the window is kept in, shared by every client
+        :param client: this client's name in usage(), the script and pid if None
+        :param reserve: {priority: calls left to higher priorities}, RESERVE if None
+        :param forget: seconds after its last call a client is left out of usage()
+        """
+        if fcntl is None:
+            raise RuntimeError('ratelimit.py SharedRateLimiter needs fcntl, leave RATE_LIMIT_FILE empty here')
+        self.logger = logging.getLogger('SharedRateLimiter')
+        self.logger.debug('ratelimit.py SharedRateLimiter __init__')
+        self.path = path
+        self.client = client or default_client_name()
+        self.max_calls = max_calls
+        self.period = period
+        self.reserve = dict(RESERVE if reserve is None else reserve)
+        self.forget = forget
+
+    @contextlib.contextmanager
+    def _state(self, write=True):
+        # a fresh descriptor each time, so threads of one process lock each other out too
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+            text = f.read()
+            try:
+                state = json.loads(text) if text.strip() else {}
+            except ValueError:
+                self.logger.warning('ratelimit.py SharedRateLimiter: {0} unreadable, starting over'.format(self.path))
+                state = {}
+            state.setdefault('calls', [])  # [time, client, priority]
+            state.setdefault('clients', {})  # client -> {'calls', 'waited', 'last'}
+            yield state
+            if write:
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+
+    def acquire(self, priority=DEFAULT):
+        """
+        Wait for a call of priority to fit in the window, and take it
+        :return: seconds waited
+        """
+        limit = max(1, self.max_calls - self.reserve.get(priority, 0))
+        start = time.time()
+        while True:
+            with self._state() as state:
+                now = time.time()
+                calls = state['calls'] = [c for c in state['calls'] if c[0] > now - self.period]
+                if len(calls) < limit:
+                    calls.append([now, self.client, priority])
+                    waited = now - start
+                    stats = state['clients'].setdefault(self.client, {'calls': 0, 'waited': 0.0, 'last': now})
+                    stats['calls'] += 1
+                    stats['waited'] += waited
+                    stats['last'] = now
+                    for client in [c for c, s in state['clients'].items() if s['last'] < now - self.forget]:
+                        del state['clients'][client]
+                    return waited
+                # until enough of the window has aged out for this priority
+                wait = calls[len(calls) - limit][0] + self.period - now
+            time.sleep(min(max(wait, 0.05), self.period))
+
+    def usage(self):
+        """
+        :return: {'window': calls in the last period, 'max_calls', 'clients': {client: {'window': {priority: calls},
+                 'calls': total, 'waited': seconds in total, 'last': time}}}
+        """
+        now = time.time()
+        with self._state(write=False) as state:
+            calls = [c for c in state['calls'] if c[0] > now - self.period]
+            clients = dict((client, dict(stats, window={})) for client, stats in state['clients'].items())
+        for _, client, priority in calls:
+            window = clients.setdefault(client, {'calls': 0, 'waited': 0.0, 'last': 0, 'window': {}})['window']
+            window[priority] = window.get(priority, 0) + 1
+        return {'window': len(calls), 'max_calls': self.max_calls, 'clients': clients}
+
+    def format_usage(self):
+        usage = self.usage()
+        return '{0}/{1} calls this minute; '.format(usage['window'], usage['max_calls']) + ', '.join(
+            '{0} {1} this minute ({2} calls, {3:.0f}s waited)'.format(
+                client, sum(s['window'].values()), s['calls'], s['waited'])
+            for client, s in sorted(usage['clients'].items()))
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('usage: python -m lib.ratelimit RATE_LIMIT_FILE')
+        sys.exit(2)
+    usage = SharedRateLimiter(sys.argv[1], client='-').usage()
+    print('{0}/{1} calls in the last minute'.format(usage['window'], usage['max_calls']))
+    print('{0:<28} {1:>6} {2:>6} {3:>8} {4:>8} {5:>10} {6:>10}'.format(
+        'client', TRADE, DEFAULT, HISTORY, 'calls', 'waited s', 'idle s'))
+    for client, s in sorted(usage['clients'].items()):
+        print('{0:<28} {1:>6} {2:>6} {3:>8} {4:>8} {5:>10.1f} {6:>10.0f}'.format(
+            client, s['window'].get(TRADE, 0), s['window'].get(DEFAULT, 0), s['window'].get(HISTORY, 0),
+            s['calls'], s['waited'], time.time() - s['last']))
+
+
+if __name__ == '__main__':
+    main()
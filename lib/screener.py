@@ -0,0 +1,140 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+class Screener(object):
+    """Keeps the latest CHANGE_PCT, BID and OFFER of every epic in NumPy arrays
+    and publishes epics passing the find_next_trade checks to a queue:
+
+        Price_Change_Day_percent_low < |CHANGE_PCT| < Price_Change_Day_percent_high
+        BID - OFFER > max_spread (per epic, negative)
+
+    on_update is a stream listener for MARKET:{epic} items. An epic is published
+    when it starts passing, and again after cooldown seconds if it still passes.
+    """
+
+    def __init__(self, epic_ids, change_high, change_low, max_spreads, cooldown=60):
+        self.epic_ids = list(epic_ids)
+        self._index = dict((epic_id, i) for i, epic_id in enumerate(self.epic_ids))
+        n = len(self.epic_ids)
+
+        self.change_high = float(change_high)
+        self.change_low = float(change_low)
+        self.max_spread = np.asarray(max_spreads, dtype=float)
+        self.cooldown = cooldown
+
+        self.change_pct = np.zeros(n)
+        self.bid = np.full(n, np.nan)
+        self.offer = np.full(n, np.nan)
+        self.excluded = np.zeros(n, dtype=bool)
+        self.queued = np.zeros(n, dtype=bool)
+        self.published_at = np.full(n, -np.inf)
+
+        self.values = [None] * n  # latest stream values per epic, as find_next_trade returned them
+        self.received = np.full(n, np.nan)  # when those arrived, time.monotonic()
+        self.candidates = queue.Queue()
+        self._lock = threading.Lock()
+
+    def passing(self):
+        """Vectorised check of every epic, excluded ones included."""
+        change = np.abs(self.change_pct)
+        with np.errstate(invalid='ignore'):
+            return (self.change_low < change) & (change < self.change_high) & \
+                   ((self.bid - self.offer) > self.max_spread)
+
+    def _passes(self, i):
+        change = abs(self.change_pct[i])
+        return self.change_low < change < self.change_high and (self.bid[i] - self.offer[i]) > self.max_spread[i]
+
+    def _publish(self, rows, now):
+        for i in rows:
+            self.queued[i] = True
+            self.published_at[i] = now
+            self.candidates.put(i)
+
+    def on_update(self, item_info):
+        epic_id = item_info['name'].split(':', 1)[1]
+        i = self._index.get(epic_id)
+        if i is None:
+            return
+        values = item_info['values']
+        with self._lock:
+            change_pct = values.get('CHANGE_PCT')
+            self.change_pct[i] = 0.0 if change_pct is None else float(change_pct)
+            self.bid[i] = np.nan if values.get('BID') is None else float(values['BID'])
+            self.offer[i] = np.nan if values.get('OFFER') is None else float(values['OFFER'])
+            self.values[i] = dict(values)
+            self.received[i] = item_info.get('received', np.nan)
+            now = time.time()
+            if not self.queued[i] and not self.excluded[i] and now - self.published_at[i] >= self.cooldown \
+                    and self._passes(i):
+                self._publish([i], now)
+
+    def scan(self):
+        """Publish every epic passing now that isn't queued, excluded or cooling down."""
+        with self._lock:
+            now = time.time()
+            ready = self.passing() & ~self.queued & ~self.excluded & (now - self.published_at >= self.cooldown)
+            self._publish(np.flatnonzero(ready), now)
+
+    def set_thresholds(self, change_high, change_low, max_spreads):
+        """Swap in new limits, e.g. after a settings reload, and rescan."""
+        with self._lock:
+            self.change_high = float(change_high)
+            self.change_low = float(change_low)
+            self.max_spread = np.asarray(max_spreads, dtype=float)
+        self.scan()
+
+    def latest(self, epic_id):
+        """:return: the epic's latest stream values, None if none yet or not screened"""
+        i = self._index.get(epic_id)
+        with self._lock:
+            return None if i is None or self.values[i] is None else dict(self.values[i])
+
+    def set_excluded(self, epic_ids):
+        """Exclude epics, e.g. those with open positions, and rescan the others."""
+        with self._lock:
+            self.excluded[:] = False
+            for epic_id in epic_ids:
+                if epic_id in self._index:
+                    self.excluded[self._index[epic_id]] = True
+        self.scan()
+
+    def next_candidate(self, timeout=None):
+        """
+        Wait for the next epic that passes
+        :param timeout: seconds, None waits for ever
+        :return: {'values': {..., 'EPIC': epic_id}, 'received': ...} like find_next_trade, or None on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            try:
+                i = self.candidates.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            with self._lock:
+                self.queued[i] = False
+                # the queue may be stale by now, so check again
+                if self.excluded[i] or not self._passes(i):
+                    self.published_at[i] = -np.inf
+                    continue
+                values = dict(self.values[i])
+                received = float(self.received[i])
+            values['EPIC'] = self.epic_ids[i]
+            return {'values': values, 'received': None if np.isnan(received) else received}
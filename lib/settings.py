@@ -0,0 +1,212 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Typed snapshot of the [Trade] and [Epics] config sections.
+
+build_settings parses and validates a ConfigParser once. The result is
+immutable, so a thread can keep using the snapshot it picked up while
+SettingsWatcher swaps in a new one after a config file changes:
+
+    watcher = SettingsWatcher(load, ['default.conf', 'config.conf'])
+    watcher.start()
+    settings = watcher.current  # read once per iteration
+"""
+
+import collections
+import configparser
+import json
+import logging
+import os
+import threading
+import types
+
+import numpy as np
+
+
+def _boolean(value):
+    # the same strings ConfigParser.getboolean accepts
+    try:
+        return {'1': True, 'yes': True, 'true': True, 'on': True,
+                '0': False, 'no': False, 'false': False, 'off': False}[value.strip().lower()]
+    except KeyError:
+        raise ValueError('not a boolean: {0!r}'.format(value))
+
+
+# [Trade] key -> type
+TRADE_KEYS = collections.OrderedDict([
+    ('algorithm', str),
+    ('high_resolution', _boolean),
+    ('use_clientsentiment', _boolean),
+    ('clientsentiment_contrarian', _boolean),
+    ('clientsentiment_value', float),
+    ('hightrend_watermark', float),
+    ('predict_accuracy', float),
+    ('Price_Change_Day_percent_high', float),
+    ('Price_Change_Day_percent_low', float),
+    ('use_max_spread', _boolean),
+    ('max_spread', float),
+    ('spread_multiplier', float),
+    ('greed', float),
+    ('size', float),
+    ('stopDistance_value', float),
+    ('always_guarantee_stops', _boolean),
+    ('never_guarantee_stops', _boolean),
+    ('exit_trailing_stop', float),
+    ('exit_max_hold', float),
+    ('exit_target_pnl', float),
+])
+
+TradeSettings = collections.namedtuple('TradeSettings', list(TRADE_KEYS))
+
+
+class Settings(collections.namedtuple('Settings', ['trade', 'epic_ids', 'epic_index', 'minspread', 'max_spread'])):
+    """
+    trade: TradeSettings
+    epic_ids: tuple of epics in config order
+    epic_index: read-only {epic_id: row} into the arrays below
+    minspread: read-only array of each epic's minspread
+    max_spread: read-only array of the permitted BID - OFFER per epic (negative),
+                max_spread or minspread * spread_multiplier * -1 depending on use_max_spread
+    """
+    __slots__ = ()
+
+    def max_spread_for(self, epic_id):
+        return float(self.max_spread[self.epic_index[epic_id]])
+
+
+def _readonly(values):
+    array = np.array(values, dtype=float)
+    array.flags.writeable = False
+    return array
+
+
+def build_settings(config):
+    """
+    Parse and validate the [Trade] and [Epics] sections
+    :param config: ConfigParser
+    :return: Settings
+    :raises ValueError: naming the offending key
+    """
+    trade = {}
+    for key, convert in TRADE_KEYS.items():
+        try:
+            trade[key] = convert(config['Trade'][key])
+        except KeyError:
+            raise ValueError('[Trade] {0} is missing'.format(key))
+        except ValueError as e:
+            raise ValueError('[Trade] {0}: {1}'.format(key, e))
+    trade = TradeSettings(**trade)
+
+    if not 0 <= trade.Price_Change_Day_percent_low < trade.Price_Change_Day_percent_high:
+        raise ValueError('[Trade] Price_Change_Day_percent_low must be >= 0 and below Price_Change_Day_percent_high')
+    if not 0 <= trade.predict_accuracy <= 1:
+        raise ValueError('[Trade] predict_accuracy must be between 0 and 1')
+    if trade.size <= 0 or trade.stopDistance_value <= 0:
+        raise ValueError('[Trade] size and stopDistance_value must be positive')
+    if min(trade.exit_trailing_stop, trade.exit_max_hold, trade.exit_target_pnl) < 0:
+        raise ValueError('[Trade] exit_trailing_stop, exit_max_hold and exit_target_pnl must be 0 (off) or more')
+
+    try:
+        epics = json.loads(config['Epics']['EPICS'], object_pairs_hook=collections.OrderedDict)
+    except KeyError:
+        raise ValueError('[Epics] EPICS is missing')
+    except ValueError as e:
+        raise ValueError('[Epics] EPICS is not valid JSON: {0}'.format(e))
+    try:
+        minspread = [float(epics[epic_id]['minspread']) for epic_id in epics]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('[Epics] every epic needs a numeric minspread')
+
+    if trade.use_max_spread:
+        max_spread = [trade.max_spread] * len(minspread)
+    else:
+        max_spread = [m * trade.spread_multiplier * -1 for m in minspread]
+
+    epic_ids = tuple(epics)
+    return Settings(trade=trade,
+                    epic_ids=epic_ids,
+                    epic_index=types.MappingProxyType(dict((epic_id, i) for i, epic_id in enumerate(epic_ids))),
+                    minspread=_readonly(minspread),
+                    max_spread=_readonly(max_spread))
+
+
+class SettingsWatcher(object):
+    """Polls config file mtimes and swaps current for a fresh snapshot when one changes.
+
+    A snapshot failing to parse or validate is logged and ignored, the previous one stays current.
+    listeners are called with (old, new) on the watcher thread after each swap.
+    """
+
+    def __init__(self, load, paths, interval=5):
+        """
+        :param load: callable returning a new Settings
+        :param paths: config files to watch, missing ones are fine
+        :param interval: seconds between polls
+        """
+        self.logger = logging.getLogger('SettingsWatcher')
+        self.logger.debug('settings.py SettingsWatcher __init__')
+        self.load = load
+        self.paths = list(paths)
+        self.interval = interval
+        self.listeners = []
+        self._mtimes = self._stat()
+        self.current = load()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def check(self):
+        """Reload if a file changed since the last check. Returns True if current was swapped."""
+        mtimes = self._stat()
+        if mtimes == self._mtimes:
+            return False
+        self._mtimes = mtimes
+        try:
+            new = self.load()
+        except (ValueError, KeyError, configparser.Error) as e:
+            # e.g. a file saved half way through an edit, the next save is checked again
+            self.logger.error('settings.py SettingsWatcher check: keeping previous settings, {0!r}'.format(e))
+            return False
+        old, self.current = self.current, new
+        self.logger.info('settings.py SettingsWatcher check: settings reloaded')
+        for listener in self.listeners:
+            try:
+                listener(old, new)
+            except Exception:
+                self.logger.exception('settings.py SettingsWatcher check: listener failed')
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                # keep watching, hot reload shouldn't end with one bad check
+                self.logger.exception('settings.py SettingsWatcher _run: check failed')
+
+    def start(self):
+        self.logger.debug('settings.py SettingsWatcher start')
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(name="SETTINGS-WATCHER-THREAD", target=self._run)
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
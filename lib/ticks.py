@@ -0,0 +1,105 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Ticks from the stream, aggregated into one OHLC bar per epic per second, see streamer.py.
+
+Ticks and bars are kept as plain tuples in lists, and only become DataFrames
+in aggregate_ticks() and take(), so adding a tick costs the same however many
+came before it.
+"""
+
+import logging
+import threading
+import time
+
+import pandas as pd
+
+TICK_COLUMNS = ['timestamp', 'epic_id', 'bid', 'offer']
+BAR_COLUMNS = ['timestamp', 'epic_id', 'O', 'H', 'L', 'C', 'spread']
+
+
+class TickDB:
+    agg_size = 100  # size of buffer before aggregation is triggered
+    keep_time_secs = 5  # only aggregate ticks more than 3 seconds old, to avoid splitting up partial reads
+    max_bars = 100000  # bars kept until take(), the oldest are dropped past this if saving falls behind
+    def __init__(self):
+        logging.debug('ticks.py TickDB __init__:')
+        self._idx = 0
+        self._tick_buffer = []  # (timestamp, epic_id, bid, offer)
+        self._bars = []  # BAR_COLUMNS tuples
+        self.dropped_bars = 0
+        self._lock = threading.Lock()
+
+    def add_tick(self, new_data):
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('ticks.py TickDB add_tick:')
+            logging.debug(new_data)
+        self._idx += 1
+        self._tick_buffer.append((new_data['timestamp'], new_data['epic_id'], new_data['bid'], new_data['offer']))
+
+        if (self._idx % self.agg_size) == 0:
+            logging.debug('ticks.py TickDB add_tick: Aggregating')
+            # Aggregate data in buffer if old enough, keep the rest for next time
+            now = time.time()
+            old, recent = [], []
+            for tick in self._tick_buffer:
+                (old if abs(tick[0] - now) > self.keep_time_secs else recent).append(tick)
+            self._tick_buffer = recent
+            if not old:
+                return
+            aggregated = aggregate(old)
+            with self._lock:
+                self._bars.extend(aggregated)
+                if len(self._bars) > self.max_bars:
+                    self.dropped_bars += len(self._bars) - self.max_bars
+                    logging.warning('ticks.py TickDB add_tick: {0} bars not taken, dropping the oldest'.format(len(self._bars)))
+                    del self._bars[:-self.max_bars]
+
+    def take(self):
+        """The bars aggregated so far, as a DataFrame of BAR_COLUMNS, leaving none behind."""
+        with self._lock:
+            bars, self._bars = self._bars, []
+        return pd.DataFrame(bars, columns=BAR_COLUMNS)
+
+    def aggregate_ticks(self, tick_data):
+        """
+        :param tick_data: DataFrame of TICK_COLUMNS, oldest first
+        :return: DataFrame of BAR_COLUMNS, see aggregate
+        """
+        logging.debug('ticks.py TickDB aggregate_ticks:')
+        return pd.DataFrame(aggregate(tick_data[TICK_COLUMNS].itertuples(index=False, name=None)),
+                            columns=BAR_COLUMNS)
+
+
+def aggregate(ticks):
+    """
+    OHLC of the mid price and the mean spread for each epic each second
+    :param ticks: (timestamp, epic_id, bid, offer), oldest first
+    :return: BAR_COLUMNS tuples, epic by epic, each second in order
+    """
+    bars = {}  # epic_id -> {timestamp: [O, H, L, C, spread sum, ticks]}, both in order of their first tick
+    for timestamp, epic_id, bid, offer in ticks:
+        mid = (offer + bid) / 2
+        bar = bars.setdefault(epic_id, {}).get(timestamp)
+        if bar is None:
+            bars[epic_id][timestamp] = [mid, mid, mid, mid, offer - bid, 1]
+            continue
+        if mid > bar[1]:
+            bar[1] = mid
+        if mid < bar[2]:
+            bar[2] = mid
+        bar[3] = mid
+        bar[4] += offer - bid
+        bar[5] += 1
+    return [(timestamp, epic_id, o, h, l, c, spread / n)
+            for epic_id, seconds in bars.items()
+            for timestamp, (o, h, l, c, spread, n) in seconds.items()]
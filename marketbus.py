@@ -0,0 +1,85 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Market data daemon: one stream session publishing prices for every process on the host.
+
+Streams MARKET updates of the [Epics] and CHART bars at MARKET_BUS_SCALE
+into the MARKET_BUS file, see lib/bus.py. faig.py and any other API()
+with the same MARKET_BUS screen off it and take its bars instead of
+subscribing themselves, and subscribe again if its heartbeat stops. They
+still log in and stream TRADE, ACCOUNT and their positions' prices:
+
+    python marketbus.py
+    python -m lib.ratelimit ratelimit.json   # the daemon's calls, with RATE_LIMIT_FILE
+"""
+
+import logging
+import signal
+import threading
+
+import igstream
+from igclient import IGClient, load_config
+from igsession import SessionManager
+from lib.bus import MARKET_FIELDS, MarketBus
+from lib.candles import FIELDS as CHART_FIELDS
+from lib.logs import setup_from_config
+
+
+def main():
+    config = load_config()
+    setup_from_config(config, filename='marketbus-logfile.txt')
+    logger = logging.getLogger('marketbus')
+    section = config['Config']
+
+    client = IGClient(config)
+    session_manager = SessionManager(client, section.get('SESSION_FILE', fallback='') or None)
+    d = session_manager.login()
+    if client.accountId is None:
+        client.select_account()
+        session_manager.save()
+    session_manager.start()
+
+    epic_ids = client.settings.epic_ids
+    scale = section.get('MARKET_BUS_SCALE', fallback='1MINUTE')
+    bus = MarketBus(epic_ids, path=section.get('MARKET_BUS', fallback='') or None,
+                    n_bars=section.getint('MARKET_BUS_BARS', fallback=120), scale=scale)
+    stream = igstream.IGStream(igclient=client, loginresponse=d,
+                               dispatch_queue_size=section.getint('STREAM_DISPATCH_QUEUE', fallback=0))
+
+    # every tick, the readers decide how often to look
+    market = igstream.Subscription.from_preset('record', mode="MERGE",
+                                               items=["MARKET:{}".format(epic_id) for epic_id in epic_ids],
+                                               fields=MARKET_FIELDS)
+    _, ok = stream.subscribe(subscription=market, listener=bus.on_market)
+    if not ok:
+        raise SystemExit('marketbus.py: MARKET subscription failed')
+    chart = igstream.Subscription.from_preset('candles', mode="MERGE",
+                                              items=["CHART:{0}:{1}".format(epic_id, scale) for epic_id in epic_ids],
+                                              fields=CHART_FIELDS)
+    _, ok = stream.subscribe(subscription=chart, listener=bus.on_chart)
+    if not ok:
+        logger.warning('marketbus.py: CHART:{0} subscription failed, publishing prices only'.format(scale))
+    logger.info('marketbus.py: publishing {0} epics to {1}'.format(len(epic_ids), bus.path))
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    try:
+        bus.run_heartbeat(stop)
+    except KeyboardInterrupt:
+        pass
+    bus.close()
+    stream.disconnect()
+    session_manager.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Soak test: a day of synthetic stream traffic, checking memory stays flat.
+
+The screen subscription of --epics MARKET items gets --rate updates per
+item per simulated second through LSClient's dispatch into the screener and
+the paper broker, as in faig.py. Every simulated minute a position monitor
+style subscription comes and goes, and a paper position is opened or
+closed; with --tickdb every update also goes into a TickDB, taken every
+hour as streamer.py saves it.
+
+RSS is sampled every simulated hour. Past --warmup hours it may grow by no
+more than --tolerance MB, or the exit status is 1:
+
+    python soak.py
+    python soak.py --hours 4 --rate 5 --out soak.json
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import time
+
+import igstream
+from bench import SCREEN_FIELDS, synthetic_feed
+from lib.latency import TRACKER
+from lib.paper import PaperBroker
+from lib.screener import Screener
+
+
+def rss():
+    """:return: bytes resident, the peak where there's no /proc"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SoakLSClient(igstream.LSClient):
+    """LSClient with a session that needs no server, lines are fed to _forward_update_message."""
+
+    server_lag = False  # synthetic stamps
+
+    def __init__(self):
+        super(SoakLSClient, self).__init__('http://soak/')
+        self.logger = logging.getLogger('SoakLSClient')
+        self._session = {'SessionId': 'SOAK'}
+
+    def _call(self, base_url, url, body):
+        raise IOError('No network calls during a soak test')
+
+    def _control(self, params):
+        return igstream.OK_CMD
+
+
+class SoakIGStream(igstream.IGStream):
+
+    def __init__(self):
+        self.logger = logging.getLogger('SoakIGStream')
+        self.logger.debug('soak.py SoakIGStream __init__')
+        self.recorder = None
+        self.lightstreamer_client = SoakLSClient()
+
+
+def _tick_listener(tick_db):
+    def on_update(item_info):
+        values = item_info['values']
+        tick_db.add_tick({'timestamp': int(time.time()), 'epic_id': item_info['name'].split(':', 1)[1],
+                          'bid': float(values['BID']), 'offer': float(values['OFFER'])})
+    return on_update
+
+
+def soak(epics=90, hours=24, rate=1.0, tickdb=False):
+    """
+    :return: {'rss': [bytes after each hour], 'updates', 'candidates', 'tables', 'results', 'seconds'}
+    """
+    logger = logging.getLogger('soak')
+    TRACKER.lag_alert = 0
+    stream = SoakIGStream()
+    client = stream.lightstreamer_client
+    items = ['MARKET:CS.D.SOAK{0:03d}.TODAY.IP'.format(i) for i in range(epics)]
+    epic_ids = [item.split(':', 1)[1] for item in items]
+
+    screener = Screener(epic_ids, change_high=1.9, change_low=0.2, max_spreads=[-2.0] * epics)
+    paper = PaperBroker(balance=1e9)
+    screen = igstream.Subscription.from_preset('screen', mode='MERGE', items=items, fields=SCREEN_FIELDS)
+    screen_key, _ = stream.subscribe(screen, screener.on_update)
+    screen.addlistener(paper.on_price)
+    if tickdb:
+        from lib.ticks import TickDB
+        tick_db = TickDB()
+        screen.addlistener(_tick_listener(tick_db))
+    baseline_tables = len(client._subscriptions)
+
+    per_minute = int(epics * rate * 60)
+    updates = candidates = 0
+    samples = []
+    start = time.monotonic()
+    for minute in range(int(hours * 60)):
+        prefix = '{0},'.format(screen_key)
+        for line in synthetic_feed(epics, per_minute + epics, seed=minute).lines:
+            client._forward_update_message(prefix + line, time.monotonic())
+        updates += per_minute + epics
+        while screener.next_candidate(timeout=0) is not None:
+            candidates += 1
+
+        # a position comes and goes, with the monitor's subscription to its prices
+        epic_id = epic_ids[minute % epics]
+        if minute % 2 == 0:
+            paper.positions_otc({'epic': epic_id, 'direction': 'BUY', 'size': 1, 'stopDistance': 1e6,
+                                 'limitDistance': 1e6})
+        else:
+            for position in paper.positions()['positions']:
+                paper.positions_otc_close({'dealId': position['position']['dealId']})
+        monitor = igstream.Subscription.from_preset('monitor', mode='MERGE', items=['MARKET:' + epic_id],
+                                                    fields=['BID', 'OFFER', 'MARKET_STATE'])
+        monitor_key, _ = stream.subscribe(monitor, paper.on_price)
+        client._forward_update_message('{0},1|1.0|1.1|TRADEABLE'.format(monitor_key), time.monotonic())
+        stream.unsubscribe(monitor_key)
+
+        if (minute + 1) % 60 == 0:
+            if tickdb:
+                tick_db.take()
+            gc.collect()
+            samples.append(rss())
+            logger.info('soak.py hour {0}: rss {1:.1f} MB, {2} updates, {3:.0f} updates/s'.format(
+                len(samples), samples[-1] / 1e6, updates, updates / (time.monotonic() - start)))
+
+    return {'rss': samples, 'updates': updates, 'candidates': candidates,
+            'tables': len(client._subscriptions) - baseline_tables, 'results': len(screen._results),
+            'seconds': time.monotonic() - start}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a day of synthetic stream traffic and check memory is flat')
+    parser.add_argument('--epics', type=int, default=90)
+    parser.add_argument('--hours', type=float, default=24, help='simulated hours')
+    parser.add_argument('--rate', type=float, default=1.0, help='updates per item per simulated second')
+    parser.add_argument('--warmup', type=int, default=2, help='hours before growth counts')
+    parser.add_argument('--tolerance', type=float, default=16, help='MB of growth allowed after the warm up')
+    parser.add_argument('--tickdb', action='store_true', help='also aggregate every update in a TickDB, slow')
+    parser.add_argument('--out', help='write the result as JSON')
+    args = parser.parse_args()
+    if int(args.hours) <= max(args.warmup, 1):
+        parser.error('--hours must be more than --warmup')
+    logging.basicConfig(level=logging.INFO, format='%(name)-12s: %(levelname)-8s %(message)s')
+
+    result = soak(args.epics, args.hours, args.rate, args.tickdb)
+    samples = result['rss']
+    baseline = samples[max(args.warmup, 1) - 1]
+    result['growth'] = samples[-1] - baseline
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    print('{0} updates in {1:.0f}s, rss {2:.1f} MB after the warm up, {3:.1f} MB at the end, {4:+.1f} MB'.format(
+        result['updates'], result['seconds'], baseline / 1e6, samples[-1] / 1e6, result['growth'] / 1e6))
+    failures = []
+    if result['growth'] > args.tolerance * 1e6:
+        failures.append('rss grew {0:.1f} MB'.format(result['growth'] / 1e6))
+    if result['tables']:
+        failures.append('{0} subscriptions left behind'.format(result['tables']))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Backtest many [Trade] settings at once, on every core.
+
+Any numeric [Trade] setting can be swept, e.g. greed, predict_accuracy,
+clientsentiment_value, hightrend_watermark, the Price_Change_Day_percent_*
+band and spread_multiplier; the rest keep their config values. A grid tries
+every combination, a random search draws settings uniformly from ranges:
+
+    python sweep.py bars.npz --grid greed=0.1,0.5,1 predict_accuracy=0.8,0.85,0.9
+    python sweep.py bars.npz --random greed=0.1:2 Price_Change_Day_percent_low=0.1:1 --samples 2000 --seed 1
+
+The bars, and the regression backtest.features() fits from them (the same
+whatever the settings), are computed once and written to .npy files that
+each worker maps into memory, so they are shared through the page cache
+rather than pickled to every process.
+
+Each result is appended to --out as a JSON line as soon as it is in. Run the
+same command again after an interruption and the settings already there are
+skipped; a random search draws the same settings for the same --seed.
+"""
+
+import argparse
+import collections
+import configparser
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+import numpy as np
+
+import backtest
+from igclient import load_config
+from lib.settings import TRADE_KEYS, build_settings
+
+_worker = {}
+
+
+def _parse_key(key):
+    if TRADE_KEYS.get(key) is not float:
+        raise argparse.ArgumentTypeError('{0} is not a numeric [Trade] setting'.format(key))
+    return key
+
+
+def grid(specs):
+    """['greed=0.1,0.5', 'predict_accuracy=0.8,0.9'] -> every combination as dicts"""
+    keys, values = [], []
+    for spec in specs:
+        key, _, choices = spec.partition('=')
+        keys.append(_parse_key(key))
+        values.append([float(v) for v in choices.split(',')])
+    return [collections.OrderedDict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def random_search(specs, n, seed=0):
+    """['greed=0.1:2'] -> n dicts drawn uniformly, rounded to 4 places so reruns match"""
+    rng = np.random.RandomState(seed)
+    ranges = []
+    for spec in specs:
+        key, _, span = spec.partition('=')
+        low, _, high = span.partition(':')
+        ranges.append((_parse_key(key), float(low), float(high)))
+    return [collections.OrderedDict((key, round(float(rng.uniform(low, high)), 4)) for key, low, high in ranges)
+            for _ in range(n)]
+
+
+def params_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def share(bars, features, directory):
+    """Write the arrays workers map, returns what they need to find them."""
+    arrays = dict(('bars_' + field, value) for field, value in bars._asdict().items()
+                  if field != 'epic_ids' and value is not None)
+    arrays.update(('features_' + field, np.ascontiguousarray(value)) for field, value in features._asdict().items())
+    for name, value in arrays.items():
+        np.save(os.path.join(directory, name + '.npy'), value)
+    return {'directory': directory, 'epic_ids': list(bars.epic_ids), 'names': sorted(arrays)}
+
+
+def _init(shared, config, rules, guaranteed_premium):
+    # Ctrl-C is for the parent, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    arrays = dict((name, np.load(os.path.join(shared['directory'], name + '.npy'), mmap_mode='r'))
+                  for name in shared['names'])
+    _worker['bars'] = backtest.Bars(epic_ids=shared['epic_ids'],
+                                    **dict((field, arrays.get('bars_' + field))
+                                           for field in backtest.Bars._fields if field != 'epic_ids'))
+    _worker['features'] = backtest.Features(**dict((field, arrays['features_' + field])
+                                                   for field in backtest.Features._fields))
+    _worker['config'] = config
+    _worker['rules'] = rules
+    _worker['guaranteed_premium'] = guaranteed_premium
+
+
+def evaluate(params):
+    """Backtest one set of settings in a worker. :return: (params, summary or None, error or None)"""
+    config = configparser.ConfigParser()
+    config.read_dict(_worker['config'])
+    for key, value in params.items():
+        config['Trade'][key] = repr(value)
+    try:
+        settings = build_settings(config)
+    except ValueError as e:
+        return params, None, str(e)
+    start = time.monotonic()
+    trades = backtest.run(_worker['bars'], settings, guaranteed_premium=_worker['guaranteed_premium'],
+                          features_=_worker['features'], rules=_worker['rules'])
+    result = backtest.summary(trades, _worker['bars'])
+    del result['per_epic']
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return params, result, None
+
+
+def done_keys(path):
+    """Settings already in a results file, a half written last line is ignored."""
+    keys = set()
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    keys.add(params_key(json.loads(line)['params']))
+                except (ValueError, KeyError):
+                    pass
+    return keys
+
+
+def sweep(bars, candidates, out, workers=None, catalogue=None, guaranteed_premium=0.0):
+    """
+    Backtest each of candidates, skipping those already in out
+    :return: number of settings run this time
+    """
+    logger = logging.getLogger('sweep')
+    done = done_keys(out)
+    todo = [params for params in candidates if params_key(params) not in done]
+    logger.info('sweep.py sweep: {0} to run, {1} already in {2}'.format(len(todo), len(candidates) - len(todo), out))
+    if not todo:
+        return 0
+
+    config = load_config()
+    config = dict((section, dict(config[section])) for section in ('Trade', 'Epics'))
+    rules = backtest._rules_for(bars.epic_ids, catalogue)
+    directory = tempfile.mkdtemp(prefix='sweep-')
+    count = 0
+    try:
+        shared = share(bars, backtest.features(bars), directory)
+        pool = multiprocessing.Pool(workers, initializer=_init, initargs=(shared, config, rules, guaranteed_premium))
+        try:
+            with open(out, 'a') as f:
+                for params, result, error in pool.imap_unordered(evaluate, todo):
+                    f.write(json.dumps({'params': params, 'result': result, 'error': error}) + '\n')
+                    f.flush()
+                    count += 1
+            pool.close()
+        except KeyboardInterrupt:
+            logger.warning('sweep.py sweep: interrupted after {0}, run again to resume'.format(count))
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return count
+
+
+def best(out, top=10, sort='pnl'):
+    results = []
+    with open(out) as f:
+        for line in f:
+            try:
+                d = json.loads(line)
+            except ValueError:
+                continue
+            if d.get('result'):
+                results.append(d)
+    return sorted(results, key=lambda d: d['result'][sort] if d['result'][sort] is not None else -np.inf,
+                  reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest many [Trade] settings on every core')
+    parser.add_argument('path', nargs='?', help='.npz of bars, see backtest.save_bars')
+    parser.add_argument('--synthetic', metavar='EPICSxBARS', help='random walk bars instead, e.g. 90x8760')
+    search = parser.add_mutually_exclusive_group(required=True)
+    search.add_argument('--grid', nargs='+', metavar='KEY=V1,V2', help='every combination of these values')
+    search.add_argument('--random', nargs='+', metavar='KEY=LOW:HIGH', help='--samples settings drawn from these')
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='processes, default one per core')
+    parser.add_argument('--catalogue', help='instruments.json to fit orders to the dealing rules of')
+    parser.add_argument('--guaranteed-premium', type=float, default=0.0)
+    parser.add_argument('--out', default='sweep.jsonl', help='results, appended to and resumed from')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--sort', default='pnl', choices=['pnl', 'hit_rate', 'trades'])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(name)-12s: %(levelname)-8s %(message)s')
+
+    if args.synthetic:
+        epics, n = (int(v) for v in args.synthetic.lower().split('x'))
+        bars = backtest.synthetic_bars(epics, n)
+    elif args.path:
+        bars = backtest.load_bars(args.path)
+    else:
+        parser.error('give a .npz of bars or --synthetic')
+    candidates = grid(args.grid) if args.grid else random_search(args.random, args.samples, args.seed)
+
+    start = time.monotonic()
+    count = sweep(bars, candidates, args.out, args.workers, args.catalogue, args.guaranteed_premium)
+    elapsed = time.monotonic() - start
+    print("{0} settings in {1:.1f}s, results in {2}".format(count, elapsed, args.out))
+    for d in best(args.out, args.top, args.sort):
+        print("{pnl:>12} {hit_rate:>7} {trades:>6} {max_drawdown:>12}  ".format(**d['result']) + json.dumps(d['params']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""Deterministic checks that need no account, network or config.conf, unlike test.py.
+
+    python -m pytest -q tests
+
+Anything that talks to IG talks to apps/standin_server.py on a local port instead.
+"""
+
+import configparser
+import os
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_default_config(**overrides):
+    """default.conf, with [Config] keys replaced by overrides"""
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'default.conf'))
+    for key, value in overrides.items():
+        config['Config'][key] = str(value)
+    return config
+
+
+def start_standin(**kwargs):
+    """
+    Serve apps/standin_server.py on a free local port, from a daemon thread
+    :param kwargs: StandIn arguments, besides epics
+    :return: (StandInServer, API_ENDPOINT), server.shutdown() stops it
+    """
+    from apps.standin_server import StandIn, StandInServer
+
+    kwargs.setdefault('rate_limit', 0)
+    server = StandInServer(('127.0.0.1', 0), StandIn({}, **kwargs))
+    thread = threading.Thread(name="STANDIN-THREAD", target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}/gateway/deal'.format(server.server_address[1])
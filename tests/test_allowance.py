@@ -0,0 +1,68 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+
+import numpy as np
+
+from lib.allowance import FRUGAL, NORMAL, OFFLINE, AllowancePlanner, candidate_value
+from lib.history import PriceHistory
+
+
+def test_modes_follow_the_projection_to_the_reset():
+    planner = AllowancePlanner(reserve=100, window=3600, fresh_age=60)
+    assert planner.mode() == NORMAL and planner.allow(1000, value=0.5), 'nothing known yet'
+
+    # 10 points a minute for the 100 minutes to the reset is 1000, well inside 5000
+    planner._started -= 600
+    planner.update({'remainingAllowance': 5000, 'allowanceExpiry': 6000}, 100)
+    assert planner.mode() == NORMAL
+    assert planner.max_age(3600) == 60 and planner.max_age(1) == 1
+
+    # at 100 points a minute the 9000 projected won't fit, so only the better candidates fetch
+    planner.update(None, 900)
+    assert planner.remaining == 4100 and planner.mode() == FRUGAL
+    assert planner.max_age(3600) == 3600
+    assert planner.allow(10, value=0.8)
+    assert planner.allow(10, value=0.2) is False
+    assert planner.allow(10, value=0.9)
+    assert planner.allow(4001) is False, 'never into the reserve'
+
+    # down to the reserve only cached bars are used, until the reset
+    planner.exhausted()
+    assert planner.mode() == OFFLINE and planner.allow(1, value=1) is False
+    assert planner.max_age(60) == float('inf')
+    assert planner.mode(now=planner.expires_at + 1) == NORMAL
+
+
+def test_candidate_value():
+    # mid band, spread well inside the maximum
+    assert candidate_value(1.0, 100, 100.5, 0.5, 1.5, -2.0) == 0.5 + 0.5 * 0.75
+    assert candidate_value(0.5, 100, 100.5, 0.5, 1.5, -2.0) == 0
+    assert candidate_value(-1.25, 100, 102, 0.5, 1.5, -2.0) == 0.5 * 0.5
+    values = candidate_value(np.array([1.0, 2.0]), np.array([100, 100]), np.array([100.5, 100.5]), 0.5, 1.5, -2.0)
+    assert list(values) == [0.875, 0]
+
+
+def test_history_asks_only_for_what_it_lacks():
+    history = PriceHistory(keep=10)
+    now = time.time() // 3600 * 3600
+    prices = [{'snapshotTimeUTC': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now - i * 3600)),
+               'openPrice': {'bid': 1}, 'highPrice': {'bid': 2}, 'lowPrice': {'bid': 0}, 'closePrice': {'bid': 1},
+               'lastTradedVolume': 5} for i in range(4, -1, -1)]
+    assert history.missing('A', 'HOUR', 5, 60) == 5
+    history.add('A', 'HOUR', prices, fetched_at=now + 10)
+    assert history.missing('A', 'HOUR', 5, 60, now=now + 20) == 0
+    # an hour on, the newest bar we have is asked for again, with a bar to spare for those opened since
+    assert history.missing('A', 'HOUR', 5, 60, now=now + 3610) == 3
+    assert history.missing('A', 'HOUR', 8, 60, now=now + 20) == 8
+    assert len(history.bars('A', 'HOUR', 8)) == 5
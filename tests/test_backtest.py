@@ -0,0 +1,81 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import numpy as np
+
+import backtest
+
+
+def test_regression_matches_sklearn():
+    from sklearn.linear_model import LinearRegression
+
+    bars = backtest.synthetic_bars(epics=3, bars=24 * 8, seed=1)
+    f = backtest.features(bars)
+    per_day = 24
+    for e, t in ((0, 150), (1, 171), (2, 191)):
+        # the fetch_lg_prices bars as the live bot sees them: 5 of each resolution, ending at bar t
+        x, y = [], []
+        for multiple in backtest.MULTIPLES + (per_day,):
+            for point in range(backtest.POINTS):
+                end = t - point * multiple
+                x.append([bars.high[e, end - multiple + 1:end + 1].max(), bars.low[e, end - multiple + 1:end + 1].min()])
+                y.append(bars.close[e, end])
+        model = LinearRegression().fit(np.array(x), np.array(y))
+        day_start = t - t % per_day
+        day = [[bars.high[e, day_start:t + 1].max(), bars.low[e, day_start:t + 1].min()]]
+        assert f.enough[e, t]
+        assert np.isclose(f.prediction[e, t], model.predict(np.array(day))[0], rtol=1e-9, atol=1e-6), (e, t)
+        assert np.isclose(f.score[e, t], model.score(np.array(x), np.array(y)), atol=1e-6), (e, t)
+
+
+def bars_of(open_, high, low, close):
+    a = lambda v: np.array([v], dtype=float)
+    return backtest.Bars(epic_ids=['E'], time=3600.0 * np.arange(len(close)), open=a(open_), high=a(high), low=a(low),
+                         close=a(close), spread=None, long_pct=None)
+
+
+def test_fill_stops_gaps_and_limits():
+    zero, one = np.array([0.0]), np.array([1.0])
+    pair = np.zeros(2, dtype=int)
+    # a long, stop 5 below a 100 entry, and the next bar opens through it at 90
+    bars = bars_of([100, 90, 90], [100, 91, 91], [100, 89, 89], [100, 90, 90])
+    exit_bar, exit_price, entry, reason = backtest._fill(
+        bars, zero, pair, pair, np.array([1, 1]), np.array([5.0, 5.0]), np.array([np.nan, np.nan]),
+        np.array([False, True]), 0)
+    assert list(exit_bar) == [1, 1] and list(entry) == [100, 100]
+    assert list(exit_price) == [90, 95], 'a gap fills at the open, unless the stop is guaranteed'
+    assert list(reason) == [backtest.STOP, backtest.STOP]
+
+    # stop and limit both inside one bar count as the stop
+    bars = bars_of([100, 100, 100], [100, 104, 100], [100, 96, 100], [100, 100, 100])
+    exit_bar, exit_price, _, reason = backtest._fill(
+        bars, zero, pair[:1], pair[:1], np.array([1]), np.array([3.0]), np.array([3.0]), np.array([False]), 0)
+    assert (exit_bar[0], exit_price[0], reason[0]) == (1, 97, backtest.STOP)
+
+    # a short enters at the bid and closes at the offer: bid + 1 here
+    bars = bars_of([100, 110, 100], [100, 111, 100], [100, 109, 100], [100, 110, 100])
+    exit_bar, exit_price, entry, reason = backtest._fill(
+        bars, one, pair, pair, np.array([-1, -1]), np.array([5.0, 5.0]), np.array([np.nan, np.nan]),
+        np.array([False, True]), 0)
+    assert list(entry) == [100, 100] and list(exit_price) == [111, 105]
+    bars = bars_of([100, 99, 100], [100, 99, 100], [100, 96, 100], [100, 97, 100])
+    exit_bar, exit_price, _, reason = backtest._fill(
+        bars, one, pair[:1], pair[:1], np.array([-1]), np.array([5.0]), np.array([3.0]), np.array([False]), 0)
+    assert (exit_bar[0], exit_price[0], reason[0]) == (1, 97, backtest.LIMIT)
+
+    # neither reached: out of time after max_bars, or out of data
+    bars = bars_of([100] * 5, [101] * 5, [99] * 5, [100, 100, 100.5, 100, 100])
+    for max_bars, expected in ((2, (2, 100.5, backtest.TIMEOUT)), (0, (4, 100, backtest.END))):
+        exit_bar, exit_price, _, reason = backtest._fill(
+            bars, zero, pair[:1], pair[:1], np.array([1]), np.array([5.0]), np.array([5.0]), np.array([False]),
+            max_bars)
+        assert (exit_bar[0], exit_price[0], reason[0]) == expected
@@ -0,0 +1,96 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import threading
+import time
+
+import numpy as np
+
+from lib.bus import BusFollower, BusReader, MarketBus
+
+
+def market(epic_id, bid):
+    return {'name': 'MARKET:' + epic_id,
+            'values': {'BID': str(bid), 'OFFER': str(bid + 1), 'MID_OPEN': str(bid + 0.5), 'HIGH': str(bid + 2),
+                       'LOW': str(bid - 2), 'CHANGE': '0', 'CHANGE_PCT': '0', 'UPDATE_TIME': '12:00:00',
+                       'MARKET_DELAY': '0', 'MARKET_STATE': 'TRADEABLE'}}
+
+
+def chart(epic_id, minute, close):
+    return {'name': 'CHART:{0}:1MINUTE'.format(epic_id),
+            'values': {'UTM': str(minute * 60000), 'BID_OPEN': str(close), 'BID_HIGH': str(close),
+                       'BID_LOW': str(close), 'BID_CLOSE': str(close), 'LTV': '1'}}
+
+
+def test_bus_seqlock_and_rings(tmp_path):
+    path = str(tmp_path / 'bus')
+    bus = MarketBus(['A', 'B'], path=path, n_bars=3)
+    reader = BusReader(path)
+    bus.on_market(market('A', 100))
+    assert reader.quote('A') == (100.0, 101.0) and reader.quote('B') is None
+
+    # a row part way through a write is read again once the writer is done with it
+    seq = bus.board['seq']
+    s = int(seq[0])
+    seq[0] = s + 1
+    bus.board['bid'][0] = 200  # offer still 101
+
+    def finish():
+        time.sleep(0.1)
+        bus.board['offer'][0] = 201
+        seq[0] = s + 2
+    threading.Thread(target=finish).start()
+    row = reader.row('A')
+    assert (row['bid'], row['offer'], row['seq']) == (200, 201, s + 2)
+
+    # rows copied under a writer hammering them are never torn
+    stop = threading.Event()
+
+    def write():
+        bid = 0
+        while not stop.is_set():
+            bid += 1
+            bus.on_market(market('B', bid))
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        for _ in range(2000):
+            row = reader.row('B')
+            if not np.isnan(row['bid']):
+                assert row['offer'] - row['bid'] == 1 and row['high'] - row['low'] == 4
+            board = reader.snapshot()
+            if not np.isnan(board[1]['bid']):
+                assert board[1]['offer'] - board[1]['bid'] == 1
+    finally:
+        stop.set()
+        writer.join()
+
+    # the ring keeps the latest n_bars, oldest first, and an update of the newest replaces it
+    for minute in range(5):
+        bus.on_chart(chart('A', minute, 100 + minute))
+    bus.on_chart(chart('A', 4, 150))
+    bars = reader.bars('A')
+    assert list(bars['time']) == [120, 180, 240] and list(bars['close']) == [102, 103, 150]
+    assert len(reader.bars('B')) == 0
+
+    # a follower hands on the bars added since last time, and the newest again
+    got = []
+    follower = BusFollower(reader, lambda item_info: None, bars_listener=lambda e, scale, b: got.append(
+        (e, scale, list(b['close']))))
+    rows = follower._rows()
+    seen, counts = np.zeros(len(rows), dtype='<u8'), np.zeros(len(rows), dtype='<u8')
+    follower._bars(rows, seen, counts)
+    bus.on_chart(chart('A', 5, 105))
+    follower._bars(rows, seen, counts)
+    follower._bars(rows, seen, counts)
+    assert got == [('A', '1MINUTE', [102, 103, 150]), ('A', '1MINUTE', [150, 105])]
+    bus.close()
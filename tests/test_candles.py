@@ -0,0 +1,83 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import logging
+import time
+
+from ig import API
+from lib.allowance import AllowancePlanner
+from lib.candles import CandleBuilder
+from lib.history import PriceHistory
+
+EPIC = 'CS.D.GBPUSD.TODAY.IP'
+
+
+def chart(scale, bar_time, close, cons_end='0'):
+    return {'name': 'CHART:{0}:{1}'.format(EPIC, scale),
+            'values': {'UTM': str(int(bar_time * 1000)), 'BID_OPEN': str(close - 1), 'BID_HIGH': str(close + 1),
+                       'BID_LOW': str(close - 2), 'BID_CLOSE': str(close), 'LTV': '3', 'CONS_END': cons_end,
+                       'DAY_HIGH': '110', 'DAY_LOW': '90'}}
+
+
+def history_api():
+    """ig.API with just what fetch_history needs, recording the prices() calls it makes"""
+    api = API.__new__(API)
+    api.logger = logging.getLogger('API')
+    api.history = PriceHistory()
+    api.candles = CandleBuilder(api.history)
+    api.planner = AllowancePlanner(reserve=0)
+    api.fetched = []
+    api.prices = lambda epic_id, resolution: api.fetched.append(resolution)
+    return api
+
+
+def test_stream_updates_build_bars_until_closed():
+    candles = CandleBuilder(PriceHistory())
+    now = time.time() // 300 * 300
+    candles.on_update(chart('5MINUTE', now - 300, 100))
+    candles.on_update(chart('5MINUTE', now - 300, 101, cons_end='1'))
+    candles.on_update(chart('5MINUTE', now - 300, 150))  # late, the bar is closed
+    candles.on_update(chart('5MINUTE', now, 102))
+    bars = candles.history.bars(EPIC, 'MINUTE_5', 5)
+    assert [bar['closePrice']['bid'] for bar in bars] == [101, 102]
+    assert candles.completed == 1 and candles.day_high_low[EPIC] == (110, 90)
+    assert candles.streams(EPIC, 'MINUTE_5') and not candles.streams(EPIC, 'HOUR')
+
+
+def test_history_bases():
+    api = history_api()
+    assert api.history_base(EPIC, 'HOUR_2', 5, {'HOUR', 'HOUR_2'}) == 'HOUR'
+    assert api.history_base(EPIC, 'MINUTE_30', 5) == 'MINUTE_30'
+
+    now = time.time() // 300 * 300
+    api.candles.on_update(chart('5MINUTE', now, 100))
+    assert api.history_base(EPIC, 'MINUTE_30', 5) == 'MINUTE_5'
+    assert api.history_base(EPIC, 'HOUR', 5) == 'MINUTE_5'
+    assert api.history_base(EPIC, 'HOUR_4', 5) == 'HOUR_4', 'more 5 minute bars than the history keeps'
+    api.candles.on_update(chart('HOUR', now // 3600 * 3600, 100))
+    assert api.history_base(EPIC, 'HOUR', 5) == 'HOUR'
+    assert api.history_base(EPIC, 'HOUR_4', 5) == 'HOUR'
+    assert api.history_base(EPIC, 'DAY', 5, {'HOUR', 'DAY'}) == 'DAY'
+
+
+def test_minute_30_resampled_from_streamed_5_minute_bars():
+    api = history_api()
+    now = time.time() // 1800 * 1800
+    for i in range(35, -1, -1):
+        api.candles.on_update(chart('5MINUTE', now - i * 300, 100 + (35 - i)))
+    api.fetched = []
+    minute_30, day = api.fetch_history(EPIC, ['MINUTE_30/5', 'DAY/1'])
+    assert api.fetched == ['DAY/1']
+    # six 5 minute bars each, and the one just started
+    assert [bar['openPrice']['bid'] for bar in minute_30] == [110, 116, 122, 128, 134]
+    assert [bar['closePrice']['bid'] for bar in minute_30] == [116, 122, 128, 134, 135]
+    assert day == []
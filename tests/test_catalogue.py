@@ -0,0 +1,93 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import functools
+import json
+import time
+
+from igclient import IGClient
+from lib.catalogue import InstrumentCatalogue
+from lib.ratelimit import DEFAULT, HISTORY
+from tests import load_default_config, start_standin
+
+
+def market(epic_id, bid=100.0, offer=101.0):
+    return {'instrument': {'marketId': 'M-' + epic_id, 'name': epic_id, 'lotSize': 1, 'marginFactor': 5,
+                           'marginFactorUnit': 'PERCENTAGE', 'openingHours': None},
+            'dealingRules': {'minDealSize': {'unit': 'POINTS', 'value': 0.5}},
+            'snapshot': {'bid': bid, 'offer': offer}}
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_misses_fetch_in_the_foreground_and_stale_entries_in_the_background(tmp_path):
+    path = str(tmp_path / 'instruments.json')
+    fetched, refreshed = [], []
+    catalogue = InstrumentCatalogue(path, fetch=lambda e: fetched.append(e) or market(e),
+                                    refresh_fetch=lambda e: refreshed.append(e) or market(e, 100, 100.5),
+                                    max_age=60, save_interval=0.05)
+    assert catalogue.market_id('A') == 'M-A' and fetched == ['A']
+    assert catalogue.get('A')['minSpread'] == 1.0 and fetched == ['A'], 'a second get is served from memory'
+    catalogue.observe_spread('A', 0.8)
+    catalogue.observe_spread('A', 2)
+    assert catalogue.get('A')['minSpread'] == 0.8
+
+    # a stale entry is served as it is while the background thread fetches it again
+    catalogue._instruments['A']['updated'] -= 120
+    catalogue.start()
+    assert catalogue.get('A')['marketId'] == 'M-A'
+    assert wait_for(lambda: refreshed == ['A'] and catalogue.get('A')['updated'] > time.time() - 60)
+    assert fetched == ['A'] and catalogue.get('A')['minSpread'] == 0.5
+    catalogue.refresh(['A', 'B'])
+    assert wait_for(lambda: refreshed == ['A', 'B'])
+
+    # and kept for the next run
+    assert wait_for(lambda: 'B' in json.load(open(path))['instruments'])
+    again = InstrumentCatalogue(path, fetch=lambda e: fetched.append(e) or market(e))
+    assert again.dealing_rules('B') == market('B')['dealingRules'] and fetched == ['A']
+
+
+def test_old_catalogue_format_starts_afresh(tmp_path):
+    path = tmp_path / 'instruments.json'
+    path.write_text(json.dumps({'version': 1, 'instruments': {'A': {'marketId': 'OLD'}}}))
+    catalogue = InstrumentCatalogue(str(path), fetch=market)
+    assert catalogue.market_id('A') == 'M-A'
+
+
+class RecordingLimiter(object):
+    def __init__(self):
+        self.priorities = []
+
+    def acquire(self, priority):
+        self.priorities.append(priority)
+        return 0.0
+
+
+def test_markets_can_be_called_at_history_priority():
+    server, endpoint = start_standin()
+    try:
+        client = IGClient(load_default_config(API_ENDPOINT=endpoint))
+        client.session()
+        client.rate_limiter = RecordingLimiter()
+        epic = 'CS.D.GBPUSD.TODAY.IP'
+        assert client.markets(epic)['instrument']['epic'] == epic
+        refresh = functools.partial(client.markets, priority=HISTORY)
+        assert refresh(epic)['instrument']['epic'] == epic
+        assert client.rate_limiter.priorities == [DEFAULT, HISTORY]
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,55 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import numpy as np
+
+from lib.dealing import RULES, adjust_order, adjust_orders, compile_rules, stack_rules
+
+
+def random_rules(rng):
+    rules = {}
+    for name in RULES:
+        if rng.rand() < 0.2:
+            continue  # missing, never applies
+        unit = 'PERCENTAGE' if name != 'minDealSize' and rng.rand() < 0.3 else 'POINTS'
+        value = rng.uniform(0.1, 2) if unit == 'PERCENTAGE' else rng.uniform(0.5, 50)
+        rules[name] = {'unit': unit, 'value': round(value, 2)}
+    if 'maxStopOrLimitDistance' in rules:
+        rules['maxStopOrLimitDistance'] = {'unit': 'POINTS', 'value': 500}
+    return rules
+
+
+def test_adjust_orders_matches_adjust_order():
+    rng = np.random.RandomState(7)
+    n = 300
+    dealing_rules = [random_rules(rng) for _ in range(n)]
+    price = rng.uniform(1, 20000, n)
+    size = np.round(rng.uniform(0.1, 5, n), 2)
+    stop = np.where(rng.rand(n) < 0.2, np.nan, np.round(rng.uniform(0, 800, n), 1))
+    limit = np.where(rng.rand(n) < 0.2, np.nan, np.round(rng.uniform(0, 800, n), 1))
+    guaranteed = rng.rand(n) < 0.5
+
+    sizes, stops, limits = adjust_orders(stack_rules([compile_rules(r) for r in dealing_rules]), price, size, stop,
+                                         limit, guaranteed)
+    for i in range(n):
+        data = {'size': str(size[i])}
+        if not np.isnan(stop[i]):
+            data['stopDistance'] = str(stop[i])
+        if not np.isnan(limit[i]):
+            data['limitDistance'] = str(limit[i])
+        data = adjust_order(data, compile_rules(dealing_rules[i]), price[i], guaranteed[i])
+        assert np.isclose(float(data['size']), sizes[i], atol=0.005), i
+        for key, batch in (('stopDistance', stops), ('limitDistance', limits)):
+            if np.isnan(batch[i]):
+                assert key not in data, i
+            else:
+                assert np.isclose(float(data[key]), batch[i], atol=0.005), (i, key)
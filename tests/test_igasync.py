@@ -0,0 +1,63 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import asyncio
+
+import pytest
+
+from igasync import AsyncIGClient
+from igclient import AuthenticationError
+from tests import load_default_config, start_standin
+
+EPIC = 'CS.D.GBPUSD.TODAY.IP'
+
+
+def test_async_client_logs_in_again_and_times_out():
+    server, endpoint = start_standin()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = AsyncIGClient(load_default_config(API_ENDPOINT=endpoint), timeout=1)
+    try:
+        login = loop.run_until_complete(client.session())
+        assert login['currentAccountId'] == client.accountId
+        assert loop.run_until_complete(client.markets(EPIC))['instrument']['epic'] == EPIC
+
+        # the stand-in forgets every token, the next calls log in again once between them and go through
+        cst = client.auth['CST']
+        server.standin.tokens.clear()
+
+        async def both():
+            return await asyncio.gather(client.positions(), client.markets(EPIC))
+        positions, market = loop.run_until_complete(both())
+        assert positions['positions'] == [] and market['instrument']['epic'] == EPIC
+        assert client.auth['CST'] != cst and len(server.standin.tokens) == 1
+
+        # a refused login isn't retried
+        client.auth = {}
+        client.authenticated_headers = dict(client.headers, CST='refused')
+        with pytest.raises(AuthenticationError):
+            loop.run_until_complete(client.accounts())
+
+        # a response slower than the timeout fails the call, and its connection with it
+        loop.run_until_complete(client.session())
+        server.standin.latency = 2
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(client.markets(EPIC))
+        server.standin.latency = 0
+        assert loop.run_until_complete(client.markets(EPIC))['instrument']['epic'] == EPIC
+    finally:
+        client.close()
+        loop.close()
+        asyncio.set_event_loop(None)
+        server.shutdown()
+        server.server_close()
+
@@ -0,0 +1,85 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import os
+import stat
+
+import pytest
+
+from igclient import IGClient
+from igsession import SessionManager
+from tests import load_default_config, start_standin
+
+EPIC = 'CS.D.GBPUSD.TODAY.IP'
+
+
+@pytest.fixture
+def standin():
+    server, endpoint = start_standin()
+    yield server, endpoint
+    server.shutdown()
+    server.server_close()
+
+
+def start(endpoint, path):
+    client = IGClient(load_default_config(API_ENDPOINT=endpoint))
+    manager = SessionManager(client, path)
+    d = manager.login()
+    if client.accountId is None:
+        client.select_account()
+        manager.save()
+    return client, manager, d
+
+
+def test_saved_session_is_reused(standin, tmp_path):
+    server, endpoint = standin
+    path = str(tmp_path / 'session.json')
+    first, manager, d = start(endpoint, path)
+    assert not manager.restored and first.accountId
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert len(server.standin.tokens) == 1
+
+    # a restart picks up the same tokens and account without logging in
+    again, manager, restored = start(endpoint, path)
+    assert manager.restored and len(server.standin.tokens) == 1
+    assert again.auth == first.auth and again.accountId == first.accountId
+    assert restored['currentAccountId'] == d['currentAccountId']
+    assert again.stream_password() == first.stream_password()
+    assert again.markets(EPIC)['instrument']['epic'] == EPIC
+
+    # another user, or tokens about to run out, and it logs in afresh
+    state = json.load(open(path))
+    json.dump(dict(state, username='someone else'), open(path, 'w'))
+    assert not start(endpoint, path)[1].restored
+    state = json.load(open(path))
+    json.dump(dict(state, expires=state['created'] + 60), open(path, 'w'))
+    assert not start(endpoint, path)[1].restored
+
+
+def test_refused_tokens_log_in_again(standin, tmp_path):
+    server, endpoint = standin
+    path = str(tmp_path / 'session.json')
+    client, manager, d = start(endpoint, path)
+
+    # saved tokens the server has forgotten are dropped at startup
+    server.standin.tokens.clear()
+    client, manager, d = start(endpoint, path)
+    assert not manager.restored and len(server.standin.tokens) == 1
+
+    # and during a run, a refused call logs in once and goes through
+    cst = client.auth['CST']
+    server.standin.tokens.clear()
+    assert client.markets(EPIC)['instrument']['epic'] == EPIC
+    assert client.auth['CST'] != cst and len(server.standin.tokens) == 1
+    assert json.load(open(path))['auth'] == client.auth
+
@@ -0,0 +1,98 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from igstream import ShardedIGStream, Subscription
+
+
+class FakeShardClient(object):
+    """Stands in for a shard's LSClient, refusing subscriptions while fail is set"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.subscriptions = {}
+        self._key = 0
+
+    def subscribe(self, subscription):
+        self._key += 1
+        if self.fail:
+            return self._key, False
+        self.subscriptions[self._key] = subscription
+        return self._key, True
+
+    def unsubscribe(self, sub_key):
+        del self.subscriptions[sub_key]
+
+
+class FakeClient(object):
+    def stream_password(self):
+        return 'CST-x|XST-y'
+
+
+def sharded(shards, items_per_session=2, max_sessions=3):
+    stream = ShardedIGStream(igclient=FakeClient(), loginresponse={'lightstreamerEndpoint': 'http://127.0.0.1/',
+                                                                   'currentAccountId': 'ACC'},
+                             items_per_session=items_per_session, max_sessions=max_sessions)
+    # shards connect on first use, as LSClients would
+    stream._shards = shards
+    stream._client = lambda shard: shards.setdefault(shard, FakeShardClient())
+    return stream
+
+
+def market(*epics):
+    return Subscription(mode='MERGE', items=['MARKET:' + epic for epic in epics], fields=['BID', 'OFFER'])
+
+
+def test_items_spread_over_shards_and_map_back():
+    shards = {}
+    stream = sharded(shards)
+    updates = []
+    subscription = market('A', 'B', 'C', 'D')
+    sub_key, success = stream.subscribe(subscription, updates.append)
+    assert success
+    assert sum(len(sub.item_names) for client in shards.values() for sub in client.subscriptions.values()) == 4
+    assert all(stream._shard_load[shard] <= 2 for shard in shards)
+
+    # an update on a shard reaches the caller at the item's position in its own subscription
+    for client in shards.values():
+        for child in client.subscriptions.values():
+            child.notifyupdate('{0}|1|2'.format(len(child.item_names)), server_lag=False)
+    assert sorted(u['pos'] for u in updates) == sorted(
+        subscription.item_names.index(c.item_names[-1]) + 1 for s in shards.values() for c in s.subscriptions.values())
+
+    stream.unsubscribe(sub_key)
+    assert all(not client.subscriptions for client in shards.values())
+    assert not stream._assigned and not any(stream._shard_load.values())
+
+
+def test_failed_shard_lets_go_of_the_others():
+    shards = {}
+    stream = sharded(shards)
+    # two items hashed onto different shards, the later of which refuses subscriptions
+    by_shard = {}
+    for i in range(50):
+        by_shard.setdefault(stream.shard_for('MARKET:E{0}'.format(i)), []).append('E{0}'.format(i))
+    good, bad = sorted(by_shard)[:2]
+    shards[bad] = FakeShardClient(fail=True)
+
+    kept, success = stream.subscribe(market(by_shard[good][0]), lambda item_info: None)
+    assert success
+    sub_key, success = stream.subscribe(market(by_shard[good][1], by_shard[bad][0]), lambda item_info: None)
+    assert not success
+    assert sub_key not in stream._subscriptions
+    assert [sub.item_names for sub in shards[good].subscriptions.values()] == [['MARKET:' + by_shard[good][0]]], \
+        'the shard that went through is unsubscribed again'
+    assert stream._shard_load == {good: 1, bad: 0}
+    assert list(stream._assigned) == ['MARKET:' + by_shard[good][0]]
+
+    # and the earlier subscription is untouched
+    stream.unsubscribe(kept)
+    assert not shards[good].subscriptions and not stream._assigned
@@ -0,0 +1,99 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+
+import numpy as np
+
+from lib.monitor import PositionMonitor
+
+OPENED = '2026-01-02T10:00:00'
+OPENED_AT = 1767348000
+
+
+def position(deal_id, epic_id, direction, level, size=1, **extra):
+    return {'position': dict({'dealId': deal_id, 'direction': direction, 'size': size, 'level': level,
+                              'stopLevel': None, 'limitLevel': None, 'contractSize': 1,
+                              'createdDateUTC': OPENED}, **extra),
+            'market': {'epic': epic_id, 'bid': None, 'offer': None}}
+
+
+def price(epic_id, bid, offer):
+    return {'name': 'MARKET:' + epic_id, 'values': {'BID': str(bid), 'OFFER': str(offer)}}
+
+
+def monitor(**rules):
+    closed = []
+    m = PositionMonitor(close=closed.append, subscribe=lambda epic_id, listener: None, **rules)
+    m.load({'positions': [position('LONG', 'A', 'BUY', 100, size=2, stopLevel=90, limitLevel=120),
+                          position('SHORT', 'B', 'SELL', 50, contractSize=10)]})
+    return m, closed
+
+
+def test_positions_are_priced_from_the_stream():
+    m, closed = monitor()
+    assert m.evaluate(now=OPENED_AT) == []
+    assert np.isnan(m.pnl).all(), 'no prices yet'
+    m.on_price(price('A', 105, 106))
+    m.on_price(price('B', 47, 48))
+    m.on_price(price('C', 1, 2))  # no position, ignored
+    assert m.evaluate(now=OPENED_AT) == [] and closed == []
+    assert list(m.pnl) == [2 * 5, 10 * 2]
+    assert (m.to_stop[0], m.to_limit[0]) == (15, 15)
+    assert list(m.best) == [105, 48]
+
+
+def test_trailing_stop():
+    m, closed = monitor(trailing_stop=3)
+    m.on_price(price('A', 110, 111))
+    m.on_price(price('B', 45, 46))
+    assert m.evaluate(now=OPENED_AT) == []
+    # the long gives back 3 of its best, the short only 2
+    m.on_price(price('A', 107, 108))
+    m.on_price(price('B', 47, 48))
+    assert m.evaluate(now=OPENED_AT) == ['LONG']
+    assert closed == [{'dealId': 'LONG', 'direction': 'SELL', 'size': '2.0', 'orderType': 'MARKET'}]
+    # still open until the OPU says otherwise, and not tried again before retry is up
+    assert m.evaluate(now=OPENED_AT + 1) == []
+    m.on_trade({'values': {'OPU': json.dumps({'dealId': 'LONG', 'dealStatus': 'ACCEPTED', 'status': 'DELETED'})}})
+    assert m.deal_ids == ['SHORT'] and m.closed == 1
+
+
+def test_max_hold_and_target_pnl():
+    m, closed = monitor(max_hold=3600)
+    m.on_price(price('A', 100, 101))
+    m.on_price(price('B', 50, 51))
+    assert m.evaluate(now=OPENED_AT + 3599) == []
+    assert sorted(m.evaluate(now=OPENED_AT + 3600)) == ['LONG', 'SHORT']
+
+    m, closed = monitor(target_pnl=25)
+    m.on_price(price('A', 113, 114))
+    m.on_price(price('B', 47, 48))
+    assert m.evaluate(now=OPENED_AT) == ['LONG']
+    m.on_price(price('B', 47, 47.5))
+    assert m.evaluate(now=OPENED_AT) == ['SHORT']
+    assert [c['direction'] for c in closed] == ['SELL', 'BUY']
+
+
+def test_rules_change_and_updates_keep_their_history():
+    m, closed = monitor()
+    m.on_price(price('A', 110, 111))
+    m.evaluate(now=OPENED_AT)
+    # an OPU update moving the stop keeps when it opened and its best price
+    m.on_trade({'values': {'OPU': json.dumps({'dealId': 'LONG', 'dealStatus': 'ACCEPTED', 'status': 'UPDATED',
+                                              'epic': 'A', 'direction': 'BUY', 'size': 2, 'level': 100,
+                                              'stopLevel': 105, 'limitLevel': 120})}})
+    assert m.deal_ids == ['SHORT', 'LONG']
+    assert (m.opened_at[-1], m.best[-1], m.stop_level[-1]) == (OPENED_AT, 110, 105)
+    m.on_price(price('A', 108, 109))
+    m.set_rules(trailing_stop=2, max_hold=0, target_pnl=0)
+    assert m.evaluate(now=OPENED_AT) == ['LONG']
@@ -0,0 +1,89 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from ig import API
+from lib.paper import PaperBroker
+from lib.settings import build_settings
+from tests import load_default_config
+
+
+def tick(epic_id, bid, offer):
+    return {'name': 'MARKET:' + epic_id, 'values': {'BID': str(bid), 'OFFER': str(offer)}}
+
+
+def order(direction='BUY', stop=10, limit=20, **extra):
+    return dict({'epic': 'A', 'direction': direction, 'size': 2, 'stopDistance': stop, 'limitDistance': limit,
+                 'guaranteedStop': False, 'currencyCode': 'GBP'}, **extra)
+
+
+def paper_api(always_guarantee_stops):
+    """ig.API with just what positions_otc needs on paper"""
+    config = load_default_config()
+    config['Trade']['always_guarantee_stops'] = str(always_guarantee_stops)
+    api = API.__new__(API)
+    api.settings = build_settings(config)
+    api.paper = PaperBroker()
+    api.paper.on_price(tick('A', 100, 101))
+    return api
+
+
+def test_fills_at_the_price_and_closes_at_levels():
+    events = []
+    broker = PaperBroker(balance=1000)
+    broker.listeners.append(lambda item_info: events.append(list(item_info['values'])[0]))
+    assert broker.confirms(broker.positions_otc(order())['dealReference'])['reason'] == 'MARKET_OFFLINE'
+
+    broker.on_price(tick('A', 100, 101))
+    confirm = broker.confirms(broker.positions_otc(order())['dealReference'])
+    assert (confirm['dealStatus'], confirm['level'], confirm['stopLevel'], confirm['limitLevel']) == \
+        ('ACCEPTED', 101, 91, 121)
+    sell = broker.confirms(broker.positions_otc(order('SELL', limit=5))['dealReference'])
+    assert (sell['level'], sell['stopLevel'], sell['limitLevel']) == (100, 110, 95)
+    assert len(broker.positions()['positions']) == 2
+
+    # the sell's limit is reached at the offer, and fills at the limit
+    broker.on_price(tick('A', 93, 94))
+    assert list(broker.open) == [confirm['dealId']]
+    assert broker.realised == 2 * (100 - 95)
+
+    # the buy is closed by hand at the bid
+    close = broker.confirms(broker.positions_otc_close({'dealId': confirm['dealId']})['dealReference'])
+    assert (close['status'], close['level'], close['profit']) == ('CLOSED', 93, 2 * (93 - 101))
+    assert broker.positions() == {'positions': []}
+    assert events == ['CONFIRMS'] + ['OPU', 'CONFIRMS'] * 4
+    assert broker.account()['FUNDS'] == 1000 + 10 - 16
+
+
+def test_gaps_through_stops_fill_at_the_price_unless_guaranteed():
+    broker = PaperBroker()
+    broker.on_price(tick('A', 100, 101))
+    plain = broker.confirms(broker.positions_otc(order())['dealReference'])
+    guaranteed = broker.confirms(broker.positions_otc(order(guaranteedStop=True))['dealReference'])
+    assert guaranteed['guaranteedStop'] and not plain['guaranteedStop']
+
+    # a gap from 100 to 80, through both stops at 91
+    broker.on_price(tick('A', 80, 81))
+    assert broker.open == {}
+    assert broker.confirms(plain['dealReference'])['status'] == 'OPEN'
+    closes = [c for c in broker.confirmations.values() if c['status'] == 'CLOSED']
+    assert sorted((c['dealId'], c['level']) for c in closes) == sorted(
+        [(plain['dealId'], 80), (guaranteed['dealId'], 91)])
+
+
+def test_paper_orders_follow_the_guaranteed_stop_settings():
+    for always, level in ((True, 91), (False, 80)):
+        api = paper_api(always)
+        deal_ref = api.positions_otc(order())['dealReference']
+        assert api.paper.confirms(deal_ref)['guaranteedStop'] is always
+        api.paper.on_price(tick('A', 80, 81))
+        closed = [c for c in api.paper.confirmations.values() if c['status'] == 'CLOSED']
+        assert [c['level'] for c in closed] == [level]
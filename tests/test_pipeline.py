@@ -0,0 +1,101 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import queue
+import time
+
+import lib.pipeline
+from lib.pipeline import TradePipeline
+from lib.settings import build_settings
+from tests import load_default_config
+
+
+class FakePrediction(object):
+    """Prediction without the maths: QUIET fails quick_check and FLAT finds no direction"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.epic_id = None
+        self.current_price = None
+        self.direction_to_trade = None
+
+    def set_marketdata(self, market_data):
+        pass
+
+    def quick_check(self):
+        return None if self.epic_id == 'QUIET' else True
+
+    def linear_regression(self, x, y, high_price, low_price):
+        self.direction_to_trade = None if self.epic_id == 'FLAT' else 'BUY'
+
+
+class FakeAPI(object):
+    """Screens the epics of statuses in turn, and answers placeOrder with their status"""
+
+    def __init__(self, statuses):
+        self.settings = build_settings(load_default_config())
+        self.rate_limiter = None
+        self.statuses = statuses
+        self.screen = queue.Queue()
+        for epic_id in statuses:
+            self.screen.put({'values': {'EPIC': epic_id, 'BID': '100', 'OFFER': '101', 'CHANGE_PCT': '1'}})
+        self.ordered = []
+
+    def find_next_trade(self, exclude=()):
+        return self.screen.get()
+
+    def clientsentiment(self, epic_id):
+        return {'longPositionPercentage': 60, 'shortPositionPercentage': 40}
+
+    def fetch_lg_prices(self, epic_id, value=1.0):
+        return None if epic_id == 'NOHIST' else ([[2.0, 1.0]], [1.5])
+
+    def fetch_lg_highlow(self, epic_id, value=1.0):
+        return 2.0, 1.0
+
+    def placeOrder(self, prediction, trace=None):
+        self.ordered.append(prediction.epic_id)
+        if self.statuses[prediction.epic_id] == 'BOOM':
+            raise IOError('connection reset')
+        return self.statuses[prediction.epic_id]
+
+
+def run(api, max_age=60):
+    pipeline = TradePipeline(api, workers=2, max_age=max_age)
+    pipeline.start()
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        counts = dict(pipeline.counts)
+        if counts['screened'] == len(api.statuses) and sum(counts.values()) == 2 * len(api.statuses):
+            break
+        time.sleep(0.01)
+    pipeline.stop()
+    return pipeline
+
+
+def test_every_candidate_is_counted_by_outcome(monkeypatch):
+    monkeypatch.setattr(lib.pipeline, 'Prediction', FakePrediction)
+    api = FakeAPI({'A': 'ACCEPTED', 'B': 'REJECTED', 'C': None, 'BOOM': 'BOOM', 'QUIET': None, 'NOHIST': None,
+                   'FLAT': None})
+    pipeline = run(api)
+    assert sorted(api.ordered) == ['A', 'B', 'BOOM', 'C']
+    assert pipeline.counts == {'screened': 7, 'ordered': 1, 'rejected': 4, 'stale': 0, 'failed': 2}
+    assert not pipeline.in_flight()
+    assert pipeline.format_counts() == '7 screened: 1 ordered, 4 rejected, 0 stale, 2 failed, 0 in flight'
+
+
+def test_stale_candidates_are_not_ordered(monkeypatch):
+    monkeypatch.setattr(lib.pipeline, 'Prediction', FakePrediction)
+    api = FakeAPI({'A': 'ACCEPTED', 'B': 'ACCEPTED'})
+    pipeline = run(api, max_age=-1)
+    assert api.ordered == []
+    assert pipeline.counts == {'screened': 2, 'ordered': 0, 'rejected': 0, 'stale': 2, 'failed': 0}
@@ -0,0 +1,93 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import asyncio
+import threading
+import time
+
+from igasync import RateLimiter
+from igclient import trackcall
+from lib.ratelimit import DEFAULT, HISTORY, RESERVE, TRADE, SharedRateLimiter
+
+
+def test_shared_rate_limiter_priorities(tmp_path):
+    limiter = SharedRateLimiter(str(tmp_path / 'ratelimit.json'), client='check', max_calls=4, period=1.0,
+                                reserve={TRADE: 0, DEFAULT: 1, HISTORY: 2})
+    assert limiter.acquire(HISTORY) < 0.05
+    assert limiter.acquire(HISTORY) < 0.05
+    # history has had its two of the window, a third waits for the first to age out
+    waited = {}
+    history = threading.Thread(target=lambda: waited.setdefault(HISTORY, limiter.acquire(HISTORY)))
+    history.start()
+    time.sleep(0.1)
+    assert HISTORY not in waited
+    assert limiter.acquire(DEFAULT) < 0.05
+    assert limiter.acquire(TRADE) < 0.05, 'a trade call goes ahead of the waiting history call'
+    history.join(5)
+    assert waited[HISTORY] > 0.5
+    assert limiter.usage()['clients']['check']['calls'] == 5
+
+
+def test_async_rate_limiter_priorities():
+    limiter = RateLimiter(max_calls=3, period=0.5, reserve={TRADE: 0, DEFAULT: 1, HISTORY: 2})
+    loop = asyncio.new_event_loop()
+
+    async def calls():
+        start = time.monotonic()
+        await limiter.acquire(HISTORY)
+        await limiter.acquire(DEFAULT)
+        await limiter.acquire(TRADE)
+        quick = time.monotonic() - start
+        await limiter.acquire(HISTORY)
+        return quick, time.monotonic() - start
+    try:
+        quick, waited = loop.run_until_complete(calls())
+    finally:
+        loop.close()
+    assert quick < 0.05
+    assert waited >= 0.4, 'history waits for its one call of the window to age out'
+
+
+class Client(object):
+    def __init__(self):
+        self.rate_limiter = None
+        self.recent_calls = []
+        self.recent_calls_lock = threading.Lock()
+        self.session_manager = None
+        self.auth = {}
+
+    @trackcall
+    def prices(self):
+        return HISTORY
+
+    @trackcall
+    def positions(self):
+        return TRADE
+
+
+def test_in_process_budget_leaves_the_reserve_to_orders():
+    client = Client()
+    # the window is down to what history leaves to the others
+    client.recent_calls = [int(time.time())] * (30-1 - RESERVE[HISTORY])
+    waited = {}
+    history = threading.Thread(target=lambda: waited.setdefault(HISTORY, client.prices()))
+    history.start()
+    time.sleep(0.1)
+    assert HISTORY not in waited
+    start = time.time()
+    assert client.positions() == TRADE
+    assert time.time() - start < 0.5, 'an order goes ahead of the waiting history call'
+    # nothing ages out of the window for a minute, so let the history call through by hand
+    with client.recent_calls_lock:
+        client.recent_calls = []
+    history.join(5)
+    assert waited == {HISTORY: HISTORY}
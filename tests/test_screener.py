@@ -0,0 +1,63 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+from lib.screener import Screener
+
+
+def market(epic_id, change_pct, bid, offer):
+    return {'name': 'MARKET:' + epic_id, 'received': 1.0,
+            'values': {'CHANGE_PCT': str(change_pct), 'BID': str(bid), 'OFFER': str(offer)}}
+
+
+def screener(cooldown=60):
+    # |CHANGE_PCT| between 1 and 5, spreads of at most 2
+    return Screener(['A', 'B', 'C'], change_high=5, change_low=1, max_spreads=[-2, -2, -2], cooldown=cooldown)
+
+
+def test_publishes_epics_as_they_start_passing():
+    s = screener()
+    s.on_update(market('A', 0.5, 100, 101))  # change too small
+    s.on_update(market('B', 2, 100, 103))  # spread too wide
+    s.on_update(market('C', -3, 100, 101))
+    s.on_update(market('X', 3, 100, 101))  # not screened
+    assert list(s.passing()) == [False, False, True]
+    candidate = s.next_candidate(timeout=0)
+    assert candidate == {'values': {'CHANGE_PCT': '-3', 'BID': '100', 'OFFER': '101', 'EPIC': 'C'}, 'received': 1.0}
+    assert s.next_candidate(timeout=0) is None
+
+    # passing again within the cooldown isn't news
+    s.on_update(market('C', -3.5, 100, 101))
+    assert s.next_candidate(timeout=0) is None
+    s.on_update(market('A', 1.5, 100, 101))
+    assert s.next_candidate(timeout=0)['values']['EPIC'] == 'A'
+    assert s.latest('A')['CHANGE_PCT'] == '1.5' and s.latest('X') is None
+
+
+def test_queue_is_checked_again_before_handing_out():
+    s = screener(cooldown=0)
+    s.on_update(market('A', 2, 100, 101))
+    s.on_update(market('B', 2, 100, 101))
+    # A stopped passing, and B got an open position, while they waited in the queue
+    s.on_update(market('A', 9, 100, 101))
+    s.set_excluded(['B'])
+    assert s.next_candidate(timeout=0) is None
+
+    s.set_excluded([])
+    assert s.next_candidate(timeout=0)['values']['EPIC'] == 'B'
+
+
+def test_new_thresholds_rescan():
+    s = screener()
+    s.on_update(market('A', 7, 100, 101))
+    assert s.next_candidate(timeout=0) is None
+    s.set_thresholds(change_high=10, change_low=1, max_spreads=[-2, -2, -2])
+    assert s.next_candidate(timeout=0)['values']['EPIC'] == 'A'
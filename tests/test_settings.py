@@ -0,0 +1,81 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import configparser
+import os
+
+import pytest
+
+from igclient import load_config
+from lib.settings import SettingsWatcher, build_settings
+from tests import ROOT, load_default_config
+
+
+def test_build_settings_validates():
+    settings = build_settings(load_default_config())
+    assert settings.trade.size == 2 and settings.trade.always_guarantee_stops is True
+    assert settings.max_spread_for('CS.D.AUDUSD.TODAY.IP') == settings.trade.max_spread
+    with pytest.raises(ValueError):
+        settings.minspread[0] = 1  # read-only
+    config = load_default_config()
+    config['Trade']['use_max_spread'] = 'no'
+    settings = build_settings(config)
+    assert settings.max_spread_for('CS.D.AUDUSD.TODAY.IP') == pytest.approx(-0.6 * settings.trade.spread_multiplier)
+
+    config = load_default_config()
+    config['Trade']['Price_Change_Day_percent_low'] = '9'
+    with pytest.raises(ValueError, match='Price_Change_Day_percent_low'):
+        build_settings(config)
+    config = load_default_config()
+    del config['Trade']['greed']
+    with pytest.raises(ValueError, match='greed is missing'):
+        build_settings(config)
+
+
+def test_watcher_keeps_the_last_good_settings(tmp_path):
+    with open(os.path.join(ROOT, 'default.conf')) as f:
+        default = f.read()
+    path = str(tmp_path / 'config.conf')
+    mtime = [1000000000]
+
+    def save(text):
+        with open(path, 'w') as f:
+            f.write(text)
+        mtime[0] += 10
+        os.utime(path, (mtime[0], mtime[0]))
+
+    def load():
+        config = configparser.ConfigParser()
+        config.read([path])
+        return build_settings(load_config(config))
+
+    save(default)
+    watcher = SettingsWatcher(load, [path], interval=0)
+    reloads = []
+    watcher.listeners.append(lambda old, new: reloads.append((old.trade.size, new.trade.size)))
+    assert not watcher.check()
+
+    save(default.replace('size: 2', 'size: 3'))
+    assert watcher.check() and watcher.current.trade.size == 3
+
+    # saved half way through an edit, or missing a section or key: none of it replaces the last good snapshot
+    for broken in (default.replace('size: 2', 'size: 4\nsize: 5'),  # DuplicateOptionError
+                   default.replace('[Trade]', '[Trade'),  # ParsingError
+                   default.replace('[Config]', '[Konfig]'),  # KeyError in load_config
+                   default.replace('size: 2', 'size: lots')):  # ValueError
+        save(broken)
+        assert not watcher.check()
+        assert watcher.current.trade.size == 3
+
+    save(default.replace('size: 2', 'size: 6'))
+    assert watcher.check() and watcher.current.trade.size == 6
+    assert reloads == [(2, 3), (3, 6)]
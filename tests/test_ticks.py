@@ -0,0 +1,53 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+
+import pandas as pd
+
+from lib.ticks import BAR_COLUMNS, TickDB
+
+
+def tick(timestamp, epic_id, bid, offer):
+    return {'timestamp': timestamp, 'epic_id': epic_id, 'bid': bid, 'offer': offer}
+
+
+def test_ticks_become_one_bar_per_epic_per_second():
+    ticks = pd.DataFrame([tick(10, 'B', 99, 101), tick(10, 'A', 10, 12), tick(10, 'B', 103, 104),
+                          tick(11, 'B', 95, 96), tick(10, 'B', 100, 101), tick(10, 'A', 9, 10)])
+    bars = TickDB().aggregate_ticks(ticks)
+    assert list(bars.columns) == BAR_COLUMNS
+    assert [tuple(bar) for bar in bars.itertuples(index=False)] == [
+        (10, 'B', 100, 103.5, 100, 100.5, (2 + 1 + 1) / 3),
+        (11, 'B', 95.5, 95.5, 95.5, 95.5, 1),
+        (10, 'A', 11, 11, 9.5, 9.5, 1.5)]
+
+
+def test_recent_ticks_wait_and_the_oldest_bars_are_dropped():
+    db = TickDB()
+    db.agg_size = 4
+    db.max_bars = 3
+    now = int(time.time())
+    for second in range(4):
+        db.add_tick(tick(now - 60 + second, 'A', 100 + second, 101 + second))
+    assert list(db.take()['O']) == [101.5, 102.5, 103.5] and db.dropped_bars == 1
+    assert len(db.take()) == 0
+
+    # ticks from the last few seconds may be followed by more of the same second, so they stay in the buffer
+    for i in range(4):
+        db.add_tick(tick(now - 60 if i < 2 else now, 'A', 100 + i, 101 + i))
+    assert list(db.take()['H']) == [101.5]
+    for i in range(4):
+        db.add_tick(tick(now - 60, 'B', 100, 101))
+    bars = db.take()
+    assert list(zip(bars['epic_id'], bars['C'])) == [('B', 100.5)]
+    assert len(db._tick_buffer) == 2